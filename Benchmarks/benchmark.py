@@ -0,0 +1,208 @@
+# Copyright 2017
+#
+# Licensed under the Apache License, Version 2.0, <LICENSE-APACHE or
+# http://apache.org/licenses/LICENSE-2.0> or the MIT license <LICENSE-MIT or
+# http://opensource.org/licenses/MIT> or the LGPL, Version 2.0 <LICENSE-LGPLv2 or
+# https://www.gnu.org/licenses/old-licenses/lgpl-2.0.txt>, at your option.
+# This file may not be copied, modified, or distributed except according to those terms.
+
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+
+sys.path.append(os.path.dirname(os.path.realpath(__file__)))
+import controlStandIn
+
+
+# Times full ccAutomaton runs (-ce -rj -de by default) against the Control Node stand-in and reports how much of each stage is overhead.
+# The stand-in scripts how long the Environment takes to spin up, how long each job runs and how long the deletion takes. Whatever a stage takes beyond that scripted time is spent by ccAutomaton itself: requests, polling intervals, SSH/SFTP and noticing that something has finished.
+#
+# Usage:
+#     python Benchmarks/benchmark.py --runs 3 --jobs 4 --simultaneous --scenario myScenario.json --output report.json
+
+repositoryDirectory = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+jobScriptText = "#!/bin/bash\n#CC -np 1\necho \"Hello from the stand-in\"\n"
+
+
+def writeConfiguration(workDirectory, standIn, scenario, jobs, simultaneous):
+    userName = scenario.get("userName") or "benchmark"
+    password = scenario.get("password") or "benchmark"
+    jobScriptPath = os.path.join(workDirectory, "benchmark.sh")
+    with open(jobScriptPath, "w") as f:
+        f.write(jobScriptText)
+
+    # The Environment is expected to take as long as the scenario says it will (see monitorEnvironmentCreation)
+    expectedCreationTime = sum(float(state.get("seconds", 0)) for state in scenario['environmentCreation'])
+    general = {"environmentName": "benchmark", "cloudType": "aws", "dnsName": standIn.domainName, "sessionCacheDirectory": os.path.join(workDirectory, "sessions"), "expectedCreationTime": str(expectedCreationTime), "readinessTimeout": "300"}
+    # Any other General field (ex: pollInitialInterval) can be set from the scenario
+    general.update(scenario.get("general", {}))
+
+    lines = ["[UserInfo]", "userName: " + str(userName), "password: " + str(password), "firstName: Bench", "lastName: Mark", "pempath:", "", "[General]"]
+    lines += [str(name) + ": " + str(value) for name, value in general.items()]
+    lines += ["", "[CloudyClusterEnvironment]", "templateName: ccqEnvironment1", "keyName: benchmark", "region: us-east-2", "az: us-east-2a", "", "[Computation]"]
+    for job in range(1, jobs + 1):
+        options = {"uploadProtocol": "sftp", "uploadScript": "true", "localPath": jobScriptPath, "remotePath": "/home/" + str(userName) + "/benchmark" + str(job) + ".sh", "executeDirectory": "/home/" + str(userName), "monitorJob": "false" if simultaneous else "true", "timeout": 600, "directory": workDirectory, "schedulerType": "ccq"}
+        lines.append("jobScript" + str(job) + ": " + json.dumps({"name": "benchmark" + str(job), "options": options}))
+
+    # The template definition goes in its own section like in the shipped configuration files (ex: ConfigurationFiles/ccqEnvironment1.conf), the name must match the schedName in EnvironmentTemplates/CloudyCluster/ccqEnvironment1.py
+    lines += ["", "# Template definitions", "[ccqEnvironment1]", "vpcCidr: 10.0.0.0/16", "scheduler1: {'type': 'Slurm', 'ccq': 'true', 'instanceType': 't2.small', 'name': '" + str(scenario['schedulerName']) + "'}", "efs1: {\"type\": \"common\"}", "efs3: {\"type\": \"sharedHome\"}", "login1: {'name': 'Login', 'instanceType': 't2.small'}", "nat1: {'instanceType': 't2.micro', 'accessFrom': '0.0.0.0/0'}"]
+
+    configFilePath = os.path.join(workDirectory, "benchmark.conf")
+    with open(configFilePath, "w") as f:
+        f.write("\n".join(lines) + "\n")
+    return configFilePath
+
+
+def unionSeconds(intervals):
+    # The length of the union of the (start, end) intervals, jobs that run at the same time only count once
+    total = 0.0
+    currentStart = None
+    currentEnd = None
+    for start, end in sorted(intervals):
+        if currentEnd is None or start > currentEnd:
+            if currentEnd is not None:
+                total += currentEnd - currentStart
+            currentStart, currentEnd = start, end
+        else:
+            currentEnd = max(currentEnd, end)
+    if currentEnd is not None:
+        total += currentEnd - currentStart
+    return total
+
+
+def analyzeStages(report, requestLog, machines):
+    # Splits the time of every stage into the scripted time (the stand-in was busy on purpose), the time spent answering requests and the rest, which is overhead
+    stages = {}
+    for name, stage in report.get("stages", {}).items():
+        if stage.get("startTime") is None or stage.get("endTime") is None:
+            continue
+        startTime, endTime = float(stage['startTime']), float(stage['endTime'])
+        requests = [entry for entry in requestLog if startTime <= entry['startTime'] <= endTime]
+        scripted = []
+        lags = []
+        for machine in machines:
+            if startTime <= machine['startTime'] <= endTime and machine['finishedAt'] is not None:
+                scripted.append((machine['startTime'], min(machine['finishedAt'], endTime)))
+                if machine['noticedAt'] is not None:
+                    lags.append(machine['noticedAt'] - machine['finishedAt'])
+        seconds = endTime - startTime
+        scriptedSeconds = unionSeconds(scripted)
+        stages[name] = {"status": stage['status'], "seconds": seconds, "scripted": scriptedSeconds, "overhead": seconds - scriptedSeconds, "requests": len(requests), "requestSeconds": sum(entry['endTime'] - entry['startTime'] for entry in requests), "injectedLatency": sum(entry['latency'] for entry in requests), "noticeLag": max(lags) if lags else None}
+    return stages
+
+
+def runOnce(standIn, scenario, stages, jobs, simultaneous, keep, number):
+    workDirectory = tempfile.mkdtemp(prefix="ccAutomatonBenchmark-")
+    exitCode = None
+    try:
+        configFilePath = writeConfiguration(workDirectory, standIn, scenario, jobs, simultaneous)
+        reportPath = os.path.join(workDirectory, "report.json")
+        logPath = os.path.join(workDirectory, "ccAutomaton.log")
+        command = [sys.executable, os.path.join(repositoryDirectory, "Create_Processing_Environment.py"), "-et", "CloudyCluster", "-cf", configFilePath, "-sf", os.path.join(workDirectory, "state.db"), "-rp", reportPath] + ["-" + stage for stage in stages]
+        environment = dict(os.environ)
+        # Trust the self signed certificate of the stand-in
+        environment['REQUESTS_CA_BUNDLE'] = standIn.certificatePath
+
+        machinesBefore = set(machine['name'] + str(machine['startTime']) for machine in standIn.getStateMachines())
+        startTime = time.time()
+        with open(logPath, "w") as log:
+            exitCode = subprocess.call(command, cwd=workDirectory, env=environment, stdout=log, stderr=subprocess.STDOUT)
+        endTime = time.time()
+
+        try:
+            with open(reportPath, "r") as f:
+                report = json.load(f)
+        except Exception as e:
+            report = {"stages": {}, "error": "The run did not write a report."}
+        requestLog = standIn.getRequestLog(startTime, endTime)
+        machines = [machine for machine in standIn.getStateMachines() if machine['name'] + str(machine['startTime']) not in machinesBefore]
+        result = {"run": number, "exitCode": exitCode, "seconds": endTime - startTime, "stages": analyzeStages(report, requestLog, machines), "routes": controlStandIn.summarizeRequests(requestLog), "error": report.get("error")}
+        if keep or exitCode != 0:
+            result['workDirectory'] = workDirectory
+        return result
+    finally:
+        # The log of a failed run is kept so the failure can be looked at
+        if not keep and exitCode == 0:
+            shutil.rmtree(workDirectory, ignore_errors=True)
+
+
+def aggregate(results):
+    # Mean, min and max of every stage figure over the runs
+    stages = {}
+    for result in results:
+        for name, stage in result['stages'].items():
+            stages.setdefault(name, []).append(stage)
+    summary = {}
+    for name, runs in stages.items():
+        summary[name] = {}
+        for figure in ["seconds", "scripted", "overhead", "requests", "requestSeconds", "noticeLag"]:
+            values = [run[figure] for run in runs if run[figure] is not None]
+            if len(values) != 0:
+                summary[name][figure] = {"mean": sum(values) / len(values), "min": min(values), "max": max(values)}
+    return summary
+
+
+def printSummary(summary, results):
+    print("%-6s %-10s %-10s %-10s %-10s %-12s %s" % ("Stage", "Seconds", "Scripted", "Overhead", "Requests", "Request s", "Notice lag"))
+    for name, stage in summary.items():
+        def mean(figure):
+            return stage[figure]['mean'] if figure in stage else None
+        print("%-6s %-10s %-10s %-10s %-10s %-12s %s" % tuple([name] + [("%.2f" % value) if value is not None else "-" for value in [mean("seconds"), mean("scripted"), mean("overhead"), mean("requests"), mean("requestSeconds"), mean("noticeLag")]]))
+    failed = [result for result in results if result['exitCode'] != 0]
+    total = [result['seconds'] for result in results]
+    print(str(len(results)) + " runs, " + str(len(failed)) + " failed, " + ("%.2f" % (sum(total) / len(total))) + " seconds per run on average.")
+    for result in failed:
+        print("Run " + str(result['run']) + " failed: " + str(result.get("error")) + " (" + str(result.get("workDirectory")) + ")")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Times full ccAutomaton runs against a local Control Node stand-in and reports the overhead of every stage.")
+    parser.add_argument('-s', '--scenario', help="A JSON file with the fields of the stand-in scenario to change (see controlStandIn.defaultScenario). A general field holds extra General section fields for the runs.", default=None)
+    parser.add_argument('-n', '--runs', type=int, help="The number of runs. The default is 1.", default=1)
+    parser.add_argument('-j', '--jobs', type=int, help="The number of job scripts in each run. The default is 1.", default=1)
+    parser.add_argument('--simultaneous', action='store_true', help="Submit the job scripts together and monitor them at the same time (monitorJob false) instead of one after the other.", default=False)
+    parser.add_argument('--stages', nargs='+', help="The ccAutomaton stages to run. The default is ce rj de.", default=["ce", "rj", "de"])
+    parser.add_argument('-o', '--output', help="Write the results of every run and the summary to this JSON file.", default=None)
+    parser.add_argument('-k', '--keep', action='store_true', help="Keep the work directory (configuration, log, run state and report) of every run. The directories of failed runs are always kept.", default=False)
+    args = parser.parse_args()
+
+    try:
+        scenario = controlStandIn.loadScenario(args.scenario)
+    except Exception as e:
+        print("Unable to read the scenario " + str(args.scenario) + ".")
+        print(''.join(traceback.format_exc()))
+        sys.exit(1)
+
+    standIn = controlStandIn.ControlStandIn(scenario=scenario)
+    standIn.start()
+    print("The Control Node stand-in is listening on " + standIn.domainName + ".")
+    results = []
+    try:
+        for number in range(1, args.runs + 1):
+            print("Run " + str(number) + " of " + str(args.runs) + ": ccAutomaton " + " ".join("-" + stage for stage in args.stages))
+            result = runOnce(standIn, scenario, args.stages, args.jobs, args.simultaneous, args.keep, number)
+            print("Run " + str(number) + " finished with exit code " + str(result['exitCode']) + " in " + ("%.2f" % result['seconds']) + " seconds.")
+            results.append(result)
+    finally:
+        standIn.stop()
+
+    summary = aggregate(results)
+    printSummary(summary, results)
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump({"scenario": scenario, "runs": results, "summary": summary}, f, indent=4, default=str)
+        print("The results were written to " + str(args.output) + ".")
+    if any(result['exitCode'] != 0 for result in results):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,800 @@
+# Copyright 2017
+#
+# Licensed under the Apache License, Version 2.0, <LICENSE-APACHE or
+# http://apache.org/licenses/LICENSE-2.0> or the MIT license <LICENSE-MIT or
+# http://opensource.org/licenses/MIT> or the LGPL, Version 2.0 <LICENSE-LGPLv2 or
+# https://www.gnu.org/licenses/old-licenses/lgpl-2.0.txt>, at your option.
+# This file may not be copied, modified, or distributed except according to those terms.
+
+
+import argparse
+import copy
+import datetime
+import ipaddress
+import json
+import logging
+import os
+import posixpath
+import random
+import shlex
+import shutil
+import socket
+import socketserver
+import ssl
+import tempfile
+import threading
+import time
+import traceback
+import uuid
+from http.cookies import SimpleCookie
+from http.server import BaseHTTPRequestHandler
+from urllib.parse import urlsplit
+
+import paramiko
+
+
+# A local stand-in for a CloudyCluster Control Node (and the Login Instance of its Environments) so ccAutomaton can be run end to end without any cloud resources.
+# It answers the /srv/* routes that ccAutomaton uses over HTTPS and runs an SSH/SFTP server for the job scripts (ccqsub), both on the same port so the Control Node DNS name and the Login Instance DNS name can both be localhost:<port>.
+# How long the Environment takes to spin up or delete and the states each job goes through are scripted (see defaultScenario) and every route can be given extra latency or random failures.
+#
+# Usage:
+#     python controlStandIn.py --port 8443 --scenario myScenario.json
+#     export REQUESTS_CA_BUNDLE=<the certificate printed on startup>
+#     python Create_Processing_Environment.py -et CloudyCluster -ce -rj -de -dn localhost:8443
+
+defaultScenario = {
+    # When userName is None every user name and password combination is accepted
+    "userName": None,
+    "password": None,
+    "schedulerName": "mySlurm",
+    # Sessions older than this many seconds get the login prompt back (ex: to exercise logging in again), None keeps them forever
+    "sessionLifetime": None,
+    # A CC API key that already exists for every user (ex: "benchmarkid:benchmarksecret"), without one the key is generated by /srv/saveAndGenUserAppKey
+    "apiKey": None,
+    "seed": None,
+    # Seconds (or a [low, high] range) added to each route (ex: {"default": 0.05, "/srv/getSpinningCluster": [0.2, 0.5], "ccqsub": 1})
+    "latency": {"default": 0.0},
+    # Random failures per route (ex: {"/srv/ccqstat": {"rate": 0.1, "status": 503}})
+    "errors": {},
+    # The scripted state machines, each state lasts its seconds and is seen by at least its polls requests before the next one starts. The last state is final.
+    "environmentCreation": [{"state": "creating", "seconds": 5}, {"state": "spunUp"}],
+    "environmentDeletion": [{"state": "deleting", "seconds": 3}, {"state": "deleted"}],
+    "stateChange": [{"state": "changing", "seconds": 2}, {"state": "done"}],
+    "job": [{"state": "Pending", "seconds": 1}, {"state": "Running", "seconds": 2}, {"state": "Completed"}],
+}
+
+# The SSH readiness probe hangs up without finishing the handshake, which paramiko would report on stderr for every probe
+logging.getLogger("controlStandIn.ssh").addHandler(logging.NullHandler())
+logging.getLogger("controlStandIn.ssh").propagate = False
+
+# The instance ids of the Environment, the Login Instance is the one the job scripts connect to
+controlInstanceId = "i-0000000000control"
+loginInstanceId = "i-00000000000login"
+schedulerInstanceId = "i-000000000sched"
+natInstanceId = "i-0000000000000nat"
+
+
+def loadScenario(path=None):
+    # Returns the default scenario updated with the fields of the JSON file at path
+    scenario = copy.deepcopy(defaultScenario)
+    if path is not None:
+        with open(path, "r") as f:
+            scenario.update(json.load(f))
+    return scenario
+
+
+def createCertificate(directory, hostNames=("localhost",), ipAddresses=("127.0.0.1",)):
+    # Creates a self signed certificate for the stand-in, the certificate file doubles as the CA bundle for the clients (REQUESTS_CA_BUNDLE)
+    from cryptography import x509
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa
+    from cryptography.x509.oid import NameOID
+
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, str(hostNames[0]))])
+    alternativeNames = [x509.DNSName(str(hostName)) for hostName in hostNames] + [x509.IPAddress(ipaddress.ip_address(str(address))) for address in ipAddresses]
+    now = datetime.datetime.now(datetime.timezone.utc)
+    certificate = (x509.CertificateBuilder()
+                   .subject_name(name)
+                   .issuer_name(name)
+                   .public_key(key.public_key())
+                   .serial_number(x509.random_serial_number())
+                   .not_valid_before(now - datetime.timedelta(minutes=5))
+                   .not_valid_after(now + datetime.timedelta(days=7))
+                   .add_extension(x509.SubjectAlternativeName(alternativeNames), critical=False)
+                   .add_extension(x509.BasicConstraints(ca=True, path_length=None), critical=True)
+                   .sign(key, hashes.SHA256()))
+
+    certificatePath = os.path.join(directory, "standIn.crt")
+    keyPath = os.path.join(directory, "standIn.key")
+    with open(certificatePath, "wb") as f:
+        f.write(certificate.public_bytes(serialization.Encoding.PEM))
+    descriptor = os.open(keyPath, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(descriptor, "wb") as f:
+        f.write(key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.TraditionalOpenSSL, serialization.NoEncryption()))
+    return certificatePath, keyPath
+
+
+class StateMachine(object):
+    # Walks through a scripted list of states (ex: [{"state": "creating", "seconds": 30}, {"state": "spunUp"}]). The states are worked out from the clock when they are asked for so there is no thread per machine.
+    def __init__(self, name, states):
+        self.name = str(name)
+        self.states = [dict(state) for state in states]
+        self.index = 0
+        now = time.time()
+        self.startTime = now
+        # When each state started and when a request first saw it, the difference for the last state is how long the client took to notice
+        self.enteredAt = [None] * len(self.states)
+        self.observedAt = [None] * len(self.states)
+        self.enteredAt[0] = now
+        self.polls = 0
+        self.lastObservedAt = now
+        self.lock = threading.Lock()
+
+    def advance(self, now):
+        while self.index < len(self.states) - 1:
+            state = self.states[self.index]
+            endsAt = self.enteredAt[self.index] + float(state.get("seconds", 0))
+            if "polls" in state:
+                if self.polls < int(state['polls']):
+                    break
+                endsAt = max(endsAt, self.lastObservedAt)
+            if now < endsAt:
+                break
+            self.index += 1
+            self.enteredAt[self.index] = endsAt
+            self.polls = 0
+
+    def peek(self):
+        # The current state without counting it as seen by a client
+        with self.lock:
+            self.advance(time.time())
+            return self.states[self.index]
+
+    def current(self):
+        with self.lock:
+            now = time.time()
+            self.advance(now)
+            if self.observedAt[self.index] is None:
+                self.observedAt[self.index] = now
+            self.polls += 1
+            self.lastObservedAt = now
+            return self.states[self.index]
+
+    def finished(self):
+        with self.lock:
+            self.advance(time.time())
+            return self.index == len(self.states) - 1
+
+    def describe(self):
+        with self.lock:
+            self.advance(time.time())
+            finalState = len(self.states) - 1
+            return {"name": self.name, "startTime": self.startTime, "states": [{"state": self.states[index]['state'], "enteredAt": self.enteredAt[index], "observedAt": self.observedAt[index]} for index in range(len(self.states))], "finishedAt": self.enteredAt[finalState], "noticedAt": self.observedAt[finalState]}
+
+
+class StandInHttpHandler(BaseHTTPRequestHandler):
+    # Keep-alive so the pooled sessions of ccAutomaton reuse their connections the same way they do with a real Control Node
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.server.standIn.handleHttp(self)
+
+    def do_POST(self):
+        self.server.standIn.handleHttp(self)
+
+    def log_message(self, format, *args):
+        # The requests are recorded in the request log instead
+        pass
+
+
+class StandInServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, standIn):
+        self.standIn = standIn
+        socketserver.ThreadingTCPServer.__init__(self, address, StandInHttpHandler)
+
+    def finish_request(self, request, clientAddress):
+        self.standIn.handleConnection(request, clientAddress, self)
+
+
+class StandInSshServer(paramiko.ServerInterface):
+    def __init__(self, standIn):
+        self.standIn = standIn
+        self.userName = None
+        self.password = None
+
+    def get_allowed_auths(self, username):
+        return "password,keyboard-interactive"
+
+    def check_auth_password(self, username, password):
+        if self.standIn.checkPassword(username, password):
+            self.userName = username
+            return paramiko.AUTH_SUCCESSFUL
+        return paramiko.AUTH_FAILED
+
+    def check_auth_interactive(self, username, submethods):
+        # The job scripts log in with keyboard-interactive and answer the "Password" prompt
+        self.userName = username
+        return paramiko.InteractiveQuery("", "", ("Password: ", False))
+
+    def check_auth_interactive_response(self, responses):
+        if len(responses) == 1 and self.standIn.checkPassword(self.userName, responses[0]):
+            return paramiko.AUTH_SUCCESSFUL
+        return paramiko.AUTH_FAILED
+
+    def check_channel_request(self, kind, chanid):
+        if kind == "session":
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_exec_request(self, channel, command):
+        threading.Thread(target=self.standIn.runCommand, args=(channel, self.userName, command.decode(errors="replace")), daemon=True).start()
+        return True
+
+
+class StandInSftpHandle(paramiko.SFTPHandle):
+    def stat(self):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def chattr(self, attr):
+        return paramiko.SFTP_OK
+
+
+class StandInSftp(paramiko.SFTPServerInterface):
+    # Serves the files of the stand-in directory, relative paths are in the home directory of the user (/home/<userName>)
+    def __init__(self, server, *args, **kwargs):
+        super(StandInSftp, self).__init__(server, *args, **kwargs)
+        self.standIn = server.standIn
+        self.userName = server.userName
+
+    def getLocalPath(self, path):
+        return self.standIn.getLocalPath(self.userName, path)
+
+    def canonicalize(self, path):
+        if not str(path).startswith("/"):
+            path = posixpath.join(self.standIn.getHome(self.userName), str(path))
+        return posixpath.normpath(str(path))
+
+    def open(self, path, flags, attr):
+        # Job output only shows up once the job has finished
+        self.standIn.writeFinishedJobOutput()
+        localPath = self.getLocalPath(path)
+        try:
+            if flags & (os.O_WRONLY | os.O_RDWR):
+                os.makedirs(os.path.dirname(localPath), exist_ok=True)
+            mode = getattr(attr, "st_mode", None) or 0o644
+            descriptor = os.open(localPath, flags, mode)
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        if flags & os.O_WRONLY:
+            fileMode = "ab" if flags & os.O_APPEND else "wb"
+        elif flags & os.O_RDWR:
+            fileMode = "a+b" if flags & os.O_APPEND else "r+b"
+        else:
+            fileMode = "rb"
+        handle = StandInSftpHandle(flags)
+        handle.filename = localPath
+        handle.readfile = os.fdopen(descriptor, fileMode)
+        handle.writefile = handle.readfile
+        return handle
+
+    def stat(self, path):
+        self.standIn.writeFinishedJobOutput()
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.stat(self.getLocalPath(path)))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def lstat(self, path):
+        return self.stat(path)
+
+    def list_folder(self, path):
+        localPath = self.getLocalPath(path)
+        try:
+            entries = []
+            for fileName in os.listdir(localPath):
+                attributes = paramiko.SFTPAttributes.from_stat(os.stat(os.path.join(localPath, fileName)))
+                attributes.filename = fileName
+                entries.append(attributes)
+            return entries
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def remove(self, path):
+        try:
+            os.remove(self.getLocalPath(path))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+    def rename(self, oldpath, newpath):
+        try:
+            os.rename(self.getLocalPath(oldpath), self.getLocalPath(newpath))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+    def mkdir(self, path, attr):
+        try:
+            os.mkdir(self.getLocalPath(path))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+    def rmdir(self, path):
+        try:
+            os.rmdir(self.getLocalPath(path))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+    def chattr(self, path, attr):
+        return paramiko.SFTP_OK
+
+
+class ControlStandIn(object):
+    def __init__(self, scenario=None, host="127.0.0.1", port=0, directory=None):
+        self.scenario = scenario if scenario is not None else loadScenario()
+        self.host = str(host)
+        self.port = int(port)
+        # Holds the certificate, the SSH host key and the files uploaded over SFTP
+        self.ownsDirectory = directory is None
+        self.directory = directory if directory is not None else tempfile.mkdtemp(prefix="controlStandIn-")
+        self.random = random.Random(self.scenario.get("seed"))
+
+        self.sessions = {}
+        self.appKeys = {}
+        self.clusters = {}
+        self.jobs = {}
+        self.nextJobId = 1
+        self.lock = threading.Lock()
+
+        # One entry per HTTP request (and ccqsub command): {"path", "status", "startTime", "endTime", "latency"}
+        self.requestLog = []
+        self.requestLogLock = threading.Lock()
+
+        self.server = None
+        self.serverThread = None
+        self.sslContext = None
+        self.hostKey = None
+        self.certificatePath = None
+
+        self.routes = {"/srv/cloudyLogin": self.cloudyLogin, "/srv/getCurrentDomain": self.getCurrentDomain, "/srv/getGeneratedTableNames": self.getGeneratedTableNames, "/srv/writeEfs": self.writeEfs, "/srv/saveCluster": self.saveCluster, "/srv/startCluster": self.startCluster, "/srv/getSpinningCluster": self.getSpinningCluster, "/srv/getSpinningClusterPart": self.getSpinningClusterPart, "/srv/getClusterByName": self.getClusterByName, "/srv/cloudycluster/Base": self.clusterAction, "/srv/listAppKeys": self.listAppKeys, "/srv/saveAndGenUserAppKey": self.saveAndGenUserAppKey, "/srv/setNewDBThroughput": self.setNewDBThroughput, "/srv/deleteOriginalControlNode": self.deleteOriginalControlNode, "/srv/ccqsub": self.ccqsub, "/srv/ccqstat": self.ccqstat}
+        # These routes do not need the session cookie (ccqsub and ccqstat check the CC API key instead)
+        self.publicRoutes = {"/srv/cloudyLogin", "/srv/getCurrentDomain", "/srv/getGeneratedTableNames", "/srv/writeEfs", "/srv/ccqsub", "/srv/ccqstat"}
+
+    @property
+    def domainName(self):
+        return "localhost:" + str(self.port)
+
+    def start(self):
+        self.certificatePath, keyPath = createCertificate(self.directory)
+        self.sslContext = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        self.sslContext.load_cert_chain(self.certificatePath, keyPath)
+        self.hostKey = paramiko.RSAKey.generate(2048)
+        self.server = StandInServer((self.host, self.port), self)
+        self.port = self.server.server_address[1]
+        self.serverThread = threading.Thread(target=self.server.serve_forever, name="controlStandIn", daemon=True)
+        self.serverThread.start()
+        return {"status": "success", "payload": {"domainName": self.domainName, "certificatePath": self.certificatePath}}
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+        if self.ownsDirectory:
+            shutil.rmtree(self.directory, ignore_errors=True)
+
+    def handleConnection(self, request, clientAddress, server):
+        # HTTPS, plain HTTP and SSH share the port, the first byte tells them apart. SSH clients send their identification string right away, the readiness probe only listens so a quiet connection is SSH as well.
+        try:
+            request.settimeout(0.3)
+            try:
+                first = request.recv(1, socket.MSG_PEEK)
+                if first == b"":
+                    return
+            except socket.timeout:
+                first = b"S"
+            request.settimeout(None)
+            if first == b"\x16":
+                connection = self.sslContext.wrap_socket(request, server_side=True)
+                try:
+                    StandInHttpHandler(connection, clientAddress, server)
+                finally:
+                    connection.close()
+            elif first == b"S":
+                self.handleSsh(request)
+            else:
+                StandInHttpHandler(request, clientAddress, server)
+        except Exception as e:
+            # Clients that go away halfway through a handshake (ex: the SSH readiness probe) end up here
+            pass
+
+    def handleSsh(self, request):
+        transport = paramiko.Transport(request)
+        transport.set_log_channel("controlStandIn.ssh")
+        transport.add_server_key(self.hostKey)
+        transport.set_subsystem_handler("sftp", paramiko.SFTPServer, StandInSftp)
+        try:
+            transport.start_server(server=StandInSshServer(self))
+            transport.join()
+        finally:
+            transport.close()
+
+    def getLatency(self, route):
+        latency = self.scenario.get("latency", {})
+        value = latency.get(route, latency.get("default", 0.0))
+        if isinstance(value, (list, tuple)):
+            with self.lock:
+                return self.random.uniform(float(value[0]), float(value[1]))
+        return float(value or 0.0)
+
+    def getInjectedError(self, route):
+        error = self.scenario.get("errors", {}).get(route)
+        if not error:
+            return None
+        with self.lock:
+            failed = self.random.random() < float(error.get("rate", 0))
+        if failed:
+            return int(error.get("status", 503))
+        return None
+
+    def recordRequest(self, route, status, startTime, latency):
+        with self.requestLogLock:
+            self.requestLog.append({"path": route, "status": status, "startTime": startTime, "endTime": time.time(), "latency": latency})
+
+    def getRequestLog(self, startTime=None, endTime=None):
+        with self.requestLogLock:
+            return [entry for entry in self.requestLog if (startTime is None or entry['startTime'] >= startTime) and (endTime is None or entry['startTime'] <= endTime)]
+
+    def getStateMachines(self):
+        # Every state machine that has been started, as dictionaries (see StateMachine.describe)
+        with self.lock:
+            machines = []
+            for cluster in self.clusters.values():
+                machines += [cluster[kind] for kind in ["creation", "deletion", "stateChange"] if cluster.get(kind) is not None]
+            machines += [job['machine'] for job in self.jobs.values()]
+        return [machine.describe() for machine in machines]
+
+    def checkPassword(self, userName, password):
+        if self.scenario.get("userName") is None:
+            return userName is not None and password is not None
+        return str(userName) == str(self.scenario['userName']) and str(password) == str(self.scenario['password'])
+
+    def getHome(self, userName):
+        return "/home/" + str(userName)
+
+    def getLocalPath(self, userName, path):
+        path = str(path)
+        if not path.startswith("/"):
+            path = posixpath.join(self.getHome(userName), path)
+        path = posixpath.normpath(path).lstrip("/")
+        return os.path.join(self.directory, "root", path)
+
+    def handleHttp(self, handler):
+        startTime = time.time()
+        route = urlsplit(handler.path).path
+        length = int(handler.headers.get("Content-Length") or 0)
+        body = handler.rfile.read(length) if length > 0 else b""
+        latency = self.getLatency(route)
+        if latency > 0:
+            time.sleep(latency)
+        headers = {}
+        try:
+            parameters = json.loads(body) if body else {}
+        except Exception as e:
+            parameters = {}
+
+        status = self.getInjectedError(route)
+        if status is not None:
+            content = {"status": "error", "message": "The stand-in failed this request on purpose."}
+        elif route not in self.routes:
+            status, content = 404, {"status": "error", "message": "Unknown route " + str(route) + "."}
+        else:
+            userName = self.getSessionUser(handler.headers.get("Cookie"))
+            if route not in self.publicRoutes and userName is None:
+                # Same as a Control Node whose session has expired
+                status, content = 401, "Please Login"
+            else:
+                try:
+                    values = self.routes[route](parameters, userName)
+                    status, content = values[0], values[1]
+                    if len(values) > 2:
+                        headers = values[2]
+                except Exception as e:
+                    status, content = 500, {"status": "error", "message": "The stand-in failed to handle " + str(route) + ".", "traceback": ''.join(traceback.format_exc())}
+
+        if isinstance(content, (dict, list)):
+            data = json.dumps(content).encode()
+            contentType = "application/json"
+        else:
+            data = str(content).encode()
+            contentType = "text/html"
+        handler.send_response(status)
+        for name, value in headers.items():
+            handler.send_header(name, value)
+        handler.send_header("Content-Type", contentType)
+        handler.send_header("Content-Length", str(len(data)))
+        handler.end_headers()
+        handler.wfile.write(data)
+        self.recordRequest(route, status, startTime, latency)
+
+    def getSessionUser(self, cookieHeader):
+        if not cookieHeader:
+            return None
+        cookies = SimpleCookie()
+        try:
+            cookies.load(str(cookieHeader))
+        except Exception as e:
+            return None
+        if "sessionId" not in cookies:
+            return None
+        with self.lock:
+            session = self.sessions.get(cookies['sessionId'].value)
+        if session is None:
+            return None
+        sessionLifetime = self.scenario.get("sessionLifetime")
+        if sessionLifetime is not None and time.time() - session['createdAt'] > float(sessionLifetime):
+            return None
+        return session['userName']
+
+    def cloudyLogin(self, parameters, userName):
+        if not self.checkPassword(parameters.get("userName"), parameters.get("password")):
+            return 200, {"status": "error", "message": "Incorrect User / Password Combination"}
+        token = uuid.uuid4().hex
+        with self.lock:
+            self.sessions[token] = {"userName": str(parameters['userName']), "createdAt": time.time()}
+        os.makedirs(self.getLocalPath(parameters['userName'], "."), exist_ok=True)
+        return 200, {"status": "success", "message": "Successfully logged in."}, {"Set-Cookie": "sessionId=" + token + "; Path=/"}
+
+    def getCurrentDomain(self, parameters, userName):
+        return 200, {"status": "success", "payload": self.domainName}
+
+    def getGeneratedTableNames(self, parameters, userName):
+        return 200, {"status": "success", "payload": {"objectTableName": "standInObjects", "lookupTableName": "standInLookup"}}
+
+    def writeEfs(self, parameters, userName):
+        # The real route does not return anything on success
+        return 200, ""
+
+    def setNewDBThroughput(self, parameters, userName):
+        return 200, {"status": "success", "message": "Successfully updated the DB Table Capacity."}
+
+    def deleteOriginalControlNode(self, parameters, userName):
+        return 200, {"status": "success", "message": "The Control Node is being deleted."}
+
+    def getCluster(self, clusterName):
+        with self.lock:
+            return self.clusters.get(str(clusterName))
+
+    def saveCluster(self, parameters, userName):
+        clusterName = str(parameters.get("clusterName") or parameters['clusterObj'].get("clusterName"))
+        with self.lock:
+            self.clusters[clusterName] = {"object": parameters['clusterObj'], "creation": None, "deletion": None, "stateChange": None}
+        return 200, {"response": "success", "message": "Saved the Environment " + clusterName + "."}
+
+    def startCluster(self, parameters, userName):
+        clusterName = str(parameters['clusterObj'].get("clusterName"))
+        cluster = self.getCluster(clusterName)
+        if cluster is None:
+            return 200, {"response": "error", "message": "The Environment " + clusterName + " has not been saved."}
+        cluster['creation'] = StateMachine("create " + clusterName, self.scenario['environmentCreation'])
+        return 200, {"response": "success", "message": "Started the creation of the Environment " + clusterName + "."}
+
+    def getSpinningCluster(self, parameters, userName):
+        cluster = self.getCluster(parameters.get("clusterName"))
+        if cluster is None or cluster['creation'] is None:
+            return 200, {"clusterSpunUp": "false", "clusterError": "none"}
+        state = cluster['creation'].current()
+        if state['state'] == "error":
+            return 200, {"clusterSpunUp": "false", "clusterError": state.get("message", "The stand-in failed the Environment on purpose.")}
+        return 200, {"clusterSpunUp": "true" if state['state'] == "spunUp" else "false", "clusterError": "none"}
+
+    def getInstanceStates(self, cluster):
+        # Returns {instanceId: state name} for the Environment, the Control Node is always running
+        states = {controlInstanceId: "running"}
+        if cluster is None or cluster['creation'] is None or (cluster['deletion'] is not None and cluster['deletion'].finished()):
+            return states
+        if cluster['creation'].peek()['state'] != "spunUp":
+            state = "pending"
+        else:
+            state = "running"
+            if cluster['deletion'] is not None:
+                state = "shutting-down"
+            elif cluster['stateChange'] is not None:
+                action = cluster['stateChangeAction']
+                if cluster['stateChange'].finished():
+                    state = "stopped" if action == "pause" else "running"
+                else:
+                    state = "stopping" if action == "pause" else "pending"
+        for instanceId in [loginInstanceId, schedulerInstanceId, natInstanceId]:
+            states[instanceId] = state
+        return states
+
+    def getSpinningClusterPart(self, parameters, userName):
+        cluster = self.getCluster(parameters.get("clusterName"))
+        states = self.getInstanceStates(cluster)
+        if cluster is not None and cluster['creation'] is not None:
+            # Counts as seen by the client (ex: the readiness checks) for the state machine
+            cluster['creation'].current()
+        roles = {controlInstanceId: ("Utility", "ControlNode", self.domainName), loginInstanceId: ("Utility", "WebDavNode", self.domainName), schedulerInstanceId: ("Utility", "SchedulerNode", None), natInstanceId: ("VPC Info", "NATNode", None)}
+        instances = {}
+        for instanceId, state in states.items():
+            groupName, role, domainName = roles[instanceId]
+            if groupName == parameters.get("groupName"):
+                instances[instanceId] = {"RecType": role, "domainName": domainName, "State": str({'Code': 16, 'Name': state})}
+        return 200, {str(parameters.get("type")): {str(parameters.get("groupName")): {"instances": instances}}}
+
+    def getClusterByName(self, parameters, userName):
+        cluster = self.getCluster(parameters.get("clusterName"))
+        if cluster is None:
+            return 200, {}
+        if cluster['deletion'] is not None and cluster['deletion'].current()['state'] == "deleted":
+            # Once the Environment is gone the Control Node no longer answers with JSON
+            return 200, ""
+        return 200, cluster['object']
+
+    def clusterAction(self, parameters, userName):
+        clusterObject = parameters.get("clusterObj", {})
+        clusterName = str(clusterObject.get("clusterName"))
+        cluster = self.getCluster(clusterName)
+        if cluster is None:
+            return 200, {"status": "error", "message": "The Environment " + clusterName + " does not exist."}
+        action = clusterObject.get("action")
+        if action == "terminate":
+            cluster['deletion'] = StateMachine("delete " + clusterName, self.scenario['environmentDeletion'])
+        elif action in ["pause", "resume"]:
+            cluster['stateChangeAction'] = action
+            cluster['stateChange'] = StateMachine(str(action) + " " + clusterName, self.scenario['stateChange'])
+        else:
+            return 200, {"status": "error", "message": "Unsupported action " + str(action) + "."}
+        return 200, {"status": "success", "message": "Started the " + str(action) + " of the Environment " + clusterName + "."}
+
+    def getApiKey(self, userName):
+        with self.lock:
+            if userName not in self.appKeys and self.scenario.get("apiKey") is not None:
+                self.appKeys[userName] = str(self.scenario['apiKey'])
+            return self.appKeys.get(userName)
+
+    def listAppKeys(self, parameters, userName):
+        apiKey = self.getApiKey(userName)
+        keys = [{"userName": userName, "key": apiKey}] if apiKey is not None else []
+        return 200, {"status": "success", "payload": keys}
+
+    def saveAndGenUserAppKey(self, parameters, userName):
+        with self.lock:
+            self.appKeys[userName] = uuid.uuid4().hex[:16] + ":" + uuid.uuid4().hex
+        return 200, {"status": "success", "message": "Successfully generated a new CC App Key."}
+
+    def findUserForApiKey(self, apiKey):
+        with self.lock:
+            for userName, key in self.appKeys.items():
+                if key == str(apiKey):
+                    return userName
+        return None
+
+    def createJob(self, userName, jobName):
+        with self.lock:
+            jobId = str(self.nextJobId)
+            self.nextJobId += 1
+            self.jobs[jobId] = {"jobId": jobId, "name": str(jobName), "userName": str(userName), "machine": StateMachine("job " + jobId, self.scenario['job']), "outputWritten": False}
+        return jobId
+
+    def writeFinishedJobOutput(self):
+        # Writes the <jobName><jobId>.o and .e files to the home directory of the user once a job has finished, the same place ccq leaves them
+        with self.lock:
+            jobs = [job for job in self.jobs.values() if not job['outputWritten']]
+        for job in jobs:
+            if not job['machine'].finished():
+                continue
+            for extension, content in [(".o", "Output of the job " + job['jobId'] + " from the stand-in.\n"), (".e", "")]:
+                localPath = self.getLocalPath(job['userName'], job['name'] + job['jobId'] + extension)
+                os.makedirs(os.path.dirname(localPath), exist_ok=True)
+                with open(localPath, "w") as f:
+                    f.write(content)
+            job['outputWritten'] = True
+
+    def ccqsub(self, parameters, userName):
+        userName = self.findUserForApiKey(parameters.get("ccAccessKey"))
+        if userName is None:
+            return 200, {"status": "error", "payload": "The CC API key is not valid."}
+        jobId = self.createJob(userName, parameters.get("jobName"))
+        return 200, {"status": "success", "payload": {"message": "The job has been successfully submitted. The job id is: " + jobId}}
+
+    def ccqstat(self, parameters, userName):
+        userName = self.findUserForApiKey(parameters.get("ccAccessKey"))
+        if userName is None:
+            return 200, {"status": "error", "payload": "The CC API key is not valid."}
+        self.writeFinishedJobOutput()
+        jobId = str(parameters.get("jobId"))
+        with self.lock:
+            jobs = [job for job in self.jobs.values() if job['userName'] == userName and (jobId == "all" or job['jobId'] == jobId)]
+        if len(jobs) == 0 and jobId != "all":
+            return 200, {"status": "success", "payload": {"message": "The specified job Id does not exist in the database."}}
+        lines = ["%-10s %-30s %-15s %-15s %s" % ("JOBID", "NAME", "SCHEDULER", "USER", "STATE"), "-" * 80]
+        for job in sorted(jobs, key=lambda job: int(job['jobId'])):
+            lines.append("%-10s %-30s %-15s %-15s %s" % (job['jobId'], job['name'], self.scenario['schedulerName'], job['userName'], job['machine'].current()['state']))
+        return 200, {"status": "success", "payload": {"message": "\n".join(lines) + "\n"}}
+
+    def runCommand(self, channel, userName, command):
+        # Only ccqsub is available on the stand-in Login Instance: ccqsub -js <jobScript> -i <keyFile>
+        startTime = time.time()
+        latency = self.getLatency("ccqsub")
+        stdout, stderr, exitCode = "", "", 0
+        try:
+            if latency > 0:
+                time.sleep(latency)
+            arguments = shlex.split(command)
+            if len(arguments) == 0 or arguments[0] != "ccqsub":
+                stdout, stderr, exitCode = "", str(command) + ": command not found\n", 127
+            else:
+                options = dict(zip(arguments[1::2], arguments[2::2]))
+                jobScriptPath = options.get("-js")
+                keyPath = options.get("-i")
+                apiKey = None
+                if keyPath is not None and os.path.isfile(self.getLocalPath(userName, keyPath)):
+                    with open(self.getLocalPath(userName, keyPath), "r") as f:
+                        apiKey = f.read().strip()
+                if jobScriptPath is None or not os.path.isfile(self.getLocalPath(userName, jobScriptPath)):
+                    stdout, exitCode = "The job script " + str(jobScriptPath) + " does not exist.\n", 1
+                elif apiKey is None or self.findUserForApiKey(apiKey) != userName:
+                    stdout, exitCode = "The CC API key in " + str(keyPath) + " is not valid.\n", 1
+                else:
+                    jobId = self.createJob(userName, posixpath.basename(jobScriptPath))
+                    stdout = "The job has successfully been submitted to the scheduler " + str(self.scenario['schedulerName']) + " and the job id is: " + jobId + " \n"
+        except Exception as e:
+            stdout, stderr, exitCode = "", ''.join(traceback.format_exc()), 1
+        try:
+            channel.sendall(stdout.encode())
+            channel.sendall_stderr(stderr.encode())
+            channel.send_exit_status(exitCode)
+        finally:
+            channel.close()
+        self.recordRequest("ccqsub", exitCode, startTime, latency)
+
+
+def summarizeRequests(requestLog):
+    # Returns {path: {"count": ..., "seconds": ..., "latency": ...}} where seconds is the total time spent answering and latency the injected part of it
+    summary = {}
+    for entry in requestLog:
+        path = summary.setdefault(entry['path'], {"count": 0, "errors": 0, "seconds": 0.0, "latency": 0.0})
+        path['count'] += 1
+        if entry['status'] not in [0, 200]:
+            path['errors'] += 1
+        path['seconds'] += entry['endTime'] - entry['startTime']
+        path['latency'] += entry['latency']
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="A local stand-in for a CloudyCluster Control Node and the Login Instance of its Environments.")
+    parser.add_argument('-H', '--host', help="The address to listen on. The default is 127.0.0.1.", default="127.0.0.1")
+    parser.add_argument('-p', '--port', type=int, help="The port used for HTTPS and SSH. The default is 8443.", default=8443)
+    parser.add_argument('-s', '--scenario', help="A JSON file with the fields of the scenario to change (see defaultScenario).", default=None)
+    parser.add_argument('-d', '--directory', help="The directory for the certificate and the uploaded files. The default is a new temporary directory.", default=None)
+    args = parser.parse_args()
+
+    standIn = ControlStandIn(scenario=loadScenario(args.scenario), host=args.host, port=args.port, directory=args.directory)
+    values = standIn.start()
+    print("The Control Node stand-in is listening on " + str(values['payload']['domainName']) + ".")
+    print("Use it with: export REQUESTS_CA_BUNDLE=" + str(values['payload']['certificatePath']))
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    print("%-40s %-8s %-8s %-10s %s" % ("Route", "Count", "Errors", "Seconds", "Injected"))
+    for path, entry in sorted(summarizeRequests(standIn.getRequestLog()).items()):
+        print("%-40s %-8s %-8s %-10.2f %.2f" % (path, entry['count'], entry['errors'], entry['seconds'], entry['latency']))
+    standIn.stop()
+
+
+if __name__ == "__main__":
+    main()
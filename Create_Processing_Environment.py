@@ -11,10 +11,12 @@ import sys
 import argparse
 import os
 import uuid
+import copy
 import traceback
 import json
 from random import randint
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 #import emailScript as tidings
 import configparser
@@ -24,15 +26,24 @@ sys.path.append(os.path.dirname(os.path.realpath(__file__))+str("/Resources"))
 sys.path.append(os.path.dirname(os.path.realpath(__file__))+str("/Environments"))
 sys.path.append(os.path.dirname(os.path.realpath(__file__))+str("/WorkflowTemplates"))
 sys.path.append(os.path.dirname(os.path.realpath(__file__))+str("/JobScriptTemplates"))
+sys.path.append(os.path.dirname(os.path.realpath(__file__))+str("/Utilities"))
 
 import jobScript
+import jobMonitor
+import jobSubmitter
+import controlPool
+import fanOut
+import httpMetrics
+import stageGraph
+import stateStore
+from environment import processParameters
 
 def main():
     parser = argparse.ArgumentParser(description="A utility that users can utilize to setup and create a CloudyCluster Control Node.")
     parser.add_argument('-V', '--version', action='version', version='ccAutomaton (version 1.0)')
     parser.add_argument('-et', '--environmentType', help="The type of environment to create.", default=None)
     parser.add_argument('-all', action='store_true', help="Run the entire process: create Control Resources, create an Environment, submit the specified jobs, and upon job completion delete the Environment and the Control Resources.", default=None)
-    parser.add_argument('-cf', '--configFilePath', help="The path to the configuration file to be used by ccAutomaton. The default is the ccAutomaton.conf file in the local directory.", default="ccAutomaton.conf")
+    parser.add_argument('-cf', '--configFilePath', nargs='+', help="The path to the configuration file to be used by ccAutomaton. The default is the ccAutomaton.conf file in the local directory. When more than one configuration file is given they are all run at the same time (see -fw and -fo) and every other argument applies to each of them.", default=None)
     parser.add_argument('-cc', action='store_true', help="If specified, this argument tells ccAutomaton to create new Control Resources.", default=None)
     parser.add_argument('-ce', action='store_true', help="If specified, this argument tells ccAutomaton to create a new Environment.", default=None)
     parser.add_argument('-rj', action='store_true', help="If specified, this argument tells ccAutomaton to run the jobs specified in the configuration file.", default=None)
@@ -46,10 +57,95 @@ def main():
     parser.add_argument('-r', '--region', help="The region where the Control Resources are located.", default=None)
     parser.add_argument('-p', '--profile', help="The profile to use for the Resource API.", default=None)
     parser.add_argument('-dff', '--deleteFromFile', action='store_true', help="Deletes your Environment, Control Node, and Control Resources", default=None)
+    parser.add_argument('-fp', '--fillPool', action='store_true', help="Create Control Resources until the Control Resource pool holds controlPoolSize (from the General section) available ones for this configuration.", default=None)
+    parser.add_argument('-sf', '--stateFile', help="The path to the SQLite database that records the resources, stages and jobs of every run. The default is the ccAutomatonState.db file in the local directory.", default=stateStore.defaultPath)
+    parser.add_argument('-fw', '--fanOutWorkers', type=int, help="The maximum number of configuration files that are run at the same time when more than one is given with -cf. The default is 4.", default=4)
+    parser.add_argument('-fo', '--fanOutDirectory', help="The directory where the log of each configuration file and the combined report (report.json) are written when more than one configuration file is given with -cf. The default is fanOut-<timestamp> in the local directory.", default=None)
+    parser.add_argument('-rp', '--reportPath', help="Write the outcome, start time, end time and duration of every stage of the run to this JSON file (the fan-out report is written to the fanOutDirectory instead).", default=None)
+    parser.add_argument('--resume', nargs='?', const="latest", help="Resume the most recent run that did not finish (or the run with the given run ID): the stages that already finished are skipped, interrupted creations are monitored instead of started again and submitted jobs are monitored instead of submitted again.", default=None)
     args = parser.parse_args()
 
+    # Every resource, stage and job of the run is recorded as it changes so a crashed run can be resumed with --resume or cleaned up with -dff
+    try:
+        store = stateStore.StateStore(args.stateFile)
+        # Runs from older versions of ccAutomaton recorded their state in the infoFile
+        store.importInfoFile()
+    except Exception as e:
+        print("Unable to open the run state database " + str(args.stateFile) + ".")
+        print(''.join(traceback.format_exc()))
+        sys.exit(1)
+
+    if args.configFilePath is not None and len(args.configFilePath) > 1:
+        # Each configuration file gets its own pipeline, they run in parallel and share the HTTP sessions, credentials and the run state database
+        values = checkProcessParameters(args.configFilePath)
+        if values['status'] != "success":
+            print(values['payload']['error'])
+            sys.exit(1)
+        runner = fanOut.FanOut(args.configFilePath, lambda configFilePath: runPipeline(args, configFilePath, store), maxWorkers=args.fanOutWorkers, outputDirectory=args.fanOutDirectory)
+        values = runner.run()
+        writeHttpMetrics()
+        if values['status'] != "success":
+            sys.exit(1)
+        sys.exit(0)
+
+    configFilePath = None
+    if args.configFilePath is not None:
+        configFilePath = args.configFilePath[0]
+    values = runPipeline(args, configFilePath, store)
+    if args.reportPath is not None:
+        try:
+            with open(args.reportPath, "w") as f:
+                json.dump(values['payload'], f, indent=4, default=str)
+        except Exception as e:
+            print("Unable to write the report of the run to " + str(args.reportPath) + ".")
+            print(''.join(traceback.format_exc()))
+    writeHttpMetrics()
+    if values['status'] != "success":
+        sys.exit(1)
+    sys.exit(0)
+
+
+def checkProcessParameters(configFilePaths):
+    # The HTTP pool, metrics, poller and cache fields of the General section are applied to the whole process, so when fanning out the configuration files must not give them different values
+    # A field that is only set in some of the files applies to all of them
+    values = {}
+    for configFilePath in configFilePaths:
+        parser = configparser.ConfigParser()
+        try:
+            parser.read(str(configFilePath))
+        except Exception as e:
+            return {"status": "error", "payload": {"error": "There was a problem trying to read the configuration file " + str(configFilePath) + ".", "traceback": ''.join(traceback.format_exc())}}
+        if not parser.has_section("General"):
+            continue
+        for option in processParameters:
+            if parser.has_option("General", option):
+                values.setdefault(option, {})[str(configFilePath)] = str(parser.get("General", option)).strip()
+
+    conflicts = []
+    for option in processParameters:
+        if option not in values:
+            continue
+        if len(set(values[option].values())) > 1:
+            conflicts.append(option + " (" + ", ".join(configFilePath + ": " + value for configFilePath, value in values[option].items()) + ")")
+        elif len(values[option]) < len(configFilePaths):
+            print("The " + option + " field of the General section is only set in " + ", ".join(values[option]) + ", it applies to every configuration file of this run.")
+    if len(conflicts) != 0:
+        return {"status": "error", "payload": {"error": "The configuration files give different values for General section fields that are shared by every configuration file run at the same time: " + "; ".join(conflicts) + ". Use the same values in every file or run the files separately.", "traceback": ''.join(traceback.format_stack())}}
+    return {"status": "success", "payload": values}
+
+
+def writeHttpMetrics():
+    # The latency, status codes, retries and sizes of the REST calls of the whole process (every configuration file) are written once at the end
+    values = httpMetrics.write()
+    if values['status'] != "success":
+        print(values['payload']['error'])
+        print(values['payload']['traceback'])
+    elif len(values['payload']) != 0:
+        print("The HTTP metrics were written to " + " and ".join(values['payload']) + ".")
+
+
+def runPipeline(args, configFilePath, store):
     environmentType = args.environmentType
-    configFilePath = args.configFilePath
     doAll = args.all
     noDelete = args.nd
     createControl = args.cc
@@ -63,6 +159,8 @@ def main():
     controlResourceName = args.controlResourceName
     profile = args.profile
     deleteFromFile = args.deleteFromFile
+    fillPool = args.fillPool
+    resume = args.resume
 
     controlParameters = None
     ccEnvironmentParameters = None
@@ -89,6 +187,27 @@ def main():
         print("Please install the required libraries and try again.")
         sys.exit(1)
 
+    runState = None
+    resumedResources = {}
+    # Where raced Control Resources ended up (see raceControl), read from the run that created them
+    controlPlacement = None
+    if resume is not None:
+        values = store.getRun(None if resume == "latest" else resume, configFilePath)
+        if values['status'] != "success":
+            print(values['payload']['error'])
+            sys.exit(1)
+        runState = values['payload']
+        run = runState.getRun()
+        resumedResources = runState.getResources()
+        print("Resuming the run " + str(runState.runId) + " which was started on " + time.ctime(run['createdAt']) + ".")
+        if environmentType is None:
+            environmentType = run['environmentType']
+        if configFilePath is None:
+            configFilePath = run['configFilePath']
+
+    if configFilePath is None:
+        configFilePath = "ccAutomaton.conf"
+
     if environmentType is None:
         # Check and see if there was an argument passed. If there was then we use that as the environment type
         try:
@@ -204,32 +323,47 @@ def main():
             stagesToRun.append("dc")
         if deleteFromFile:
             stagesToRun.append("dff")
+        if fillPool:
+            stagesToRun.append("fp")
+
+    if runState is not None:
+        # The stages of the interrupted run that already finished are not run again
+        finishedStages = runState.getStages()
+        stagesToRun = [stage for stage in runState.getRun()['stages'] if finishedStages.get(stage) != "success"]
+        print("The stages left to run are: " + str(stagesToRun))
+        if dnsName is None and "controlDNS" in resumedResources and resumedResources["controlDNS"]['status'] not in stateStore.goneStatuses:
+            dnsName = resumedResources["controlDNS"]['value']
+        if controlResourceName is None and "controlResources" in resumedResources and resumedResources["controlResources"]['status'] not in stateStore.goneStatuses:
+            controlResourceName = resumedResources["controlResources"]['value']
+        if "controlPlacement" in resumedResources and resumedResources["controlPlacement"]['status'] not in stateStore.goneStatuses:
+            controlPlacement = json.loads(resumedResources["controlPlacement"]['value'])
+        if "environment" in resumedResources and resumedResources["environment"]['status'] == "created" and args.environmentName is None:
+            environmentName = resumedResources["environment"]['value']
+    else:
+        runState = store.createRun(environmentType, configFilePath, stagesToRun)
+        print("The state of this run is recorded in " + str(store.path) + " under the run ID " + str(runState.runId) + ".")
 
-    # If not creating the Control Resources we need to make sure the DNSName is not None
-    if "cc" not in stagesToRun:
-        # If the dnsName is None check to see if one is specified in the config file
+    # If not creating the Control Resources we need to make sure the DNSName is not None (filling the Control Resource pool does not use an existing Control Node)
+    if "cc" not in stagesToRun and len([stage for stage in stagesToRun if stage != "fp"]) != 0:
+        # If the dnsName is None use the Control Resources of the most recent run or the one specified in the config file
         if dnsName is None:
             try:
-                f = open('infoFile', 'r')
-                lines = list(f)
-                for x in lines:
-                    if "controlDNS=" in x:
-                        print("DNS found in file")
-                        location = x.index('=')
-                        controlDNS = x[location+1:]
-                        dnsName = controlDNS.strip()
-                        break
-                print("dnsName is " + str(dnsName))
-                if "controlDNS=" in x:
-                    print("Success")
+                latest = store.getLatestResource("controlDNS", configFilePath)
+                if latest is not None:
+                    print("DNS found in the run state")
+                    dnsName = latest['value']
+                    values = store.getRun(latest['runId'])
+                    if values['status'] == "success" and values['payload'].getResource("controlPlacement") is not None:
+                        controlPlacement = json.loads(values['payload'].getResource("controlPlacement"))
                 else:
                     dnsName = configurationFileParameters['General']['dnsname']
+                print("dnsName is " + str(dnsName))
             except Exception as e:
                 print("Unable to find the DNS name for the Control Resources to be used to fulfill the request. Please check the configuration file and be sure that there is a dnsname field in the general section or specify the DNS name using the -dn commandline argument and try again.")
                 sys.exit(1)
 
     # Need to create different environment objects depending on what we are running.
-    if "cc" in stagesToRun:
+    if "cc" in stagesToRun or "fp" in stagesToRun:
         # Check and see if the requested environment/cloud type is configured in the conf file
         try:
             controlParameters = configurationFileParameters[str(environmentType) + str(cloudType)]
@@ -309,32 +443,68 @@ def main():
 
     # Instantiate the class with the required parameters
     environment = myClass(**kwargs)
+    environment.runState = runState
+    if controlPlacement is not None and "cc" not in stagesToRun:
+        environment.applyControlPlacement(controlPlacement)
+
+    # With a controlPoolSize in the General section the Control Resources are leased from a pool of warm Control Nodes (cc) and handed back to it (dc) instead of being created and deleted by every run
+    pool = None
+    try:
+        poolSize = int(generalParameters.get("controlpoolsize") or 0)
+    except Exception as e:
+        print("The controlPoolSize field in the General section must be a number.")
+        sys.exit(1)
+    if poolSize > 0:
+        kwargs = {"store": store, "poolKey": environment.getControlPoolKey(), "size": poolSize}
+        if generalParameters.get("controlpoolidletimeout") is not None:
+            kwargs["idleTimeout"] = generalParameters["controlpoolidletimeout"]
+        if generalParameters.get("controlpoolleasetimeout") is not None:
+            kwargs["leaseTimeout"] = generalParameters["controlpoolleasetimeout"]
+        pool = controlPool.ControlPool(**kwargs)
+    elif "fp" in stagesToRun:
+        print("The Control Resource pool is not enabled. Please set the controlPoolSize field in the General section of the configuration file and try again.")
+        sys.exit(1)
     # print parameters defined in the class
     #attrs = vars(environment)
     #print ', '.join("%s: %s" % item for item in attrs.items())
 
-    if "cc" in stagesToRun:
-        if os.path.isfile('infoFile'):
-            os.remove('infoFile')
+    # Every requested stage is added to a dependency graph and started as soon as the stages it depends on have finished. Rendering the Environment template and validating the jobs only need the configuration file and take a moment, so they run first and a bad template or job configuration stops the run before any Control Resources are created.
+    def newControlResourceName():
         if str(cloudType).lower() == "aws":
-            resourceName = str(environment.name) + "ControlResources-" + str(uuid.uuid4())[:4]
+            return str(environment.name) + "ControlResources-" + str(uuid.uuid4())[:4]
         elif str(cloudType).lower() == "gcp":
-            resourceName = str(environment.name) + "-" + str(uuid.uuid4())[:4]
+            return str(environment.name) + "-" + str(uuid.uuid4())[:4]
+
+    def createControlStage():
+        resourceId = None
+        if "controlResources" in resumedResources and resumedResources["controlResources"]['status'] == "creating":
+            # The interrupted run already started creating the Control Resources, pick up the existing Cloud Formation Stack instead of creating a second one
+            resourceName = resumedResources["controlResources"]['value']
+            if "controlStack" in resumedResources:
+                resourceId = resumedResources["controlStack"]['value']
+            elif str(cloudType).lower() == "gcp":
+                # The GCP Control Node is an instance named after the Control Resources, it is looked up by that name
+                resourceId = resourceName
+        else:
+            resourceName = newControlResourceName()
         environment.controlResourceName = resourceName
-        f = open('infoFile', 'w')
-        f.write("controlResources="+str(resourceName)+"\n")
-        f.close()
-
+        environment.recordResource("controlResources", resourceName, "creating")
         # Had to make an alternate path right here for aws and gcp.  The AWS path creates a Cloud Formation Stack using a CFT.  Currently, we don't use anything anagalous to the CFT with GCP, therefore we only need to summon a Control Node.
 
         if str(cloudType).lower() == "aws":
+            kwargs = {"templateLocation": environment.controlParameters['templatelocation'], "resourceName": resourceName, "resourceId": resourceId}
+        elif str(cloudType).lower() == "gcp":
+            #  Just need instance type and image ID for Google Cloud (JCE)
+            kwargs = {"templateLocation": None, "resourceName": resourceName, "resourceId": resourceId}
+
+        if pool is not None:
+            print("Now leasing Control Resources from the pool. If none are available new ones will be created and named: " + str(resourceName))
+            values = environment.acquireControl(pool, runState.runId, **kwargs)
+        elif str(cloudType).lower() == "aws":
             print("Now creating the Control Resources. The Control Resources will be named: " + str(resourceName))
-            kwargs = {"templateLocation": environment.controlParameters['templatelocation'], "resourceName": resourceName}
             values = environment.createControl(**kwargs)
         elif str(cloudType).lower() == "gcp":
-            #  Just need instance type and image ID for Google Cloud (JCE)
             print("Now creating the Control Node for Google Cloud")
-            kwargs = {"templateLocation": None, "resourceName": resourceName}
             values = environment.createControl(**kwargs)
 
         if values['status'] != "success":
@@ -350,19 +520,79 @@ def main():
             #if emailParams:
             #    missive = moosage + "\n\n\n" + "Your Error was:  \n\n" + error + "Your Traceback was:  \n\n" + traceb + "\n\n\n"
             #    response = tidings.main(emailParams['sender'], emailParams['smtp'], emailParams['sendpw'], emailParams['email'], missive)
-            sys.exit(1)
+            return {"status": "error", "payload": values['payload']}
         else:
             print("Finished creating the Control Resources, the new DNS address is: " + values['payload'] + ". You may now log in with the username/password that were provided in the configuration file in the UserInfo section.")
-            f = open('infoFile', 'a')
-            f.write('controlDNS='+str(environment.dnsName)+"\n")
-            f.close()
+            environment.recordResource("controlDNS", environment.dnsName, "created")
+            environment.recordResource("controlResources", environment.controlResourceName, "created")
+            if environment.controlStack is not None:
+                environment.recordResource("controlStack", environment.controlStack, "created")
+            return {"status": "success", "payload": environment.dnsName}
+
+    def fillPoolStage():
+        # Creates the missing Control Resources at the same time, each one with its own copy of the Environment
+        missing = pool.size - pool.countAvailable()
+        if missing <= 0:
+            print("The Control Resource pool already holds " + str(pool.size) + " available Control Resources.")
+            return {"status": "success", "payload": 0}
+        print("Creating " + str(missing) + " Control Resources for the pool.")
+
+        def createPooledControl():
+            poolEnvironment = copy.copy(environment)
+            poolEnvironment.runState = None
+            poolEnvironment.dnsName = None
+            poolEnvironment.controlStack = None
+            poolEnvironment.sessionCookies = None
+            resourceName = newControlResourceName()
+            if str(cloudType).lower() == "aws":
+                templateLocation = environment.controlParameters['templatelocation']
+            else:
+                templateLocation = None
+            values = poolEnvironment.createControl(templateLocation, resourceName)
+            if values['status'] != "success":
+                print("There was an error creating the Control Resources named " + str(resourceName) + " for the pool.")
+                try:
+                    print(values['payload']['error'])
+                except Exception as e:
+                    print(values['payload'])
+                return values
+            pool.add(resourceName, poolEnvironment.dnsName, poolEnvironment.controlStack)
+            print("The Control Resources named " + str(resourceName) + " have been added to the pool.")
+            return values
+
+        with ThreadPoolExecutor(max_workers=missing) as executor:
+            futures = [fanOut.submit(executor, createPooledControl) for x in range(missing)]
+            results = [future.result() for future in futures]
+        failed = [values for values in results if values['status'] != "success"]
+        if len(failed) != 0:
+            return {"status": "error", "payload": failed[0]['payload']}
+        return {"status": "success", "payload": missing}
+
+    def prepareEnvironmentStage():
+        print("Now rendering and validating the Environment template.")
+        values = environment.prepareEnvironmentTemplate()
+        if values['status'] != "success":
+            print("There was an error rendering the Environment template.")
+            try:
+                print(values['payload']['error'])
+            except Exception as e:
+                print(values['payload'])
+            return {"status": "error", "payload": values['payload']}
+        return values
 
-    if "ce" in stagesToRun:
+    def createEnvironmentStage():
+        nonlocal environmentName
         print("Getting session to Control Resource.")
         if environment.sessionCookies is None:
             environment.getSession()
-        print("Now creating the Environment named: " + str(environmentName) + ".")
-        values = environment.createEnvironment()
+        if "environment" in resumedResources and resumedResources["environment"]['status'] == "creating":
+            # The interrupted run already started creating the Environment so we only need to wait for it
+            environment.name = resumedResources["environment"]['value']
+            print("Resuming the monitoring of the creation of the Environment named: " + str(environment.name) + ".")
+            values = environment.monitorEnvironmentCreation()
+        else:
+            print("Now creating the Environment named: " + str(environmentName) + ".")
+            values = environment.createEnvironment()
         print("VALUES ARE")
         print(values)
         if values['status'] != "success":
@@ -378,30 +608,19 @@ def main():
             #if emailParams:
             #    missive = moosage + "\n\n\n" + "Your Error was:  \n\n" + error + "Your Traceback was:  \n\n" + traceb + "\n\n\n"
             #    response = tidings.main(emailParams['sender'], emailParams['smtp'], emailParams['sendpw'], emailParams['email'], missive)
-            sys.exit(1)
+            return {"status": "error", "payload": values['payload']}
         else:
             print("Successfully finished creating the Environment named: " + str(environment.name) + ".")
-            f = open('infoFile', 'a')
-            f.write("envName="+str(environment.name)+"\n")
-            f.close()
+            environment.recordResource("environment", environment.name, "created")
 
         environmentName = environment.name
+        return {"status": "success", "payload": environmentName}
 
-    if "rj" in stagesToRun:
-        print("Getting session to Control Resource.")
-        if environment.sessionCookies is None:
-            environment.getSession()
-
-        if environmentName is None or str(environmentName) == "":
-            print("In order to execute job scripts or workflows on the Environment properly the full Environment name is required. This looks like <environment_name>-XXXX, please specify the full Environment name using the -en commandline argument or by specifying the environmentName field in the General section of the configuration file.")
-            sys.exit(1)
-
-        if "-" not in str(environmentName):
-            print("In order to execute job scripts or workflows on the Environment properly the full Environment name is required. This looks like <environment_name>-XXXX, please specify the full Environment name using the -en commandline argument or by specifying the environmentName field in the General section of the configuration file.")
-            sys.exit(1)
+    preparedJobs = []
 
+    def validateJobsStage():
+        # Parses the jobs from the configuration, checks their options and builds the JobScript and Workflow objects up front so a bad job configuration is found before any resources are created
         jobs = []
-        simultaneous_jobs = []
         for x in range(len(jobList)):
             for jobToRun in jobList[x]:
                 try:
@@ -409,14 +628,13 @@ def main():
                 except json.decoder.JSONDecodeError:
                     print("The configuration of the job or workflow is not in valid format. Please check the format and try again.")
                     print("%s is not valid json." % jobList[x][jobToRun])
-                    sys.exit(1)
+                    return {"status": "error", "payload": {"error": "%s is not valid json." % jobList[x][jobToRun], "traceback": ''.join(traceback.format_stack())}}
 
         for job in jobs:
             name = job[0]
             job = job[1]
 
             if "workflow" in name:
-                print("Running workflow")
                 workflowType = job['type']
 
                 # Create the scheduler object that can be used by the workflows
@@ -429,7 +647,7 @@ def main():
                 except Exception as e:
                     print("Unable to create an instance of the scheduler class for the schedulerType: " + str(job['schedulerType']) + ". Please make sure the schedulerType is specified properly.")
                     print("The traceback is: " + ''.join(traceback.format_exc()))
-                    sys.exit(1)
+                    return {"status": "error", "payload": {"error": "Unable to create an instance of the scheduler class for the workflow " + str(name) + ".", "traceback": ''.join(traceback.format_exc())}}
 
                 # Create CCQ scheduler object if requsted by workflow
                 ccqScheduler = None
@@ -444,7 +662,7 @@ def main():
                     except Exception as e:
                         print("Unable to create an instance of the scheduler class for the schedulerType: " + str(job['options']['schedulerType']) + ". Please make sure the schedulerType is specified properly.")
                         print("The traceback is: " + ''.join(traceback.format_exc()))
-                        sys.exit(1)
+                        return {"status": "error", "payload": {"error": "Unable to create an instance of the ccq scheduler class for the workflow " + str(name) + ".", "traceback": ''.join(traceback.format_exc())}}
 
                 # It is a workflow that we will run via the script in the WorkflowTemplates directory
                 kwargs = {"name": job['name'], "wfType": workflowType, "options": job['options'], "schedulerType": job['options']['schedulerType'], "environment": environment, "scheduler": scheduler, "ccq": ccqScheduler}
@@ -455,10 +673,116 @@ def main():
                 except Exception as e:
                     print("Unable to create an instance of the workflow class for the workflow type: " + str(workflowType) + ". Please make sure the workflowType is specified properly.")
                     print("The traceback is: " + ''.join(traceback.format_exc()))
-                    sys.exit(1)
+                    return {"status": "error", "payload": {"error": "Unable to create an instance of the workflow class for the workflow type: " + str(workflowType) + ".", "traceback": ''.join(traceback.format_exc())}}
+                preparedJobs.append({"name": name, "job": job, "workflow": workflow})
+
+            elif "jobscript" in name:
+                try:
+                    schedulerType = job['options']['schedulerType']
+                    schedulerOptions = ""
+                    if str(schedulerType).lower() not in environment.supportedSchedulers:
+                        for scheduler in environment.supportedSchedulers:
+                            schedulerOptions += str(scheduler)
+                        return {"status": "error", "payload": {"error": "The scheduler type specified is not supported. Please choose one of the following scheduler types: " + str(schedulerOptions)}}
+                except Exception as e:
+                    job['options']['schedulerType'] = "ccq"
+
+                kwargs = {"name": job['name'], "options": job['options'], "schedulerType": job['options']['schedulerType'], "environment": environment}
+                newJobScript = jobScript.JobScript(**kwargs)
+                values = newJobScript.validateJobScriptOptions()
+                if values['status'] != "success":
+                    print("The options of the jobscript: %s are not valid." % job["name"])
+                    return {"status": "error", "payload": values['payload']}
+                preparedJobs.append({"name": name, "job": job, "jobScript": newJobScript})
+
+            else:
+                print("No workflow or jobScript found in conf file")
+                return {"status": "error", "payload": {"error": "No workflow or jobScript found in conf file", "traceback": ''.join(traceback.format_stack())}}
+
+        print("Validated " + str(len(preparedJobs)) + " jobs and workflows.")
+        return {"status": "success", "payload": preparedJobs}
+
+    def runJobsStage():
+        # With adaptiveThroughput in the Control Resource section the Database throughput follows the load of the jobs while they run (see Utilities/throughputManager.py)
+        manager = None
+        if str((environment.controlParameters or {}).get("adaptivethroughput")).lower() == "true":
+            if environment.sessionCookies is None:
+                environment.getSession()
+            values = environment.createThroughputManager()
+            if values['status'] != "success":
+                print("Unable to manage the Database throughput during the run, it will stay as it is.")
+                try:
+                    print(values['payload']['error'])
+                except Exception as e:
+                    print(values['payload'])
+            else:
+                manager = values['payload']
+                manager.start()
+        try:
+            return runJobs(manager)
+        finally:
+            if manager is not None:
+                manager.stop()
+                if manager.getPendingJobs() > 0:
+                    # The capacity is only brought back down as the jobs finish, the ones that were not monitored to the end may still be running
+                    print(str(manager.getPendingJobs()) + " jobs may still be running, the Database throughput is left as it is.")
+                print("Finished managing the Database throughput: " + manager.describe() + ".")
+
+    def runJobs(manager=None):
+        print("Getting session to Control Resource.")
+        if environment.sessionCookies is None:
+            environment.getSession()
+
+        if environmentName is None or str(environmentName) == "":
+            print("In order to execute job scripts or workflows on the Environment properly the full Environment name is required. This looks like <environment_name>-XXXX, please specify the full Environment name using the -en commandline argument or by specifying the environmentName field in the General section of the configuration file.")
+            return {"status": "error", "payload": {"error": "The full Environment name is required to run jobs.", "traceback": ''.join(traceback.format_stack())}}
+
+        if "-" not in str(environmentName):
+            print("In order to execute job scripts or workflows on the Environment properly the full Environment name is required. This looks like <environment_name>-XXXX, please specify the full Environment name using the -en commandline argument or by specifying the environmentName field in the General section of the configuration file.")
+            return {"status": "error", "payload": {"error": "The full Environment name is required to run jobs.", "traceback": ''.join(traceback.format_stack())}}
+
+        # Every job id and job state change is recorded in the run state, on --resume the finished jobs are skipped and the submitted ones are monitored again
+        recordedJobs = runState.getJobs()
+
+        # Each job is counted off the throughput manager once, as soon as it is done or when it was never submitted
+        countedJobs = set()
+        submittedJobs = set()
+        scriptNames = {}
+
+        def jobDone(name):
+            if manager is not None and name not in countedJobs:
+                countedJobs.add(name)
+                manager.jobFinished()
+
+        def trackJob(name):
+            def recordJobState(newJobScript, jobId, jobState):
+                runState.setJob(name, jobName=newJobScript.name, jobId=jobId, schedulerName=newJobScript.schedulerName, state=jobState)
+                submittedJobs.add(name)
+                if jobState in stateStore.finishedJobStates:
+                    jobDone(name)
+            return recordJobState
+
+        if manager is not None:
+            manager.prepareForJobs(len([preparedJob for preparedJob in preparedJobs if not (preparedJob["name"] in recordedJobs and recordedJobs[preparedJob["name"]]['state'] in stateStore.finishedJobStates)]))
+
+        simultaneous_jobs = []
+        resumed_jobs = []
+        for preparedJob in preparedJobs:
+            name = preparedJob["name"]
+            job = preparedJob["job"]
+
+            if name in recordedJobs and recordedJobs[name]['state'] in stateStore.finishedJobStates:
+                print("The %s %s already finished in the %s state, skipping it." % (name, job["name"], recordedJobs[name]['state']))
+                continue
+
+            if "workflow" in name:
+                print("Running workflow")
+                workflow = preparedJob["workflow"]
 
                 values = workflow.run()
                 if values['status'] != "success":
+                    runState.setJob(name, jobName=job["name"], state="Error")
+                    jobDone(name)
                     print("The execution of the workflow %s failed." % name)
                     try:
                         error = values['payload']['error']; print(error)
@@ -474,6 +798,8 @@ def main():
                 else:
                     # The return from the run() method should provide a payload field that provides the arguments for the monitor method
                     values = workflow.monitor(**values['payload'])
+                    runState.setJob(name, jobName=job["name"], state="Completed" if values['status'] == "success" else "Error")
+                    jobDone(name)
                     if values['status'] != "success":
                         print("The execution of the workflow %s failed." % name)
                         try:
@@ -489,23 +815,22 @@ def main():
                         #    response = tidings.main(emailParams['sender'], emailParams['smtp'], emailParams['sendpw'], emailParams['email'], missive)
 
             elif "jobscript" in name:
-                print("Running jobScript")
+                newJobScript = preparedJob["jobScript"]
+                newJobScript.stateCallback = trackJob(name)
+                scriptNames[newJobScript] = name
+                if name in recordedJobs and recordedJobs[name]['jobId'] is not None:
+                    # The job was submitted by the interrupted run so it is only monitored
+                    resumed_jobs.append({"jobScript": newJobScript, "jobId": recordedJobs[name]['jobId'], "schedulerName": recordedJobs[name]['schedulerName'], "timeout": job["options"]["timeout"]})
+                    continue
 
-                try:
-                    schedulerType = job['options']['schedulerType']
-                    schedulerOptions = ""
-                    if str(schedulerType).lower() not in environment.supportedSchedulers:
-                        for scheduler in environment.supportedSchedulers:
-                            schedulerOptions += str(scheduler)
-                        return {"status": "error", "payload": {"error": "The scheduler type specified is not supported. Please choose one of the following scheduler types: " + str(schedulerOptions)}}
-                except Exception as e:
-                    job['options']['schedulerType'] = "ccq"
+                print("Running jobScript")
 
-                jobMonitor = job["options"]["monitorJob"]
-                if "true" in str(jobMonitor).lower():
-                    kwargs = {"name": job['name'], "options": job['options'], "schedulerType": job['options']['schedulerType'], "environment": environment}
-                    newJobScript = jobScript.JobScript(**kwargs)
+                monitorJob = job["options"]["monitorJob"]
+                if "true" in str(monitorJob).lower():
                     values = newJobScript.processJobScript()
+                    if values['status'] == "success" or name not in submittedJobs:
+                        # The job has finished (even if its output could not be downloaded) or it never started
+                        jobDone(name)
                     if "jobId" in values and "environment" in values:
                         print("Your Environment:", values["environment"])
                         print("Your job ID:", values["jobId"])
@@ -527,70 +852,70 @@ def main():
                         #    response = tidings.main(emailParams['sender'], emailParams['smtp'], emailParams['sendpw'], emailParams['email'], missive)
                     else:
                         print("The execution of the jobscript: %s was successful." % job["name"])
-                elif "false" in str(jobMonitor).lower():
-                    simultaneous_jobs.append(job)
-
-            else:
-                print("No workflow or jobScript found in conf file")
-                sys.exit(1)
+                elif "false" in str(monitorJob).lower():
+                    simultaneous_jobs.append(preparedJob)
 
         # at this point simultaneous_jobs is the list of jobs that we submit together
         # so it's time to submit them all
         jobIdDict = {}
         timeoutMax = -1
-        timeElapsed = 0
-        done = 0
-        for job in simultaneous_jobs:
-            kwargs = {"name": job['name'], "options": job['options'], "schedulerType": job['options']['schedulerType'], "environment": environment}
-            newJobScript = jobScript.JobScript(**kwargs)
-            values = newJobScript.processJobScript()
-            jobIdDict[values["jobId"]] = newJobScript
-            if job["options"]["timeout"] == 0:
+        for timeout in [preparedJob["job"]["options"]["timeout"] for preparedJob in simultaneous_jobs] + [resumedJob["timeout"] for resumedJob in resumed_jobs]:
+            if timeout == 0:
                 timeoutMax = 0
-            if timeoutMax and job["options"]["timeout"] > timeoutMax:
-                timeoutMax = job["options"]["timeout"]
-
-        while done < len(simultaneous_jobs):
-            if timeoutMax == 0 or timeoutMax > timeElapsed:
-                timeElapsed += 120
-                time.sleep(120)
-                to_remove = []
-                for jobId in jobIdDict:
-                    values = jobIdDict[jobId].job_state(jobId, environment)
-                    if values["status"] != "success":
-                        print("job_state returned", values)
-                        sys.exit(1)
-                    jobState = values["payload"]["jobState"]
-                    name = values["payload"]["jobName"]
-                    if jobState == "Completed":
-                        values = jobIdDict[jobId].download(jobId, name)
-                        if values["status"] != "success":
-                            print("The job %s encountered an error while downloading" % name)
-                            print(values)
-                        else:
-                            print("%s job is complete." % name)
-                        to_remove.append(jobId)
-                    elif jobState == "Error":
-                        print("%s job in error state." % name)
-                        to_remove.append(jobId)
-                    else:
-                        print("The job %s is in the %s state" % (name, jobState))
-                for jobId in to_remove:
-                    del jobIdDict[jobId]
-                    done += 1
-            else:
-                print("The time limit has been reached at %s seconds" % (timeElapsed))
-                sys.exit(1)
-
-            if done == 1:
-                print("%d job is done." % done)
-            elif done > 1:
-                print("%d jobs are done" % done)
-            else:
-                print("No jobs are done")
+            if timeoutMax and timeout > timeoutMax:
+                timeoutMax = timeout
 
+        if len(resumed_jobs) > 0:
+            submitter = jobSubmitter.JobSubmitter(environment=environment, jobs=[])
+            values = submitter.reattach(resumed_jobs)
+            if values["status"] != "success":
+                try:
+                    print(values["payload"]["error"])
+                except Exception as e:
+                    print(values["payload"])
+                return {"status": "error", "payload": values["payload"]}
+            jobIdDict.update(values["payload"])
+
+        # The simultaneous jobs share one Login Instance lookup, API key and a few SSH connections and are uploaded/submitted in parallel
+        if len(simultaneous_jobs) > 0:
+            kwargs = {"environment": environment, "jobs": [preparedJob["jobScript"] for preparedJob in simultaneous_jobs]}
+            if generalParameters.get("submissionconcurrency") is not None:
+                kwargs["maxWorkers"] = generalParameters["submissionconcurrency"]
+            submitter = jobSubmitter.JobSubmitter(**kwargs)
+            values = submitter.submitAll()
+            for preparedJob in simultaneous_jobs:
+                if preparedJob["name"] not in submittedJobs:
+                    jobDone(preparedJob["name"])
+            if values["status"] != "success":
+                try:
+                    print(values["payload"]["error"])
+                except Exception as e:
+                    print(values["payload"])
+                return {"status": "error", "payload": values["payload"]}
+            jobIdDict.update(values["payload"])
+
+        # Every submitted job is tracked by its own task with its own poll interval so results are downloaded as soon as each job finishes
+        if len(jobIdDict) > 0:
+            kwargs = {"environment": environment, "jobScripts": jobIdDict, "timeout": timeoutMax}
+            if generalParameters.get("jobpollinitialinterval") is not None:
+                kwargs["initialInterval"] = generalParameters["jobpollinitialinterval"]
+            if generalParameters.get("jobpollmaxinterval") is not None:
+                kwargs["maxInterval"] = generalParameters["jobpollmaxinterval"]
+            monitor = jobMonitor.JobMonitor(**kwargs)
+            values = monitor.run()
+            for jobId in monitor.results:
+                # Only the jobs whose state could not be read at all may still be running
+                if not monitor.results[jobId].get('fatal') and monitor.jobScripts[jobId] in scriptNames:
+                    jobDone(scriptNames[monitor.jobScripts[jobId]])
+            if values["status"] != "success":
+                try:
+                    print(values["payload"]["error"])
+                except Exception as e:
+                    print(values["payload"])
+                return {"status": "error", "payload": values["payload"]}
+        return {"status": "success", "payload": jobIdDict}
 
-    if "de" in stagesToRun:
+    def deleteEnvironmentStage():
         print("Getting session to Control Resource.")
         if environment.sessionCookies is None:
             environment.getSession()
@@ -610,16 +935,26 @@ def main():
             #if emailParams:
             #    missive = moosage + "\n\n\n" + "Your Error was:  \n\n" + error + "Your Traceback was:  \n\n" + traceb + "\n\n\n"
             #    response = tidings.main(emailParams['sender'], emailParams['smtp'], emailParams['sendpw'], emailParams['email'], missive)
-            sys.exit(1)
+            return {"status": "error", "payload": values['payload']}
         else:
             print("The Environment named " + str(environment.name) + " have been successfully deleted.")
+            environment.recordResource("environment", environment.name, "deleted")
+            return values
 
-    if "dc" in stagesToRun:
+    def deleteControlStage():
         print("Getting session to Control Resource.")
         if environment.sessionCookies is None:
             environment.getSession()
-        print("Deleting the Control Resources named " + str(environment.controlResourceName) + ".")
-        values = environment.deleteControl()
+        if pool is not None:
+            print("Releasing the Control Resources named " + str(environment.controlResourceName) + ".")
+            values = environment.releaseControl(pool, runState.runId)
+            if values['status'] == "success" and values['released']:
+                for kind in ["controlResources", "controlStack", "controlDNS", "controlPlacement"]:
+                    runState.setResourceStatus(kind, "released")
+                return values
+        else:
+            print("Deleting the Control Resources named " + str(environment.controlResourceName) + ".")
+            values = environment.deleteControl()
         if values['status'] != "success":
             moosage = "There was an issue deleting the Control Resource: " + environment.controlResourceName; print(moosage)
             try:
@@ -634,30 +969,38 @@ def main():
             #    missive = moosage + "\n\n\n" + "Your Error was:  \n\n" + error + "Your Traceback was:  \n\n" + traceb + "\n\n\n"
             #    response = tidings.main(emailParams['sender'], emailParams['smtp'], emailParams['sendpw'], emailParams['email'], missive)
         else:
+            for kind in ["controlResources", "controlStack", "controlDNS", "controlPlacement"]:
+                runState.setResourceStatus(kind, "deleted")
             if str(cloudType).lower() == "aws":
                 print("The Control Resources named " + str(environment.controlResourceName) + " have been successfully deleted.")
             elif str(cloudType).lower() == "gcp":
                 print("The Control Node was successfully deleted.")
+        # A failed Control Resource deletion is reported but does not fail the run
+        return {"status": "success", "payload": values['payload']}
 
-    if "dff" in stagesToRun:
+    def deleteFromFileStage():
+        nonlocal environmentName
         print("Deleting the Environment and Control Resource")
         environment.name = None
-        f = open('infoFile', 'r')
-        lines = list(f)
-        for x in lines:
-            if "controlResources=" in x:
-                location = x.index('=')
-                environment.controlResourceName = x[location+1:].strip()
-                print("controlResourcename is \n"+str(environment.controlResourceName))
-            ### Ask BP about this.
-            # if "controlDNS=" in x:
-            #     location = x.index('=')
-            #     controlDNS = x[location+1:]
-            #     environment.dnsName = controlDNS
-            if "envName=" in x:
-                location = x.index('=')
-                environment.name = x[location+1:].strip()
-                environmentName = environment.name
+        # The resources come from the resumed run or from the most recent run whose Control Resources have not been deleted yet
+        resourceState = runState
+        if len(resumedResources) == 0:
+            latest = store.getLatestResource("controlResources", configFilePath)
+            if latest is None:
+                return {"status": "error", "payload": {"error": "There are no Control Resources recorded in " + str(store.path) + " that still need to be deleted.", "traceback": ''.join(traceback.format_stack())}}
+            values = store.getRun(latest['runId'])
+            if values['status'] != "success":
+                return values
+            resourceState = values['payload']
+        environment.controlResourceName = resourceState.getResource("controlResources")
+        if resourceState.getResource("controlPlacement") is not None:
+            environment.applyControlPlacement(json.loads(resourceState.getResource("controlPlacement")))
+        if args.domainName is None and resourceState.getResource("controlDNS") is not None:
+            environment.dnsName = resourceState.getResource("controlDNS")
+        print("controlResourcename is \n"+str(environment.controlResourceName))
+        if resourceState.getResource("environment") is not None:
+            environment.name = resourceState.getResource("environment")
+            environmentName = environment.name
         if environment.sessionCookies is None:
             environment.getSession()
         print(environment.name)
@@ -677,13 +1020,22 @@ def main():
                 #if emailParams:
                 #    missive = moosage + "\n\n\n" + "Your Error was:  \n\n" + error + "Your Traceback was:  \n\n" + traceb + "\n\n\n"
                 #    response = tidings.main(emailParams['sender'], emailParams['smtp'], emailParams['sendpw'], emailParams['email'], missive)
-                sys.exit(1)
+                return {"status": "error", "payload": values['payload']}
             else:
                 print("The Environment named " + str(environmentName) + " have been successfully deleted.")
+                resourceState.setResourceStatus("environment", "deleted")
 
         if environment.controlResourceName:
-            print("Deleting the Control Resources named " + str(environment.controlResourceName) + ".")
-            values = environment.deleteControl()
+            if pool is not None:
+                print("Releasing the Control Resources named " + str(environment.controlResourceName) + ".")
+                values = environment.releaseControl(pool, resourceState.runId)
+                if values['status'] == "success" and values['released']:
+                    for kind in ["controlResources", "controlStack", "controlDNS", "controlPlacement"]:
+                        resourceState.setResourceStatus(kind, "released")
+                    return {"status": "success", "payload": "The Environment has been deleted and the Control Resources have been returned to the pool."}
+            else:
+                print("Deleting the Control Resources named " + str(environment.controlResourceName) + ".")
+                values = environment.deleteControl()
             if values['status'] != "success":
                 moosage = "There was an issue deleting the control resources named: " + str(environment.controlResourceName)
                 try:
@@ -699,8 +1051,58 @@ def main():
                 #    response = tidings.main(emailParams['sender'], emailParams['smtp'], emailParams['sendpw'], emailParams['email'], missive)
             else:
                 print("The Control Resources named " + str(environment.controlResourceName) + " have been successfully deleted.")
+                for kind in ["controlResources", "controlStack", "controlDNS", "controlPlacement"]:
+                    resourceState.setResourceStatus(kind, "deleted")
+        return {"status": "success", "payload": "The Environment and Control Resources in the run state have been deleted."}
 
-    sys.exit(0)
+    graph = stageGraph.StageGraph(maxWorkers=3, stageCallback=runState.setStage)
+    if "cc" in stagesToRun:
+        graph.addStage("cc", createControlStage, dependsOn=["vt", "vj"], description="create Control Resources")
+    if "ce" in stagesToRun:
+        graph.addStage("vt", prepareEnvironmentStage, description="render Environment template")
+        graph.addStage("ce", createEnvironmentStage, dependsOn=["cc", "vt"], description="create Environment")
+    if "rj" in stagesToRun:
+        graph.addStage("vj", validateJobsStage, description="validate jobs")
+        graph.addStage("rj", runJobsStage, dependsOn=["cc", "ce", "vj"], description="run jobs")
+    if "de" in stagesToRun:
+        graph.addStage("de", deleteEnvironmentStage, dependsOn=["cc", "ce", "rj"], description="delete Environment")
+    if "dc" in stagesToRun:
+        graph.addStage("dc", deleteControlStage, dependsOn=["cc", "ce", "rj", "de"], description="delete Control Resources")
+    if "fp" in stagesToRun:
+        graph.addStage("fp", fillPoolStage, description="fill Control Resource pool")
+    if "dff" in stagesToRun:
+        graph.addStage("dff", deleteFromFileStage, dependsOn=["cc", "ce", "rj", "de", "dc"], description="delete from run state")
+
+    values = graph.run()
+    graph.printSummary()
+
+    # The candidate Control Resources that lost a race are torn down in the background, the run is only over once they are gone
+    raceValues = environment.finishControlRaces()
+    if raceValues['status'] != "success":
+        try:
+            print(raceValues['payload']['error'])
+        except Exception as e:
+            print(raceValues['payload'])
+
+    # Returned to main (or to the fan-out report) with the outcome of every stage
+    report = {"runId": runState.runId, "stages": {}}
+    for name in graph.order:
+        stage = graph.stages[name]
+        report['stages'][name] = {"status": stage.status, "seconds": None, "startTime": stage.startTime, "endTime": stage.endTime}
+        if stage.startTime is not None and stage.endTime is not None:
+            report['stages'][name]['seconds'] = int(stage.endTime - stage.startTime)
+
+    if values['status'] != "success":
+        runState.finish("error")
+        print("The " + str(values['stage']) + " stage failed, stopping. The run can be resumed using: --resume " + str(runState.runId))
+        report['failedStage'] = values['stage']
+        try:
+            report['error'] = values['payload']['error']
+        except Exception as e:
+            report['error'] = str(values['payload'])
+        return {"status": "error", "payload": report}
+    runState.finish("success")
+    return {"status": "success", "payload": report}
 
 
 main()
@@ -11,17 +11,40 @@ import os
 import time
 import traceback
 import sys
-import requests
 import ast
 import json
 from requests import ConnectionError
 from environment import Environment
 import csv
-from random import randint
+import copy
+import threading
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 
 sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
 sys.path.append(os.path.join(os.path.dirname(__file__), '../Resources'))
 sys.path.append(os.path.join(os.path.dirname(__file__), '../EnvironmentTemplates'))
+sys.path.append(os.path.join(os.path.dirname(__file__), '../Utilities'))
+
+import httpSessions
+import poller
+import probes
+import apiKeyCache
+import sessionCache
+import topologyCache
+import fanOut
+import responseModels
+import throughputManager
+
+# The instance groups whose states are checked when pausing, resuming or checking an Environment
+stateGroups = (("VPC Info", "Network"), ("Utility", "Utility"))
+
+
+def readCsvItems(csvFileName):
+    # Yields one item per CSV row, leaving out the empty fields
+    with open(csvFileName) as csvFile:
+        reader = csv.DictReader(csvFile)
+        for row in reader:
+            yield dict((item, row[item]) for item in row if row[item] != "")
 
 
 class CloudyCluster(Environment):
@@ -30,9 +53,22 @@ class CloudyCluster(Environment):
         self.supportedSchedulers = ["ccq", "torque", "slurm"]
         super(CloudyCluster, self).__init__(**kwargs)
 
-    def getSession(self):
+        # Rendered Environment template, filled in by prepareEnvironmentTemplate
+        self.preparedTemplate = None
+
+        # Control Resource races whose losing candidates may still be tearing down (see raceControl), the list is shared with the copies of the Environment so the run waits for all of them
+        self.controlRaces = []
+
+    def getSession(self, useCache=True):
+        if useCache:
+            # A session saved by an earlier invocation saves the login round trip, if it has expired since then the first request that needs it logs in again (see controlRequest)
+            sessionCookies = sessionCache.load(self.dnsName, self.userName)
+            if sessionCookies is not None:
+                self.sessionCookies = sessionCookies
+                httpSessions.setCookies(self.dnsName, sessionCookies)
+                return {"status": "success", "payload": sessionCookies}
         try:
-            results = requests.post("https://" + str(self.dnsName) + "/srv/cloudyLogin", json={'userName': str(self.userName), 'password': str(self.password)})
+            results = self.getHttpSession().post("https://" + str(self.dnsName) + "/srv/cloudyLogin", json={'userName': str(self.userName), 'password': str(self.password)})
 
             if "Incorrect User / Password Combination" in str(results.content) or "You have too many failed login attempts" in str(results.content):
                 return {"status": "error", "payload": {"error": str(json.loads(results.content)['message']), "traceback": ''.join(traceback.format_stack())}}
@@ -41,6 +77,9 @@ class CloudyCluster(Environment):
 
             sessionCookies = results.cookies
             self.sessionCookies = sessionCookies
+            # Keep the cookies on the pooled Control Node session as well so every later request carries them
+            httpSessions.setCookies(self.dnsName, sessionCookies)
+            sessionCache.save(self.dnsName, self.userName, sessionCookies)
             return {"status": "success", "payload": sessionCookies}
 
         except ConnectionError as e:
@@ -48,11 +87,18 @@ class CloudyCluster(Environment):
         except Exception as e:
             return {"status": "error", "payload": {"error": "There was an error when trying to create the session.", "traceback": ''.join(traceback.format_exc(e))}}
 
-    def validateControl(self, resourceClass, instance):
+    def sessionExpired(self, response):
+        # The Control Node answers requests made with an expired session with its login prompt instead of an error status
+        return response.status_code == 401 or "Please Login" in str(response.content)
+
+    def validateControl(self, resourceClass, instance, startupKey=None, resourceId=None):
         try:
-            correct_key = resourceClass.getStartupKey(instance, self.controlParameters)["payload"]
+            if startupKey is None:
+                correct_key = resourceClass.getStartupKey(instance, self.controlParameters, resourceId=resourceId)["payload"]
+            else:
+                correct_key = startupKey
             url = "https://"+self.dnsName+"/srv/validateInstance"
-            r = requests.post(url, json = {"key": correct_key})
+            r = self.getHttpSession().post(url, json = {"key": correct_key})
             jar = r.cookies
             values = json.loads(r.text)
             if "error" in values:
@@ -61,13 +107,13 @@ class CloudyCluster(Environment):
             ######################################
             url = "https://"+self.dnsName+"/srv/cloudySave"
             specialObj = {'lastName': self.lastName, 'firstName': self.firstName, 'password': self.password, 'userName': self.userName, 'inviteKey': inviteKey}
-            r = requests.post(url, cookies=jar, json=specialObj)
+            r = self.getHttpSession().post(url, cookies=jar, json=specialObj)
             values = json.loads(r.text)
             if values['status'] != 'success':
                 return {'status': values['status'], 'payload': {"error": values['message'], "traceback": ''.join(traceback.format_stack())}}
             ######################################
             url = "https://"+self.dnsName+"/srv/getValididatorObj"
-            r = requests.get(url, cookies=jar)
+            r = self.getHttpSession().get(url, cookies=jar)
             values = json.loads(r.text)
             if values["status"] != "success":
                 return {'status': values['status'], 'payload': {"error": values['message'], "traceback": ''.join(traceback.format_stack())}}
@@ -77,7 +123,196 @@ class CloudyCluster(Environment):
         except Exception as e:
             return {"status": "error", "payload": {"error": "There was an error trying to validate the Control Instance.", "traceback": ''.join(traceback.format_exc())}}
 
-    def createControl(self, templateLocation, resourceName):
+    def getControlCandidates(self):
+        # The optional controlCandidates field lists the other places the Control Resources can be created in, in order of preference. Each entry holds the fields of the section that differ from it (ex: [{'region': 'us-west-2', 'vpc': 'vpc-xxxxxxxx', 'publicSubnet': 'subnet-xxxxxxxx', 'imageId': 'ami-xxxxxxxx'}, {'profile': 'otherAccount'}] or [{'zone': 'us-east1-c'}]).
+        value = (self.controlParameters or {}).get("controlcandidates")
+        if value is None or str(value).strip() == "":
+            return []
+        candidates = ast.literal_eval(str(value))
+        return [dict((str(name).lower(), candidateValue) for name, candidateValue in candidate.items()) for candidate in candidates]
+
+    def createControl(self, templateLocation, resourceName, resourceId=None):
+        # With controlCandidates the Control Resources are raced in several regions/zones/profiles (see raceControl). An interrupted creation that is being resumed only ever has the one Cloud Formation Stack.
+        try:
+            candidates = self.getControlCandidates()
+        except Exception as e:
+            return {"status": "error", "payload": {"error": "The controlCandidates field must be a list of dictionaries holding the fields to change for each candidate (ex: [{'region': 'us-west-2'}, {'zone': 'us-east1-c'}]).", "traceback": ''.join(traceback.format_exc())}}
+        if resourceId is None and len(candidates) != 0:
+            return self.raceControl(templateLocation, resourceName, candidates)
+        return self.createSingleControl(templateLocation, resourceName, resourceId)
+
+    def raceControl(self, templateLocation, resourceName, candidates):
+        # The section itself is the first candidate and the controlCandidates follow it. They are created at the same time (or controlCandidateStagger seconds apart, the later ones are only started while nobody has won yet) and the first one that is healthy is kept.
+        # The other candidates are torn down as soon as they finish, that happens in the background so the run carries on with the winner right away (see finishControlRaces). Every started candidate is recorded in the run state as controlCandidate<index> so a crashed run still knows about it.
+        try:
+            stagger = max(0.0, float(self.controlParameters.get("controlcandidatestagger") or 0))
+        except Exception as e:
+            return {"status": "error", "payload": {"error": "The controlCandidateStagger field must be a number of seconds.", "traceback": ''.join(traceback.format_exc())}}
+
+        # The Environment is created in the region of the Control Node, a candidate in another region says which Availability Zone of its region the Environment should use
+        if self.ccEnvironmentParameters is not None:
+            environmentRegion = self.ccEnvironmentParameters.get("region")
+            for overrides in candidates:
+                if "region" in overrides and str(overrides['region']) != str(environmentRegion) and overrides.get("environmentaz") is None:
+                    return {"status": "error", "payload": {"error": "The Environment is created in " + str(environmentRegion) + " (see the " + str(self.environmentType) + "Environment section) but the candidate Control Resources " + str(overrides) + " are in " + str(overrides['region']) + ". Add the Availability Zone the Environment should use in that region to the candidate as environmentAz (ex: {'region': 'us-west-2', 'environmentAz': 'us-west-2a', ...}).", "traceback": ''.join(traceback.format_stack())}}
+
+        # The winner's placement is applied on top of the region, profile and parameters the run was configured with, every race starts from those
+        if getattr(self, "controlOrigin", None) is None:
+            self.controlOrigin = {"region": self.region, "profile": self.profile, "controlParameters": self.controlParameters, "ccEnvironmentParameters": self.ccEnvironmentParameters}
+        origin = self.controlOrigin
+
+        environments = []
+        for index, overrides in enumerate([{}] + candidates):
+            candidate = copy.copy(self)
+            candidate.runState = None
+            candidate.dnsName = None
+            candidate.controlStack = None
+            candidate.sessionCookies = None
+            candidate.sessionLock = threading.Lock()
+            candidate.controlParameters = dict(origin['controlParameters'])
+            candidate.controlParameters.pop("controlcandidates", None)
+            candidate.controlParameters.update((name, value) for name, value in overrides.items() if name != "environmentaz")
+            candidate.region = overrides.get("region", origin['region'])
+            candidate.profile = overrides.get("profile", origin['profile'])
+            candidate.controlResourceName = resourceName if index == 0 else str(resourceName) + "-" + str(index)
+            candidate.candidateIndex = index
+            candidate.candidateOverrides = overrides
+            environments.append(candidate)
+
+        won = threading.Event()
+        lock = threading.Lock()
+        race = {"winner": None}
+
+        def describe(candidate):
+            where = candidate.controlParameters.get("zone") or candidate.controlParameters.get("az") or candidate.region
+            return str(candidate.controlResourceName) + " (" + str(where) + (", profile " + str(candidate.profile) if candidate.profile is not None else "") + ")"
+
+        def runCandidate(index, candidate):
+            if index != 0 and won.wait(index * stagger):
+                return {"status": "error", "payload": {"error": "Not started because the Control Resources " + describe(race['winner']) + " were ready first.", "traceback": ""}, "started": False}
+            print("Creating the candidate Control Resources " + describe(candidate) + ".")
+            self.recordControlCandidate(candidate, "creating")
+            values = candidate.createSingleControl(templateLocation, candidate.controlResourceName)
+            with lock:
+                isWinner = values['status'] == "success" and race['winner'] is None
+                if isWinner:
+                    race['winner'] = candidate
+                    won.set()
+            if isWinner:
+                self.recordControlCandidate(candidate, "created")
+            else:
+                values['teardown'] = self.discardControl(candidate, values, describe(candidate))
+            return values
+
+        startTime = time.monotonic()
+        executor = ThreadPoolExecutor(max_workers=len(environments))
+        futures = [fanOut.submit(executor, runCandidate, index, candidate) for index, candidate in enumerate(environments)]
+        pending = set(futures)
+        while not won.is_set() and len(pending) != 0:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        # The losing candidates keep running until they have been torn down, the run waits for them and reports how the teardown went before it exits (see finishControlRaces)
+        executor.shutdown(wait=False)
+
+        winner = race['winner']
+        if winner is None:
+            errors = []
+            for candidate, future in zip(environments, futures):
+                try:
+                    errors.append(describe(candidate) + ": " + str(future.result()['payload']['error']))
+                except Exception as e:
+                    errors.append(describe(candidate) + ": " + str(future.result().get("payload")))
+            return {"status": "error", "payload": {"error": "None of the " + str(len(environments)) + " candidate Control Resources could be created. " + " ".join(errors), "traceback": ''.join(traceback.format_stack())}}
+
+        self.controlRaces.append({"executor": executor, "candidates": [(candidate, future, describe(candidate)) for candidate, future in zip(environments, futures) if candidate is not winner]})
+        print("The candidate Control Resources " + describe(winner) + " were ready first after " + str(int(time.monotonic() - startTime)) + " seconds, the other candidates will be torn down.")
+        self.controlResourceName = winner.controlResourceName
+        self.dnsName = winner.dnsName
+        self.controlStack = winner.controlStack
+        self.sessionCookies = winner.sessionCookies
+        placement = {"region": winner.region, "profile": winner.profile, "controlParameters": dict((name, value) for name, value in winner.candidateOverrides.items() if name not in ["region", "profile", "environmentaz"]), "environmentAz": winner.candidateOverrides.get("environmentaz")}
+        self.region, self.profile, self.controlParameters, self.ccEnvironmentParameters = origin['region'], origin['profile'], origin['controlParameters'], origin['ccEnvironmentParameters']
+        self.applyControlPlacement(placement)
+        # Runs that use these Control Resources without creating them (ex: -dc on its own) follow the recorded placement
+        self.recordResource("controlPlacement", json.dumps(placement), "created")
+        return {"status": "success", "payload": self.dnsName}
+
+    def applyControlPlacement(self, placement):
+        # placement is recorded by raceControl: the region, profile and Control parameters of the candidate that won and, when it is in another region than the Environment, the Availability Zone the Environment should use there
+        self.region = placement.get("region", self.region)
+        self.profile = placement.get("profile", self.profile)
+        if self.controlParameters is not None:
+            self.controlParameters = dict(self.controlParameters, **placement.get("controlParameters", {}))
+        if self.ccEnvironmentParameters is not None and placement.get("environmentAz") is not None and str(self.ccEnvironmentParameters.get("region")) != str(self.region):
+            print("The Control Resources are in " + str(self.region) + ", the Environment will be created in " + str(placement['environmentAz']) + ".")
+            self.ccEnvironmentParameters = dict(self.ccEnvironmentParameters, region=self.region, az=placement['environmentAz'])
+            # The template was rendered with the configured region (see prepareEnvironmentTemplate)
+            self.preparedTemplate = None
+        return {"status": "success", "payload": placement}
+
+    def recordControlCandidate(self, candidate, status):
+        # Everything needed to tear the candidate down by hand: its name, Cloud Formation Stack (AWS), region, profile and the fields it changed
+        value = {"controlResourceName": candidate.controlResourceName, "controlStack": candidate.controlStack, "region": candidate.region, "profile": candidate.profile, "overrides": candidate.candidateOverrides}
+        self.recordResource("controlCandidate" + str(candidate.candidateIndex), json.dumps(value, default=str), status)
+
+    def discardControl(self, candidate, values, description):
+        # Tears down a candidate that lost the race (see raceControl): a healthy one is deleted like any other Control Node, a failed one only has its cloud resources removed
+        # Returns None when there was nothing to tear down, otherwise the result of the teardown
+        try:
+            if values.get("started") is False:
+                return None
+            if values['status'] == "success":
+                print("Deleting the candidate Control Resources " + description + ", another candidate was ready first.")
+                result = candidate.deleteControl()
+            else:
+                print("The candidate Control Resources " + description + " could not be created, removing what was created of them.")
+                try:
+                    print(values['payload']['error'])
+                except Exception as e:
+                    print(values.get("payload"))
+                result = candidate.createResourceClass(candidate.region, candidate.profile)
+                if result['status'] == "success":
+                    resourceClass = result['payload']
+                    if str(self.cloudType).lower() == "aws" and candidate.controlStack is not None:
+                        result = resourceClass.deleteControlResources(candidate.controlStack)
+                    elif str(self.cloudType).lower() == "gcp":
+                        result = resourceClass.deleteControlResources(candidate.controlResourceName, candidate.controlParameters)
+            if result['status'] != "success":
+                print("Unable to tear down the candidate Control Resources " + description + ", they will need to be deleted by hand.")
+                print(result['payload'])
+                return result
+            self.recordControlCandidate(candidate, "deleted")
+            return result
+        except Exception as e:
+            print("Unable to tear down the candidate Control Resources " + description + ", they will need to be deleted by hand.")
+            print(''.join(traceback.format_exc()))
+            return {"status": "error", "payload": {"error": "Unable to tear down the candidate Control Resources " + description + ".", "traceback": ''.join(traceback.format_exc())}}
+
+    def finishControlRaces(self):
+        # Waits for the candidates that lost a race to be torn down and reports how each teardown went, called once at the end of the run
+        failed = []
+        while len(self.controlRaces) != 0:
+            race = self.controlRaces.pop(0)
+            if not all(future.done() for candidate, future, description in race['candidates']):
+                print("Waiting for the candidate Control Resources that were not kept to be torn down.")
+            race['executor'].shutdown(wait=True)
+            for candidate, future, description in race['candidates']:
+                try:
+                    teardown = future.result().get("teardown")
+                except Exception as e:
+                    teardown = {"status": "error", "payload": {"error": ''.join(traceback.format_exc())}}
+                if teardown is None:
+                    print("The candidate Control Resources " + description + " were not started.")
+                elif teardown['status'] == "success":
+                    print("The candidate Control Resources " + description + " have been torn down.")
+                else:
+                    print("The candidate Control Resources " + description + " could not be torn down and need to be deleted by hand.")
+                    failed.append(description)
+        if len(failed) != 0:
+            return {"status": "error", "payload": {"error": "The candidate Control Resources " + ", ".join(failed) + " could not be torn down and need to be deleted by hand.", "traceback": ''.join(traceback.format_stack())}}
+        return {"status": "success", "payload": None}
+
+    def createSingleControl(self, templateLocation, resourceName, resourceId=None):
+        # resourceId identifies the Control Resources of an earlier run whose creation was interrupted (the Cloud Formation Stack Id on AWS, the instance name on GCP), in that case the existing resources are monitored instead of creating new ones
         resourceClass = None
         try:
             values = self.createResourceClass(self.region, self.profile)
@@ -88,8 +323,17 @@ class CloudyCluster(Environment):
         except Exception as e:
             return {"status": "error", "payload": {"error": "There was a problem parsing the configuration file for the required variables.", "traceback": ''.join(traceback.format_exc())}}
 
-        kwargs = {"templateLocation": str(templateLocation), "resourceName": str(resourceName), "options": self.controlParameters}
-        values = resourceClass.createControlResources(**kwargs)
+        if resourceId is not None and str(self.cloudType).lower() == "aws":
+            print("Resuming the creation of the Control Resources with the Cloud Formation Stack Id: " + str(resourceId))
+            # The Stack was created by the interrupted run so the resource class has to be told about it
+            resourceClass.stackId = str(resourceId)
+            values = {"status": "success", "payload": resourceId}
+        elif resourceId is not None and str(self.cloudType).lower() == "gcp":
+            print("Resuming the creation of the Control Node named: " + str(resourceId))
+            values = resourceClass.resumeControlResources(str(resourceId), self.controlParameters)
+        else:
+            kwargs = {"templateLocation": str(templateLocation), "resourceName": str(resourceName), "options": self.controlParameters}
+            values = resourceClass.createControlResources(**kwargs)
         if values['status'] != "success":
             return {"status": "error", "payload": values['payload']}
         else:
@@ -99,10 +343,9 @@ class CloudyCluster(Environment):
                 instance = values["instance"]
             else:
                 instance = resourceName
-            if str(self.cloudType) == "aws":
-                f = open('infoFile', 'w')
-                f.write("controlResources="+str(resourceId)+"\n")
-                f.close()
+            if str(self.cloudType).lower() == "aws":
+                self.controlStack = resourceId
+                self.recordResource("controlStack", resourceId, "creating")
             if str(self.cloudType).lower() == "aws":
                 print("The newly created Cloud Formation Stack Id is: " + str(resourceId))
                 values = resourceClass.monitorControlResources(resourceId, "creation")
@@ -119,71 +362,53 @@ class CloudyCluster(Environment):
                 if values['status'] != "success":
                     return {"status": "error", "payload": values['payload']}
                 else:
-                    print("Successfully retrieved the new IP address of the Control Resources. Now obtaining the newly assigned DNS name for the Control Resources. The Control Node IP Address is: " + str(values['payload']) + ".")
+                    print("Successfully retrieved the new IP address of the Control Resources. The Control Node IP Address is: " + str(values['payload']) + ". Now waiting for the Control Node to be ready.")
                     ipAddress = values['payload']
-                    maxTimeToWait = 600
-                    timeElapsed = 0
-                    timeToWait = 60
-                    done = False
-                    values = None
-                    while not done:
-                        values = self.getControlDns(ipAddress)
-                        if values['status'] != "success":
-                            if maxTimeToWait < timeElapsed:
-                                done = True
-                            time.sleep(timeToWait)
-                            timeElapsed += timeToWait
-                        else:
-                            done = True
+                    values = self.waitForControlReady(resourceClass, ipAddress, instance, resourceId)
+                    if values['status'] != "success":
+                        return {"status": "error", "payload": values['payload']}
+                    print("Successfully retrieved the new DNS name (" + str(self.dnsName) + ") and the newly created Database Table names.")
+                    stuff = self.validateControl(resourceClass, instance, values['payload']['startupKey'], resourceId)
+                    if stuff["status"] != "success":
+                        if "File failed to validate" in str(stuff['payload']['error']):
+                            return {"status": "error", "payload": {"error": "The .pem key file location specified in the configuration file does not match the .pem key file used to launch the instances. Please check the key and try again.", "traceback": ''.join(traceback.format_stack())}}
+                        return {"status": "error", "payload": stuff["payload"]}
+                    values = self.getSession()
                     if values['status'] != "success":
                         return {"status": "error", "payload": values['payload']}
-                    else:
-                        print("Successfully retrieved the new DNS name for the Control Resources. The new DNS name is: " + str(self.dnsName))
-                        print("Now obtaining the newly created Database Table names.")
-                        values = self.getDatabaseTableNames()
-                        if values['status'] != "success":
-                            print(values)
-                            return {"status": "error", "payload": values['payload']}
-                        else:
-                            print("Successfully obtained the newly created Database Table names.")
-                            stuff = self.validateControl(resourceClass, instance)
-                            if stuff["status"] != "success":
-                                if "File failed to validate" in str(stuff['payload']['error']):
-                                    return {"status": "error", "payload": {"error": "The .pem key file location specified in the configuration file does not match the .pem key file used to launch the instances. Please check the key and try again.", "traceback": ''.join(traceback.format_stack())}}
-                                return {"status": "error", "payload": stuff["payload"]}
-                            else:
-                                values = self.getSession()
-                                if values['status'] != "success":
-                                    return {"status": "error", "payload": values['payload']}
-                                else:
-                                    time.sleep(randint(0, 180))
-                                    try:
-                                        self.controlParameters['readcapacity']
-                                        self.controlParameters['writecapacity']
-                                        values = self.modifyDBThroughput(self.controlParameters['readcapacity'], self.controlParameters['writecapacity'])
-                                        if values['status'] != "success":
-                                            return {"status": "error", "payload": values['payload']}
-                                        else:
-                                            print("Successfully modified the Database throughput to the values requested in the configuration file.")
-                                    except Exception as e:
-                                        # The user did not specify any modifications to the DB Throughput so we just leave it as the default.
-                                        pass
-
-                                    values = self.genApiKey()
-                                    if values['status'] != "success":
-                                        return {"status": "error", "payload": values['payload']}
-                                    else:
-                                        print("Successfully generated a new API Key for the user. Now writing out a few last configuration details.")
-                                        values = self.writeOutEfsObjectToDb()
-                                        if values['status'] != "success":
-                                            return {"status": "error", "payload": values['payload']}
-                                        else:
-                                            print("Successfully wrote out the last few configuration details.")
-                                            print("\n")
-                                            return {"status": "success", "payload": self.dnsName}
 
-    def createEnvironment(self):
-        # Here we will need to get the Template class for CloudyCluster and try and retrieve the template variables
+                    # The Database throughput and the new API key do not depend on each other so they are set up at the same time, each call retries on its own
+                    setupSet = probes.ProbeSet("controlSetup", timeout=600)
+                    if self.controlParameters.get('readcapacity') is not None and self.controlParameters.get('writecapacity') is not None:
+                        setupSet.add("throughput", lambda: self.modifyDBThroughput(self.controlParameters['readcapacity'], self.controlParameters['writecapacity']), attempts=1)
+                    setupSet.add("apiKey", self.genApiKey, attempts=1)
+                    setupSet.add("efs", self.writeOutEfsObjectToDb, dependsOn=["apiKey"], attempts=1)
+                    values = setupSet.run()
+                    if values['status'] != "success":
+                        return {"status": "error", "payload": values['payload']}
+                    if "throughput" in values['payload']:
+                        print("Successfully modified the Database throughput to the values requested in the configuration file.")
+                    print("Successfully generated a new API Key for the user and wrote out the last few configuration details.")
+                    print("\n")
+                    return {"status": "success", "payload": self.dnsName}
+
+    def waitForControlReady(self, resourceClass, ipAddress, instance, resourceId=None):
+        # Instead of waiting out fixed sleeps the prerequisites of the Control Node validation are checked at the same time and each one is done as soon as it passes:
+        #     dns        - the Control Node reports its new DNS name
+        #     tables     - the Control Node reports the names of its newly created Database Tables
+        #     startupKey - the startup key has been written to the instance tags/metadata (does not need the Control Node at all)
+        readySet = probes.ProbeSet("controlReadiness", timeout=600, maxInterval=15)
+        readySet.add("dns", lambda: self.getControlDns(ipAddress))
+        readySet.add("tables", self.requestDatabaseTableNames, dependsOn=["dns"])
+        readySet.add("startupKey", lambda: resourceClass.getStartupKey(instance, self.controlParameters, wait=False, resourceId=resourceId))
+        values = readySet.run()
+        if values['status'] != "success":
+            return values
+        print("The Control Node is ready (" + ", ".join(name + ": " + str(seconds) + "s" for name, seconds in values['seconds'].items()) + ").")
+        return {"status": "success", "payload": values['payload']}
+
+    def prepareEnvironmentTemplate(self):
+        # Renders and validates the Environment template. This only needs the configuration file so it can run while the Control Resources are still being created.
         try:
             kwargs = {"environmentType": self.environmentType, "parameters": self.ccEnvironmentParameters, "templateName": self.ccEnvironmentParameters['templatename']}
         except Exception as e:
@@ -206,23 +431,37 @@ class CloudyCluster(Environment):
             if values['status'] != "success":
                 return {"status": "error", "payload": values['payload']}
             else:
-                # This is the ClusterObject that we need to pass to the /CloudyCluster/Base route
-                template = values['payload']['template']
-                self.name = values['payload']['environmentName']
-                print("The new full Environment name is: " + str(self.name))
-                values = self.saveEnvironmentConfig(template)
+                # The new full name is only applied in createEnvironment, the Control Resource name is still built from the short name
+                self.preparedTemplate = {"template": values['payload']['template'], "environmentName": values['payload']['environmentName']}
+                return {"status": "success", "payload": self.preparedTemplate}
+
+    def createEnvironment(self):
+        # Here we will need to get the Template class for CloudyCluster and try and retrieve the template variables
+        if self.preparedTemplate is None:
+            values = self.prepareEnvironmentTemplate()
+            if values['status'] != "success":
+                return {"status": "error", "payload": values['payload']}
+
+        # This is the ClusterObject that we need to pass to the /CloudyCluster/Base route
+        template = self.preparedTemplate['template']
+        self.name = self.preparedTemplate['environmentName']
+        print("The new full Environment name is: " + str(self.name))
+        self.invalidateTopology()
+        values = self.saveEnvironmentConfig(template)
+        if values['status'] != "success":
+            return {"status": "error", "payload": values['payload']}
+        else:
+            values = self.startEnvironmentCreation(template)
+            if values['status'] != "success":
+                return {"status": "error", "payload": values['payload']}
+            else:
+                # Only recorded once the Control Node has accepted the request, a resumed run monitors this Environment instead of creating a new one
+                self.recordResource("environment", self.name, "creating")
+                values = self.monitorEnvironmentCreation()
                 if values['status'] != "success":
                     return {"status": "error", "payload": values['payload']}
                 else:
-                    values = self.startEnvironmentCreation(template)
-                    if values['status'] != "success":
-                        return {"status": "error", "payload": values['payload']}
-                    else:
-                        values = self.monitorEnvironmentCreation()
-                        if values['status'] != "success":
-                            return {"status": "error", "payload": values['payload']}
-                        else:
-                            return {"status": "success", "payload": "The Environment was created successfully."}
+                    return {"status": "success", "payload": "The Environment was created successfully."}
 
     def deleteControl(self):
         values = self.createResourceClass(self.region, self.profile)
@@ -232,12 +471,15 @@ class CloudyCluster(Environment):
             resourceClass = values['payload']
 
         try:
-            url = 'https://'+str(self.dnsName)+'/srv/deleteOriginalControlNode'
-            r = requests.post(url, cookies=self.sessionCookies, json={'deleteTable': "true"})
+            r = self.controlRequest("/srv/deleteOriginalControlNode", json={'deleteTable': "true"})
             response = json.loads(r.content)
             if response['status'] != "success":
                 return {"status": "error", "payload": {"error": response['message'], "traceback": ''.join(traceback.format_stack())}}
             else:
+                # The saved session, the API keys and the topology of the Environments go away with the Control Node
+                sessionCache.remove(self.dnsName, self.userName)
+                apiKeyCache.invalidate(self.dnsName)
+                topologyCache.invalidateControl(self.dnsName)
                 return {"status": "success", "payload": "The Control Resources have been deleted successfully."}
         except Exception as e:
             return {"status": "error", "payload": {"error": "There was an error when trying to delete the Control Resources.", "traceback": ''.join(traceback.format_exc(e))}}
@@ -261,9 +503,8 @@ class CloudyCluster(Environment):
 
         try:
             clusterObject["action"] = "terminate"
-            url = 'https://'+str(self.dnsName)+'/srv/cloudycluster/Base'
             try:
-                r = requests.post(url, cookies=self.sessionCookies, json={'clusterObj': clusterObject}, timeout=60)
+                r = self.controlRequest("/srv/cloudycluster/Base", json={'clusterObj': clusterObject}, timeout=60)
                 try:
                     response = json.loads(r.content)
                     if response['status'] != "success":
@@ -276,6 +517,7 @@ class CloudyCluster(Environment):
                 pass
 
             # We successfully started the deletion of the Environment, now we need to monitor it
+            self.invalidateTopology()
             values = self.monitorEnvironmentDeletion()
             if values['status'] != "success":
                 return {"status": "success", "payload": values['payload']}
@@ -285,35 +527,51 @@ class CloudyCluster(Environment):
         except Exception as e:
             return {"status": "error", "payload": {"error": "There was an error when trying to delete the Environment.", "traceback": ''.join(traceback.format_exc(e))}}
 
+    def getStateSnapshot(self):
+        # Returns {instanceId: {"group": ..., "role": ..., "state": ...}} for every instance of the Environment, the groups are fetched at the same time
+        values = self.fetchTopology(stateGroups)
+        if values['status'] != "success":
+            return values
+        snapshot = {}
+        for groupName in values['payload']:
+            for instance, info in values['payload'][groupName].items():
+                if str(self.cloudType).lower() == "aws" and str(instance)[:2] != "i-":
+                    continue
+                snapshot[instance] = {"group": groupName, "role": info['role'], "state": info['state']}
+        return {"status": "success", "payload": snapshot}
+
+    def diffStateSnapshots(self, previous, current):
+        # Returns the (instanceId, oldState, newState) transitions between two snapshots, instances that are new in current have an oldState of None
+        transitions = []
+        for instance in sorted(current):
+            oldState = previous[instance]['state'] if instance in previous else None
+            if oldState != current[instance]['state']:
+                transitions.append((instance, oldState, current[instance]['state']))
+        for instance in sorted(previous):
+            if instance not in current:
+                transitions.append((instance, previous[instance]['state'], None))
+        return transitions
+
+    def getInstancesNotInState(self, snapshot, desiredState):
+        # The Control Node is part of the Utility group but is never paused or resumed with the Environment
+        return [instance for instance in snapshot if snapshot[instance]['state'] != desiredState and snapshot[instance]['role'] != "ControlNode"]
+
+    def printStateTable(self, snapshot):
+        print("%-30s %-15s %-20s %s" % ("Instance", "Group", "Role", "State"))
+        for instance in sorted(snapshot):
+            print("%-30s %-15s %-20s %s" % (instance, snapshot[instance]['group'], snapshot[instance]['role'], snapshot[instance]['state']))
+
     def checkState(self):
         try:
             # Currently only checks to see if the environment is running, needs to be expanded to check if stopped and stuff
-            done = True
-            networkResponse = requests.post('https://' + str(self.dnsName) + "/srv/getSpinningClusterPart", cookies=self.sessionCookies, json={"clusterName": str(self.name), "groupName": "VPC Info", "type": "Network"})
-            networkResults = networkResponse.content
-            networkResults = json.loads(networkResults)['Network']['VPC Info']['instances']
-            for instance in networkResults:
-                if str(instance)[:2] == "i-":
-                    stateInfo = ast.literal_eval(networkResults[instance]["State"])
-                    if str(stateInfo["Name"]).lower() != "running":
-                        print("Instance (" + str(instance) + ") is not yet in the running state.")
-                        # Instance has not yet successfully stopped/resumed so we must loop through again
-                        done = False
-
-            utilityResponse = requests.post('https://' + str(self.dnsName) + "/srv/getSpinningClusterPart", cookies=self.sessionCookies, json={"clusterName": str(self.name), "groupName": "Utility", "type": "Utility"})
-            utilityResults = utilityResponse.content
-            utilityResults = json.loads(utilityResults)['Utility']['Utility']['instances']
-            for instance in utilityResults:
-                if str(instance)[:2] == "i-":
-                    stateInfo = ast.literal_eval(utilityResults[instance]["State"])
-                    if str(stateInfo["Name"]).lower() != str("running") and utilityResults[instance]["RecType"] != "ControlNode":
-                        print("Instance (" + str(instance) + ") is not yet in the running state.")
-                        # Instance has not yet successfully stopped/resumed so we must loop through again
-                        done = False
-            if done:
-                return {"status": "success", "payload": True}
-            else:
+            values = self.getStateSnapshot()
+            if values['status'] != "success":
+                return values
+            notRunning = self.getInstancesNotInState(values['payload'], "running")
+            if len(notRunning) != 0:
+                print(str(len(notRunning)) + " of " + str(len(values['payload'])) + " instances are not yet in the running state: " + ", ".join(sorted(notRunning)))
                 return {"status": "success", "payload": False}
+            return {"status": "success", "payload": True}
         except Exception as e:
             return {"status": "error", "payload": {"error": "There was an error when trying to check the state of the Environment.", "traceback": ''.join(traceback.format_exc())}}
 
@@ -326,46 +584,35 @@ class CloudyCluster(Environment):
         else:
             return {"status": "error", "payload": {"error": "Unsupported state (" + str(action) + ") passed to changeEnvironmentState.", "traceback": ''.join(traceback.format_stack())}}
 
-        results = requests.post('https://' + str(self.dnsName) + "/srv/cloudycluster/Base", cookies=self.sessionCookies, json={"clusterObj": {"action": action, "clusterName": str(self.name), "groupName": "all", "instanceID": "all", "nodeType": "all", "schedType": None}})
+        self.invalidateTopology()
+        results = self.controlRequest("/srv/cloudycluster/Base", json={"clusterObj": {"action": action, "clusterName": str(self.name), "groupName": "all", "instanceID": "all", "nodeType": "all", "schedType": None}})
 
-        # It takes a few minutes for the environment to resume so wait two minutes before checking to see if the instances are running.
+        # It takes a few minutes for the environment to resume so it gets two extra minutes before timing out. The poller backs off on its own while the instances are still pending.
+        maxTimeToWait = 360
         if desiredState == "running":
-            time.sleep(120)
+            maxTimeToWait += 120
 
-        # Need to check and make sure that all the instances actually paused/resumed successfully before returning success. For the small environment we will need to check both Utility and Network groups
+        # Need to check and make sure that all the instances actually paused/resumed successfully before returning success. Only the instances that changed state since the last check are printed.
         print("Waiting for the instances to enter the desired state.")
-        done = False
-        timeElapsed = 0
-        maxTimeToWait = 360
-        sleepTime = 30
-        while not done:
+        poll = poller.Poller("changeState", timeout=maxTimeToWait, maxInterval=30)
+        previous = {}
+        while True:
             try:
-                done = True
-                networkResponse = requests.post('https://' + str(self.dnsName) + "/srv/getSpinningClusterPart", cookies=self.sessionCookies, json={"clusterName": str(self.name), "groupName": "VPC Info", "type": "Network"})
-                networkResults = networkResponse.content
-                networkResults = json.loads(networkResults)['Network']['VPC Info']['instances']
-                for instance in networkResults:
-                    if str(instance)[:2] == "i-":
-                        stateInfo = ast.literal_eval(networkResults[instance]["State"])
-                        if str(stateInfo["Name"]).lower() != str(desiredState):
-                            print("Instance (" + str(instance) + ") is not yet in the " + str(desiredState) +" state.")
-                            # Instance has not yet successfully stopped/resumed so we must loop through again
-                            done = False
-
-                utilityResponse = requests.post('https://' + str(self.dnsName) + "/srv/getSpinningClusterPart", cookies=self.sessionCookies, json={"clusterName": str(self.name), "groupName": "Utility", "type": "Utility"})
-                utilityResults = utilityResponse.content
-                utilityResults = json.loads(utilityResults)['Utility']['Utility']['instances']
-                for instance in utilityResults:
-                    if str(instance)[:2] == "i-":
-                        stateInfo = ast.literal_eval(utilityResults[instance]["State"])
-                        if str(stateInfo["Name"]).lower() != str(desiredState) and utilityResults[instance]["RecType"] != "ControlNode":
-                            print("Instance (" + str(instance) + ") is not yet in the " + str(desiredState) +" state.")
-                            # Instance has not yet successfully stopped/resumed so we must loop through again
-                            done = False
-                if not done:
-                    time.sleep(sleepTime)
-                    timeElapsed += sleepTime
-                    if timeElapsed > maxTimeToWait:
+                values = self.getStateSnapshot()
+                if values['status'] != "success":
+                    raise Exception(str(values['payload']))
+                snapshot = values['payload']
+                for instance, oldState, newState in self.diffStateSnapshots(previous, snapshot):
+                    if oldState is None:
+                        print("Instance (" + str(instance) + ") is " + str(newState) + ".")
+                    else:
+                        print("Instance (" + str(instance) + ") went from " + str(oldState) + " to " + str(newState) + ".")
+                previous = snapshot
+                notDone = self.getInstancesNotInState(snapshot, desiredState)
+                if len(notDone) != 0:
+                    print(str(len(notDone)) + " of " + str(len(snapshot)) + " instances are not yet in the " + str(desiredState) + " state (" + poll.describe() + ").")
+                    if not poll.wait():
+                        self.printStateTable(snapshot)
                         if desiredState == "stopped":
                             return {"status": "error", "payload": {"error": "Timeout waiting for the instances to stop successfully. The instances may not be completely stopped and you could still be incurring charges.", "traceback": ''.join(traceback.format_stack())}}
                         elif desiredState == "running":
@@ -376,23 +623,18 @@ class CloudyCluster(Environment):
                     elif desiredState == "running":
                         return {"status": "success", "payload": "The environment has been successfully resumed."}
             except Exception as e:
-                time.sleep(sleepTime)
-                timeElapsed += sleepTime
-                if timeElapsed > maxTimeToWait:
+                if not poll.wait():
                     if desiredState == "stopped":
                         return {"status": "error", "payload": {"error": "Timeout waiting for the instances to stop successfully. The instances may not be completely stopped and you could still be incurring charges.", "traceback": ''.join(traceback.format_stack())}}
                     elif desiredState == "running":
                         return {"status": "error", "payload": {"error": "Timeout waiting for the instances to enter the running state successfully. The instances may not be completely started and you could still be incurring charges. Make sure that the AWS Limits on this AWS account are able to handle the number of running instances.", "traceback": ''.join(traceback.format_stack())}}
 
     def getApiKey(self):
-        maxTimeToWait = 180
-        timeElapsed = 0
-        timeToWait = 30
-        done = False
-        while not done:
+        poll = poller.Poller("getApiKey", timeout=180, maxInterval=30)
+        while True:
             try:
                 ccAccessKey = None
-                results = requests.post("https://" + str(self.dnsName) + "/srv/listAppKeys", cookies=self.sessionCookies)
+                results = self.controlRequest("/srv/listAppKeys")
                 output = json.loads(results.content)
                 for key in output['payload']:
                     if key['userName'] == str(self.userName):
@@ -403,32 +645,22 @@ class CloudyCluster(Environment):
                 else:
                     return {"status": "error", "payload": {"error": "Unable to retrieve the CC App Key required for ccq job submission. Check to make sure the user you are submitting the job as has created a CC App key through the CC UI.", "traceback": ''.join(traceback.format_stack())}}
             except Exception as e:
-                if timeElapsed > maxTimeToWait:
+                if not poll.wait():
                     return {"status": "error", "payload": {"error": "Unable to retrieve the CC App Key required for ccq job submission due to an exception. Check to make sure the user you are submitting the job as has created a CC App key through the CC UI.", "traceback": ''.join(traceback.format_exc())}}
-                else:
-                    time.sleep(timeToWait)
-                    timeElapsed += timeToWait
 
     def genApiKey(self):
-        maxTimeToWait = 180
-        timeElapsed = 0
-        timeToWait = 30
-        done = False
-        while not done:
+        poll = poller.Poller("genApiKey", timeout=180, maxInterval=30)
+        while True:
             try:
-                url = 'https://' + str(self.dnsName) + '/srv/saveAndGenUserAppKey'
-                r = requests.post(url, cookies=self.sessionCookies, json={'userName': ""})
+                r = self.controlRequest("/srv/saveAndGenUserAppKey", json={'userName': ""})
                 values = json.loads(r.content)
                 if values['status'] != "success":
                     return {"status": "error", "payload": {"error": values['message'], "traceback": ''.join(traceback.format_exc())}}
                 else:
                     return {"status": "success", "payload": values['message']}
             except Exception as e:
-                if timeElapsed > maxTimeToWait:
+                if not poll.wait():
                     return {"status": "error", "payload": {"error": "There was a problem trying to generate a new API Key.", "traceback": ''.join(traceback.format_exc())}}
-                else:
-                    time.sleep(timeToWait)
-                    timeElapsed += timeToWait
 
     def monitorJob(self, jobId, ccAccessKey, schedulerName, loginDomainName, verbose, jobPrefixString, schedType):
         encodedUserName = ""
@@ -440,7 +672,7 @@ class CloudyCluster(Environment):
         final = {"jobId": str(jobId), "userName": str(encodedUserName), "password": str(encodedPassword), "verbose": verbose, "instanceId": None, "jobNameInScheduler": None, "schedulerName": str(schedulerName), "schedulerHostName": None, 'schedulerType': None, 'schedulerInstanceId': None, 'schedulerInstanceName': None, 'schedulerInstanceIp': None, "printJobOwner": "False", "printSubmissionTime": "False", "printDispatchTime": "False", "printSubmitHost": "False", "printNumCPUs": "False", 'printErrors': "False", "valKey": str(valKey), "dateExpires": str(dateExpires), "certLength": str(certLength), "jobInfoRequest": False, "ccAccessKey": str(ccAccessKey), "printOutputLocation": "False", "printInstancesForJob": "False", "remoteUserName": None, "databaseInfo": None}
 
         ccqstatURL = "https://" + str(loginDomainName) + "/srv/ccqstat"
-        results = requests.post(ccqstatURL, cookies=self.sessionCookies, json=final)
+        results = self.getHttpSession(loginDomainName).post(ccqstatURL, cookies=self.sessionCookies, json=final)
 
         jobOutput = json.loads(results.content)
         if jobOutput['status'] == "success":
@@ -469,47 +701,65 @@ class CloudyCluster(Environment):
         else:
             return {"status": "error", "payload": jobOutput['payload']}
 
+    def fetchTopologyGroup(self, groupName, groupType):
+        response = self.controlRequest("/srv/getSpinningClusterPart", json={"clusterName": str(self.name), "groupName": groupName, "type": groupType})
+        group = responseModels.InstanceGroup.parse(response, groupName, groupType)
+        return dict((instanceId, instance.toDict()) for instanceId, instance in group.instances.items())
+
+    def fetchTopology(self, groups=(("Utility", "Utility"),)):
+        # groups is a list of (groupName, type) pairs to fetch from the Control Node, the Login Instance is in the Utility group. The groups are fetched at the same time.
+        try:
+            with ThreadPoolExecutor(max_workers=len(groups)) as executor:
+                futures = [(groupName, fanOut.submit(executor, self.fetchTopologyGroup, groupName, groupType)) for groupName, groupType in groups]
+                topology = dict((groupName, future.result()) for groupName, future in futures)
+            return {"status": "success", "payload": topology}
+        except Exception as e:
+            return {"status": "error", "payload": {"error": "There was an error retrieving the instances of the Environment from the Control Resources.", "traceback": ''.join(traceback.format_exc())}}
+
+    def getTopology(self, maxAge=None):
+        return topologyCache.get(self.getTopologyKey(), self.fetchTopology, maxAge)
+
+    def findInstances(self, groupName, role):
+        # Returns {instanceId: {"role": ..., "domainName": ..., "state": ...}} for the instances of the group with the role (ex: WebDavNode)
+        values = self.getTopology()
+        if values['status'] != "success":
+            return values
+        instances = values['payload'].get(groupName, {})
+        return {"status": "success", "payload": dict((instance, instances[instance]) for instance in instances if instances[instance]['role'] == role)}
+
     def getJobSubmitDns(self):
-        maxTimeToWait = 180
-        timeElapsed = 0
-        timeToWait = 30
-        done = False
-        while not done:
+        poll = poller.Poller("getJobSubmitDns", timeout=180, maxInterval=30)
+        while True:
             try:
                 loginDomainName = None
                 # The job is submitted to the Login Instance so we must get it's domain name here.
-                utilityResponse = requests.post('https://' + str(self.dnsName) + "/srv/getSpinningClusterPart", cookies=self.sessionCookies, json={"clusterName": str(self.name), "groupName": "Utility", "type": "Utility"})
-                utilityResults = utilityResponse.content
-                utilityResults = json.loads(utilityResults)['Utility']['Utility']['instances']
-                for instance in utilityResults:
+                values = self.findInstances("Utility", "WebDavNode")
+                if values['status'] != "success":
+                    raise Exception(str(values['payload']))
+                for instance in values['payload']:
                     if str(self.cloudType).lower() == "aws":
                         if str(instance)[:2] == "i-":
-                            if utilityResults[instance]["RecType"] == "WebDavNode":
-                                loginDomainName = utilityResults[instance]['domainName']
+                            loginDomainName = values['payload'][instance]['domainName']
                     elif str(self.cloudType).lower() == "gcp":
-                        if utilityResults[instance]["RecType"] == "WebDavNode":
-                            loginDomainName = utilityResults[instance]['domainName']
+                        loginDomainName = values['payload'][instance]['domainName']
 
                 if loginDomainName is None:
-                    if timeElapsed > maxTimeToWait:
+                    # The Login Instance may not be up yet, the next attempt has to ask the Control Node again
+                    self.invalidateTopology()
+                    if not poll.wait():
                         return {"status": "error", "payload": {"error": "There was a problem trying to get the Login Instance's DNS name that is required to submit the job.", "traceback": ''.join(traceback.format_stack())}}
-                    else:
-                        time.sleep(timeToWait)
-                        timeElapsed += timeToWait
                 else:
                     return {"status": "success", "payload": loginDomainName}
             except Exception as e:
-                if timeElapsed > maxTimeToWait:
+                print(traceback.format_exc())
+                self.invalidateTopology()
+                if not poll.wait():
                     return {"status": "error", "payload": {"error": "There was a problem trying to get the Login Instance's DNS name that is required to submit the job.", "traceback": ''.join(traceback.format_exc())}}
-                else:
-                    print(traceback.format_exc())
-                    time.sleep(timeToWait)
-                    timeElapsed += timeToWait
 
     def getControlDns(self, ipAddress):
         try:
             tempurl = "http://"+str(ipAddress)+"/srv/getCurrentDomain"
-            r = requests.get(tempurl)
+            r = self.getHttpSession(ipAddress).get(tempurl)
             values = json.loads(r.content)
             if values['status'] != "success":
                 return {"status": "error", "payload": {"error": str(values['message']), "traceback": ''.join(traceback.format_stack())}}
@@ -520,26 +770,28 @@ class CloudyCluster(Environment):
         except Exception as e:
                 return {"status": "error", "payload": {"error": "There was a problem trying to obtain the Control Instance DNS.", "traceback": ''.join(traceback.format_exc())}}
 
+    def requestDatabaseTableNames(self):
+        # A single attempt, the error status is only returned for exceptions (ex: the Control Node is not answering yet)
+        try:
+            tempurl = "https://" + str(self.dnsName) + "/srv/getGeneratedTableNames"
+            r = self.getHttpSession().get(tempurl)
+            values = json.loads(r.content)
+            if values['status'] != "success":
+                return {"status": "error", "payload": {"error": str(values['message']), "traceback": ''.join(traceback.format_stack())}, "final": True}
+            else:
+                return {"status": "success", "payload": values['payload']}
+        except Exception as e:
+            return {"status": "error", "payload": {"error": "There was a problem trying to obtain the DB Table names.", "traceback": ''.join(traceback.format_exc())}}
+
     def getDatabaseTableNames(self):
-        maxTimeToWait = 300
-        timeElapsed = 0
-        timeToWait = 30
-        done = False
-        while not done:
-            try:
-                tempurl = "https://" + str(self.dnsName) + "/srv/getGeneratedTableNames"
-                r = requests.get(tempurl)
-                values = json.loads(r.content)
-                if values['status'] != "success":
-                    return {"status": "error", "payload": {"error": str(values['message']), "traceback": ''.join(traceback.format_stack())}}
-                else:
-                    return {"status": "success", "payload": values['payload']}
-            except Exception as e:
-                if timeElapsed > maxTimeToWait:
-                    return {"status": "error", "payload": {"error": "There was a problem trying to obtain the DB Table names.", "traceback": ''.join(traceback.format_exc())}}
-                else:
-                    time.sleep(timeToWait)
-                    timeElapsed += timeToWait
+        poll = poller.Poller("getDatabaseTableNames", timeout=300, maxInterval=30)
+        while True:
+            values = self.requestDatabaseTableNames()
+            if values['status'] == "success" or values.get("final"):
+                values.pop("final", None)
+                return values
+            if not poll.wait():
+                return values
 
     def prePopulatedDb(self, objectTableCsvFile, lookupTableCsvFile, objectTableName, lookupTableName):
         values = self.createResourceClass(self.region, self.profile)
@@ -548,48 +800,26 @@ class CloudyCluster(Environment):
         else:
             resourceClass = values['payload']
 
-        dbObjectTableItemList = []
+        # The rows are read from the CSV files while they are being written so even tables with millions of rows do not have to fit in memory
+        for csvFileName in [objectTableCsvFile, lookupTableCsvFile]:
+            if not os.path.isfile(str(csvFileName)):
+                return {"status": "error", "payload": {"error": "Unable to find the CSV file " + str(csvFileName) + " to load into the database.", "traceback": ''.join(traceback.format_stack())}}
+        dbObjectTableItemList = readCsvItems(objectTableCsvFile)
+        dbIndexTableItemList = readCsvItems(lookupTableCsvFile)
 
-        try:
-            with open(objectTableCsvFile) as csvFile:
-                reader = csv.DictReader(csvFile)
-                for row in reader:
-                    tempRow = {}
-                    for item in row:
-                        if row[item] != "":
-                            tempRow[item] = row[item]
-                    dbObjectTableItemList.append(tempRow)
-        except Exception as e:
-            return {"status": "error", "payload": {"error": "Encountered an error when trying to load the provided Object Table data from the CSV file.", "traceback": ''.join(traceback.format_exc)}}
-
-        dbIndexTableItemList = []
-        try:
-            with open(lookupTableCsvFile) as csvFile:
-                reader = csv.DictReader(csvFile)
-                for row in reader:
-                    tempRow = {}
-                    for item in row:
-                        if row[item] != "":
-                            tempRow[item] = row[item]
-                    dbIndexTableItemList.append(tempRow)
-        except Exception as e:
-            return {"status": "error", "payload": {"error": "Encountered an error when trying to load the provided Lookup Table data from the CSV file.", "traceback": ''.join(traceback.format_exc)}}
-
-        values = resourceClass.writeObjectsToDatabase(dbIndexTableItemList, dbObjectTableItemList, lookupTableName, objectTableName)
+        workers = self.generalParameters.get("dbwriteworkers") or 8
+        values = resourceClass.writeObjectsToDatabase(dbIndexTableItemList, dbObjectTableItemList, lookupTableName, objectTableName, workers=workers)
         if values['status'] != "success":
             return {"status": "error", "payload": values['payload']}
         else:
             return {"status": "success", "payload": values['payload']}
 
     def writeOutEfsObjectToDb(self):
-        maxTimeToWait = 180
-        timeElapsed = 0
-        timeToWait = 30
-        done = False
-        while not done:
+        poll = poller.Poller("writeOutEfsObjectToDb", timeout=180, maxInterval=30)
+        while True:
             try:
                 url = 'https://' + str(self.dnsName) + '/srv/writeEfs'
-                r = requests.get(url)
+                r = self.getHttpSession().get(url)
                 try:
                     response = json.loads(r.content)
                     if response['status'] == "error":
@@ -598,42 +828,28 @@ class CloudyCluster(Environment):
                     # This route does not return anything on success
                     return {"status": "success", "payload": "Successfully wrote out the EFS object to the DB."}
             except Exception as e:
-                if timeElapsed > maxTimeToWait:
+                if not poll.wait():
                     return {"status": "error", "payload": {"error": "There was an error encountered when attempting to write out the EFS object to the DB.", "traceback": ''.join(traceback.format_exc())}}
-                else:
-                    time.sleep(timeToWait)
-                    timeElapsed += timeToWait
 
     def saveEnvironmentConfig(self, template):
-        maxTimeToWait = 180
-        timeElapsed = 0
-        timeToWait = 30
-        done = False
-        while not done:
+        poll = poller.Poller("saveEnvironmentConfig", timeout=180, maxInterval=30)
+        while True:
             try:
-                url = 'https://' + str(self.dnsName) + '/srv/saveCluster'
-                r = requests.post(url, cookies=self.sessionCookies, json={'clusterObj': template, 'clusterName': str(self.name)})
+                r = self.controlRequest("/srv/saveCluster", json={'clusterObj': template, 'clusterName': str(self.name)})
                 response = json.loads(r.content)
                 if response['response'] != "success":
                     return {"status": "error", "payload": {"error": response['message'], "traceback": ''.join(traceback.format_stack())}}
                 else:
                     return {"status": "success", "payload": "Successfully wrote out the Cluster object to the DB."}
             except Exception as e:
-                if timeElapsed > maxTimeToWait:
+                if not poll.wait():
                     return {"status": "error", "payload": {"error": "There was an error encountered when attempting to write out the Cluster object to the DB.", "traceback": ''.join(traceback.format_exc())}}
-                else:
-                    time.sleep(timeToWait)
-                    timeElapsed += timeToWait
 
     def startEnvironmentCreation(self, template):
-        maxTimeToWait = 180
-        timeElapsed = 0
-        timeToWait = 30
-        done = False
-        while not done:
+        poll = poller.Poller("startEnvironmentCreation", timeout=180, maxInterval=30)
+        while True:
             try:
-                url = 'https://' + str(self.dnsName) + '/srv/startCluster'
-                r = requests.post(url, cookies=self.sessionCookies, json={'clusterObj': template})
+                r = self.controlRequest("/srv/startCluster", json={'clusterObj': template})
                 response = json.loads(r.content)
                 print("RESPONSE IS ")
                 print(str(response))
@@ -642,30 +858,39 @@ class CloudyCluster(Environment):
                 else:
                     return {"status": "success", "payload": "The Environment creation was started successfully."}
             except Exception as e:
-                if timeElapsed > maxTimeToWait:
+                if not poll.wait():
                     return {"status": "error", "payload": {"error": "There was an error encountered when attempting to start the Environment creation.", "traceback": ''.join(traceback.format_exc())}}
-                else:
-                    time.sleep(timeToWait)
-                    timeElapsed += timeToWait
 
     def monitorEnvironmentCreation(self):
-        url = 'https://' + str(self.dnsName) + '/srv/getSpinningCluster'
-        maxTimeToWait = 2400 # 20 minutes=1200, 40 minutes=2400, 60 minutes=3600
-        timeElapsed = 0
-        timeToWait = 120
-        done = False
-        while not done:
+        # Environments usually take about the same amount of time to spin up, so we check slowly until that time gets close and then check often
+        expectedCreationTime = float(self.generalParameters.get("expectedcreationtime", 900))
+        nearExpectedTime = expectedCreationTime - 120
+        nearExpectedInterval = 15
+        nearExpected = False
+        poll = poller.Poller("monitorEnvironmentCreation", timeout=2400, maxInterval=120)
+        while True:
+            if poll.elapsed() >= nearExpectedTime:
+                if not nearExpected:
+                    nearExpected = True
+                    poll.setMaxInterval(nearExpectedInterval)
+                    poll.reset()
+            else:
+                # Never sleep past the point where the Environment could be done
+                poll.setMaxInterval(max(nearExpectedInterval, min(120, nearExpectedTime - poll.elapsed())))
             try:
-                r = requests.post(url, cookies=self.sessionCookies, json={'clusterName': str(self.name)})
-                clusterInfo = json.loads(r.content)
-                if clusterInfo['clusterSpunUp'] == "true":
-                    time.sleep(120)
+                r = self.controlRequest("/srv/getSpinningCluster", json={'clusterName': str(self.name)})
+                clusterStatus = responseModels.ClusterStatus.parse(r)
+                if clusterStatus.spunUp:
+                    print("The Environment reports that it has spun up after " + str(int(poll.elapsed())) + " seconds. Now checking that the Login Instance is ready to use.")
+                    values = self.waitForEnvironmentReady()
+                    if values['status'] != "success":
+                        return {"status": "error", "payload": values['payload']}
                     return {"status": "success", "payload": "The Environment has been created successfully."}
                 else:
-                    if str(clusterInfo['clusterError']) != "none":
-                        print("Error encountered during cluster creation: ", clusterInfo['clusterError'])
+                    if clusterStatus.error is not None:
+                        print("Error encountered during cluster creation: ", clusterStatus.error)
                         # Environment encountered an error and failed
-                        return {"status": "error", "payload": {"error": "There was an error encountered during the creation of the new Environment.\n" + str(clusterInfo["clusterError"]), "traceback": ''.join(traceback.format_stack())}}
+                        return {"status": "error", "payload": {"error": "There was an error encountered during the creation of the new Environment.\n" + str(clusterStatus.error), "traceback": ''.join(traceback.format_stack())}}
             except Exception as e:
                 print("Checking status error:")
                 print(''.join(traceback.format_exc()))
@@ -673,22 +898,80 @@ class CloudyCluster(Environment):
                 print(r.content)
                 pass
 
-            if maxTimeToWait < timeElapsed:
+            if not poll.wait():
                 # Timeout waiting for Environment to spin up
-                return {"status": "error", "payload": {"error": "The new Environment did not spin up successfully before hitting the timeout.", "traceback": ''.join(traceback.format_stack())}}
-            else:
-                time.sleep(timeToWait)
-                timeElapsed += timeToWait
+                return {"status": "error", "payload": {"error": "The new Environment did not spin up successfully before hitting the timeout (" + poll.describe() + ").", "traceback": ''.join(traceback.format_stack())}}
+
+    def getCcqSchedulerName(self):
+        # Returns the name of the first CCQ enabled Scheduler in the Environment template or None if there is not one.
+        # The ccq flag of the [<templateName>] section is rendered into the template as the Scheduler's scalingType ("autoscaling" for CCQ, "fixed" otherwise) so the prepared template is the one place that always has it.
+        if self.preparedTemplate is None and self.ccEnvironmentParameters is not None:
+            values = self.prepareEnvironmentTemplate()
+            if values['status'] != "success":
+                print("Unable to load the Environment template to find the CCQ enabled Scheduler, the ccqstat readiness check will be skipped.")
+                return None
+        if self.preparedTemplate is None:
+            print("The Environment template is not available to find the CCQ enabled Scheduler, the ccqstat readiness check will be skipped.")
+            return None
+        for scheduler in self.preparedTemplate['template'].get("schedulers", []):
+            if str(scheduler.get("scalingType", "fixed")) != "fixed":
+                return scheduler.get("schedName")
+        print("The Environment template does not contain a CCQ enabled Scheduler, the ccqstat readiness check will be skipped.")
+        return None
+
+    def waitForEnvironmentReady(self):
+        # Instead of sleeping after the Environment reports that it is spun up we check the things the jobs actually need: the Login Instance DNS name resolves, sshd answers and ccqstat responds
+        readinessTimeout = float(self.generalParameters.get("readinesstimeout", 600))
+        poll = poller.Poller("environmentReadiness", timeout=readinessTimeout, maxInterval=10, initialInterval=1)
+        schedulerName = self.getCcqSchedulerName()
+        scheduler = None
+        loginDomainName = None
+        probe = "login"
+        while True:
+            try:
+                if probe == "login":
+                    values = self.getLoginInstanceDomainName()
+                    if values['status'] == "success":
+                        loginDomainName = values['payload']
+                        probe = "dns"
+                if probe == "dns":
+                    values = probes.resolves(loginDomainName)
+                    if values['status'] == "success":
+                        probe = "ssh"
+                if probe == "ssh":
+                    values = probes.acceptsSsh(loginDomainName)
+                    if values['status'] == "success":
+                        probe = "ccq"
+                        if schedulerName is None:
+                            probe = "done"
+                if probe == "ccq":
+                    if scheduler is None:
+                        values = self.createSchedulerClass("ccq")
+                        if values['status'] == "success":
+                            scheduler = values['payload']
+                    if scheduler is not None:
+                        values = scheduler.getJobStatuses(self, schedulerName, loginDomainName, maxAge=0)
+                        if values['status'] == "success":
+                            probe = "done"
+                if probe == "done":
+                    print("The Environment is ready to use (" + poll.describe() + " of readiness checks).")
+                    return {"status": "success", "payload": loginDomainName}
+            except Exception as e:
+                values = {"status": "error", "payload": {"error": "There was an error checking the readiness of the Environment.", "traceback": ''.join(traceback.format_exc())}}
+
+            print("Waiting for the Environment to be ready to use (check: " + probe + ").")
+            if not poll.wait():
+                try:
+                    error = values['payload']['error']
+                except Exception as e:
+                    error = str(values['payload'])
+                return {"status": "error", "payload": {"error": "The Environment spun up but was not ready to use before the timeout (" + poll.describe() + "). The last check (" + probe + ") failed with: " + str(error), "traceback": ''.join(traceback.format_stack())}}
 
     def getEnvironmentObject(self):
-        maxTimeToWait = 180
-        timeElapsed = 0
-        timeToWait = 30
-        done = False
-        while not done:
+        poll = poller.Poller("getEnvironmentObject", timeout=180, maxInterval=30)
+        while True:
             try:
-                url = 'https://'+str(self.dnsName)+'/srv/getClusterByName'
-                r = requests.post(url, cookies=self.sessionCookies, json={'clusterName': self.name})
+                r = self.controlRequest("/srv/getClusterByName", json={'clusterName': self.name})
                 response = json.loads(r.content)
                 try:
                     if response['status'] == "error":
@@ -700,23 +983,16 @@ class CloudyCluster(Environment):
                     else:
                         return {"status": "error", "payload": {"error": "The requested Environment was not found on the Control Resource specified.", "traceback": ''.join(traceback.format_stack())}}
             except Exception as e:
-                if timeElapsed > maxTimeToWait:
+                if not poll.wait():
                     return {"status": "error", "payload": {"error": "There was an error when trying to obtain the information required to delete the Environment from the Environment.", "traceback": ''.join(traceback.format_exc(e))}}
-                else:
-                    time.sleep(timeToWait)
-                    timeElapsed += timeToWait
 
     def monitorEnvironmentDeletion(self):
-        maxTimeToWait = 2400 # 20 minutes
-        timeElapsed = 0
-        timeToWait = 120
-        done = False
+        poll = poller.Poller("monitorEnvironmentDeletion", timeout=2400, maxInterval=120)
         print("Now waiting for the Environment to delete.")
-        while not done:
-            print("You have waited " + str(int(timeElapsed)/int(60)) + " minutes for the Environment to delete.")
+        while True:
+            print("You have waited " + str(int(poll.elapsed() / 60)) + " minutes for the Environment to delete.")
             try:
-                url = 'https://'+str(self.dnsName)+'/srv/getClusterByName'
-                r = requests.post(url, cookies=self.sessionCookies, json={'clusterName': self.name})
+                r = self.controlRequest("/srv/getClusterByName", json={'clusterName': self.name})
                 try:
                     response = json.loads(r.content)
                     try:
@@ -728,50 +1004,42 @@ class CloudyCluster(Environment):
                             pass
                 except Exception as e:
                     # The clusterObject is gone from the database we can return success
-                    done = True
                     return {"status": "success", "payload": "The Environment has been deleted successfully"}
             except Exception as e:
                 pass
 
-            if maxTimeToWait < timeElapsed:
-                # Timeout waiting for Environment to spin up
-                done = True
-                return {"status": "error", "payload": {"error": "The timeout was reached while waiting for the Environment to delete.", "traceback": ''.join(traceback.format_stack())}}
-            else:
-                time.sleep(timeToWait)
-                timeElapsed += timeToWait
+            if not poll.wait():
+                # Timeout waiting for Environment to delete
+                return {"status": "error", "payload": {"error": "The timeout was reached while waiting for the Environment to delete after " + poll.describe() + ".", "traceback": ''.join(traceback.format_stack())}}
 
     def getLoginInstanceDomainName(self):
-        maxTimeToWait = 180
-        timeElapsed = 0
-        timeToWait = 30
-        done = False
-        while not done:
+        poll = poller.Poller("getLoginInstanceDomainName", timeout=180, maxInterval=30)
+        while True:
             try:
                 loginDomainName = None
                 # The job is submitted to the Login Instance so we must get it's domain name here.
-                utilityResponse = requests.post('https://' + str(self.dnsName) + "/srv/getSpinningClusterPart", cookies=self.sessionCookies, json={"clusterName": str(self.name), "groupName": "Utility", "type": "Utility"})
-                utilityResults = utilityResponse.content
-                utilityResults = json.loads(utilityResults)['Utility']['Utility']['instances']
+                values = self.getTopology()
+                if values['status'] != "success":
+                    raise Exception(str(values['payload']))
+                utilityResults = values['payload'].get("Utility", {})
                 for instance in utilityResults:
                     if str(self.cloudType).lower() == "aws":
                         if str(instance)[:2] == "i-":
-                            if utilityResults[instance]["RecType"] == "WebDavNode":
+                            if utilityResults[instance]["role"] == "WebDavNode":
                                 loginDomainName = utilityResults[instance]['domainName']
                     elif str(self.cloudType).lower() == "gcp":
                         if "-wd-" in str(instance):
                             loginDomainName = utilityResults[instance]['domainName']
 
                 if loginDomainName is None:
+                    self.invalidateTopology()
                     return {"status": "error", "payload": {"error": "Unable to find the Login instance DNS.", "traceback": ''.join(traceback.format_stack())}}
                 else:
                     return {"status": "success", "payload": loginDomainName}
             except Exception as e:
-                if timeElapsed > maxTimeToWait:
+                self.invalidateTopology()
+                if not poll.wait():
                     return {"status": "error", "payload": {"error": "An error was encountered while trying to retrieve the Login instance DNS.", "traceback": ''.join(traceback.format_exc())}}
-                else:
-                    time.sleep(timeToWait)
-                    timeElapsed += timeToWait
 
     # Get the state of the job that we submitted from the ccq scheduler
     def getJobState(self, jobId, ccAccessKey, schedulerName, loginDomainName, verbose, jobPrefixString, schedType):
@@ -790,7 +1058,7 @@ class CloudyCluster(Environment):
         final = {"jobId": str(jobId), "userName": str(encodedUserName), "password": str(encodedPassword), "verbose": verbose, "instanceId": None, "jobNameInScheduler": None, "schedulerName": str(schedulerName), "schedulerHostName": None, 'schedulerType': None, 'schedulerInstanceId': None, 'schedulerInstanceName': None, 'schedulerInstanceIp': None, "printJobOwner": "False", "printSubmissionTime": "False", "printDispatchTime": "False", "printSubmitHost": "False", "printNumCPUs": "False", 'printErrors': "False", "valKey": str(valKey), "dateExpires": str(dateExpires), "certLength": str(certLength), "jobInfoRequest": False, "ccAccessKey": str(ccAccessKey), "printOutputLocation": "False", "printInstancesForJob": "False", "remoteUserName": None, "databaseInfo": None}
 
         ccqstatURL = "https://" + str(loginDomainName) + "/srv/ccqstat"
-        results = requests.post(ccqstatURL, cookies=self.sessionCookies, json=final)
+        results = self.getHttpSession(loginDomainName).post(ccqstatURL, cookies=self.sessionCookies, json=final)
 
         jobOutput = json.loads(results.content)
         if jobOutput['status'] == "success":
@@ -812,15 +1080,45 @@ class CloudyCluster(Environment):
         else:
             return {"status": "error", "payload": jobOutput['payload']}
 
+    def createThroughputManager(self):
+        # Used by the rj stage when adaptiveThroughput is true: the throughput of the Database Tables is raised for batches of jobs and while the tables throttle and lowered again once they are idle or the jobs have drained
+        if str(self.cloudType).lower() != "aws":
+            return {"status": "error", "payload": {"error": "Adaptive Database throughput is only available for Control Resources on AWS.", "traceback": ''.join(traceback.format_stack())}}
+        values = self.createResourceClass(self.region, self.profile)
+        if values['status'] != "success":
+            return {"status": "error", "payload": values['payload']}
+        resourceClass = values['payload']
+        values = self.getDatabaseTableNames()
+        if values['status'] != "success":
+            return {"status": "error", "payload": values['payload']}
+        tableNames = [str(tableName) for tableName in values['payload'].values()]
+
+        def sample():
+            return resourceClass.getDatabaseUsage(tableNames)
+
+        try:
+            baseRead = self.controlParameters.get("readcapacity")
+            baseWrite = self.controlParameters.get("writecapacity")
+            if baseRead is None or baseWrite is None:
+                # Without readCapacity/writeCapacity the tables go back to the throughput they have now
+                values = sample()
+                if values['status'] != "success":
+                    return {"status": "error", "payload": values['payload']}
+                baseRead = baseRead or max(table['provisionedRead'] or 1 for table in values['payload'].values())
+                baseWrite = baseWrite or max(table['provisionedWrite'] or 1 for table in values['payload'].values())
+            kwargs = {"sample": sample, "apply": self.modifyDBThroughput, "baseRead": baseRead, "baseWrite": baseWrite}
+            for field, argument in [("maxreadcapacity", "maxRead"), ("maxwritecapacity", "maxWrite"), ("capacityperjob", "capacityPerJob"), ("throughputsampleinterval", "interval")]:
+                if self.controlParameters.get(field) is not None:
+                    kwargs[argument] = self.controlParameters[field]
+            return {"status": "success", "payload": throughputManager.ThroughputManager(**kwargs)}
+        except Exception as e:
+            return {"status": "error", "payload": {"error": "There was a problem reading the adaptive Database throughput settings, readCapacity, writeCapacity, maxReadCapacity, maxWriteCapacity, capacityPerJob and throughputSampleInterval must be numbers.", "traceback": ''.join(traceback.format_exc())}}
+
     def modifyDBThroughput(self, readCapacity, writeCapacity):
-        maxTimeToWait = 180
-        timeElapsed = 0
-        timeToWait = 30
-        done = False
-        while not done:
+        poll = poller.Poller("modifyDBThroughput", timeout=180, maxInterval=30)
+        while True:
             try:
-                url = 'https://' + str(self.dnsName) + '/srv/setNewDBThroughput'
-                r = requests.post(url, cookies=self.sessionCookies, json={"read": str(readCapacity), "write": str(writeCapacity)})
+                r = self.controlRequest("/srv/setNewDBThroughput", json={"read": str(readCapacity), "write": str(writeCapacity)})
                 values = json.loads(r.content)
                 if values['status'] != "success":
                     if "The provisioned throughput for the table will not change" in values['message']:
@@ -829,8 +1127,5 @@ class CloudyCluster(Environment):
                 else:
                     return {"status": "success", "payload": values['message']}
             except Exception as e:
-                if timeElapsed > maxTimeToWait:
+                if not poll.wait():
                     return {"status": "error", "payload": {"error": "There was a problem trying to update the Database Throughput values.", "traceback": ''.join(traceback.format_exc())}}
-                else:
-                    time.sleep(timeToWait)
-                    timeElapsed += timeToWait
@@ -7,8 +7,27 @@
 # This file may not be copied, modified, or distributed except according to those terms.
 
 
+import copy
+import os
+import sys
+import threading
 import traceback
 
+sys.path.append(os.path.join(os.path.dirname(__file__), '../Utilities'))
+import apiKeyCache
+import controlPool
+import gcpClients
+import httpMetrics
+import httpSessions
+import poller
+import probes
+import sessionCache
+import topologyCache
+
+
+# The General section fields that tune the process wide pools, caches and pollers (see the configureFromParameters calls in Environment.__init__). They are shared by every configuration file of a fan-out run so the files must agree on them (see Create_Processing_Environment.checkProcessParameters).
+processParameters = ["httppoolconnections", "httppoolmaxsize", "httpmaxretries", "httpbackofffactor", "httpmetricspath", "httpmetricsprometheuspath", "pollinitialinterval", "pollbackoffmultiplier", "polljitter", "sessioncachedirectory", "sessioncachemaxage", "topologycachettl", "apikeycachedirectory", "gcpdiscoverydirectory"]
+
 
 class Environment(object):
     def __init__(self, environmentType, name, cloudType, userName, password, controlParameters, ccEnvironmentParameters, generalParameters, firstName, lastName, pempath, dnsName=None, controlResourceName=None, region=None, profile=None):
@@ -26,14 +45,81 @@ class Environment(object):
 
         # We initially define these parameters as None because we haven't created the Control Resources for them. As we create the resources we define these variables for later use.
         self.sessionCookies = None
+        # Held while logging in again after the session expired so threads that hit the expired session at the same time only log in once
+        self.sessionLock = threading.Lock()
         self.dnsName = dnsName
         self.controlResourceName = controlResourceName
+        # The Cloud Formation Stack Id of the Control Resources (AWS only)
+        self.controlStack = None
         self.region = region
         self.profile = profile
 
+        # The state of the current run (see Utilities/stateStore.py), the resources are recorded as they are created so a crashed run can be resumed or cleaned up
+        self.runState = None
+
+        # All REST calls go through the shared keep-alive session pool, the pool sizes and retries can be tuned in the General section
+        httpSessions.configureFromParameters(self.generalParameters)
+
+        # Every REST call is timed per endpoint, the JSON and Prometheus files written at the end of the run can be moved or turned off in the General section
+        httpMetrics.configureFromParameters(self.generalParameters)
+
+        # Every wait loop (Control Resources, Environment creation, job states, etc) goes through the shared poller whose backoff can also be tuned in the General section
+        poller.configureFromParameters(self.generalParameters)
+
+        # The Control Node session cookies are reused across invocations, the cache location and lifetime can be changed in the General section
+        sessionCache.configureFromParameters(self.generalParameters)
+
+        # The instance groups of the Environment are fetched once and shared by every job script, workflow and scheduler call, the TTL can be changed in the General section
+        topologyCache.configureFromParameters(self.generalParameters)
+
+        # The CC API keys are looked up once per Control Node and user, they can also be kept on disk by setting apiKeyCacheDirectory in the General section
+        apiKeyCache.configureFromParameters(self.generalParameters)
+
+        # The GCP API clients are built from discovery documents read once per process, a directory to keep fetched documents in can be set in the General section
+        gcpClients.configureFromParameters(self.generalParameters)
+
         # Define which scheduler types are valid for a particular environment
         #self.supportedSchedulers = []
 
+    def getHttpSession(self, host=None):
+        # Returns the pooled session for the requested host, defaults to the Control Resources
+        if host is None:
+            host = self.dnsName
+        return httpSessions.getSession(host)
+
+    def sessionExpired(self, response):
+        # Overridden by the Environments whose Control Node reports an expired session some other way
+        return response.status_code == 401
+
+    def controlRequest(self, path, method="post", host=None, **kwargs):
+        # Sends a request that needs the session cookies to the Control Resources (or host). When the session has expired on the Control Node we log in again, once, and retry the request.
+        if host is None:
+            host = self.dnsName
+        url = "https://" + str(host) + str(path)
+        cookies = self.sessionCookies
+        response = getattr(self.getHttpSession(host), method)(url, cookies=cookies, **kwargs)
+        if not self.sessionExpired(response):
+            return response
+        with self.sessionLock:
+            # Another thread may have logged in again while this request was being sent
+            if self.sessionCookies is cookies:
+                print("The session on the Control Resources " + str(self.dnsName) + " has expired, logging in again.")
+                sessionCache.remove(self.dnsName, self.userName)
+                values = self.getSession(useCache=False)
+                if values['status'] != "success":
+                    return response
+        httpMetrics.recordRetry(url, method, "session")
+        return getattr(self.getHttpSession(host), method)(url, cookies=self.sessionCookies, **kwargs)
+
+    def recordResource(self, kind, value, status):
+        if self.runState is None:
+            return
+        try:
+            self.runState.setResource(kind, value, status)
+        except Exception as e:
+            print("Unable to record the " + str(kind) + " " + str(value) + " in the run state.")
+            print(''.join(traceback.format_exc()))
+
     def createResourceClass(self, region=None, profile=None):
         try:
             environmentClass = __import__(str(self.cloudType).lower() + "Resources")
@@ -63,12 +149,113 @@ class Environment(object):
         except Exception as e:
             return {"status": "error", "payload": {"error": "Encountered an error attempting to create an instance of the Scheduler class.", "traceback": ''.join(traceback.format_exc())}}
 
-    def getSession(self):
+    def getControlPoolKey(self):
+        # Control Resources can only be shared between runs that would have created identical ones, including the user that was created on the Control Node (see controlPool.makePoolKey)
+        parameters = sorted((self.controlParameters or {}).items())
+        values = [self.environmentType, str(self.cloudType).lower(), self.region, self.profile, self.userName, self.password, parameters]
+        return controlPool.makePoolKey(values)
+
+    def checkControlHealth(self):
+        # A pooled Control Node is only handed out if its DNS name still resolves and we can still log in to it
+        values = probes.resolves(self.dnsName, 443)
+        if values['status'] != "success":
+            return values
+        return self.getSession(useCache=False)
+
+    def useControl(self, node):
+        self.controlResourceName = node['controlResourceName']
+        self.dnsName = node['dnsName']
+        self.controlStack = node['controlStack']
+        self.sessionCookies = None
+
+    def acquireControl(self, pool, runId, templateLocation, resourceName, resourceId=None):
+        # Used instead of createControl when the Control Node pool is enabled: lease a healthy pooled Control Node or create a new one that joins the pool once this run releases it
+        self.expireIdleControls(pool)
+        for node in pool.takeAbandoned():
+            print("The lease on the pooled Control Resources named " + str(node['controlResourceName']) + " taken by the run " + str(node['leasedBy']) + " ran out without them being returned. They have been marked as abandoned and will not be leased again, check them for leftover Environments and delete them by hand.")
+
+        node = pool.getLease(runId)
+        if node is None:
+            node = pool.lease(runId)
+        while node is not None:
+            self.useControl(node)
+            values = self.checkControlHealth()
+            if values['status'] == "success":
+                print("Leased the pooled Control Resources named " + str(self.controlResourceName) + " with the DNS name " + str(self.dnsName) + ".")
+                return {"status": "success", "payload": self.dnsName, "leased": True}
+            print("The pooled Control Resources named " + str(node['controlResourceName']) + " failed the health check and have been marked as unhealthy, they will need to be deleted by hand.")
+            try:
+                print(values['payload']['error'])
+            except Exception as e:
+                print(values['payload'])
+            pool.setStatus(node['controlResourceName'], "unhealthy")
+            node = pool.lease(runId)
+
+        print("There are no Control Resources available in the pool, creating new ones.")
+        self.controlResourceName = resourceName
+        self.dnsName = None
+        values = self.createControl(templateLocation, resourceName, resourceId)
+        if values['status'] == "success":
+            pool.add(self.controlResourceName, self.dnsName, self.controlStack, runId)
+            values['leased'] = False
+        return values
+
+    def releaseControl(self, pool, runId):
+        # Used instead of deleteControl when the Control Node pool is enabled: the Control Node goes back into the pool unless the pool is already full
+        node = pool.getNode(self.controlResourceName)
+        if node is None:
+            # Created before the pool was enabled
+            values = self.deleteControl()
+            values['released'] = False
+            return values
+        # When dc is run on its own the Control Node is still leased by the run that ran cc
+        if pool.release(node['leasedBy'] or runId, self.controlResourceName):
+            print("The Control Resources named " + str(self.controlResourceName) + " have been returned to the pool.")
+            return {"status": "success", "payload": "The Control Resources have been returned to the pool.", "released": True}
+        print("The Control Resource pool is full, deleting the Control Resources named " + str(self.controlResourceName) + ".")
+        values = self.deletePooledControl(pool, pool.getNode(self.controlResourceName), self)
+        values['released'] = False
+        return values
+
+    def deletePooledControl(self, pool, node, environment=None):
+        if environment is None:
+            # Deleting a Control Node other than ours, so the deletion gets its own copy of the Environment pointing at that node
+            environment = copy.copy(self)
+            environment.runState = None
+            environment.useControl(node)
+        if environment.sessionCookies is None:
+            environment.getSession()
+        values = environment.deleteControl()
+        if values['status'] != "success":
+            print("Unable to delete the pooled Control Resources named " + str(node['controlResourceName']) + ", they have been marked as unhealthy and will need to be deleted by hand.")
+            pool.setStatus(node['controlResourceName'], "unhealthy")
+        else:
+            pool.remove(node['controlResourceName'])
+        return values
+
+    def expireIdleControls(self, pool):
+        for node in pool.takeExpired():
+            print("The pooled Control Resources named " + str(node['controlResourceName']) + " have been idle for longer than " + str(int(pool.idleTimeout)) + " seconds, deleting them.")
+            self.deletePooledControl(pool, node)
+
+    def getSession(self, useCache=True):
         return {"status": "error", "payload": "Base Environment Class method getSession not implemented for " + str(self.environmentType) + "."}
 
+    def createThroughputManager(self, **kwargs):
+        return {"status": "error", "payload": "Base Environment Class method createThroughputManager not implemented for " + str(self.environmentType) + "."}
+
     def createControl(self, **kwargs):
         return {"status": "error", "payload": "Base Environment Class method createControl not implemented for " + str(self.environmentType) + "."}
 
+    def applyControlPlacement(self, **kwargs):
+        return {"status": "error", "payload": "Base Environment Class method applyControlPlacement not implemented for " + str(self.environmentType) + "."}
+
+    def finishControlRaces(self, **kwargs):
+        return {"status": "error", "payload": "Base Environment Class method finishControlRaces not implemented for " + str(self.environmentType) + "."}
+
+    def prepareEnvironmentTemplate(self, **kwargs):
+        return {"status": "error", "payload": "Base Environment Class method prepareEnvironmentTemplate not implemented for " + str(self.environmentType) + "."}
+
     def createEnvironment(self, **kwargs):
         return {"status": "error", "payload": "Base Environment Class method createEnvironment not implemented for " + str(self.environmentType) + "."}
 
@@ -96,6 +283,17 @@ class Environment(object):
     def monitorJob(self, **kwargs):
         return {"status": "error", "payload": "Base Environment Class method monitorJob not implemented for " + str(self.environmentType) + "."}
 
+    def getTopologyKey(self):
+        # The topology belongs to one Environment on one set of Control Resources
+        return (str(self.dnsName), str(self.name))
+
+    def invalidateTopology(self):
+        # Called whenever the instances of the Environment may have changed (created, paused/resumed, deleted) or a lookup did not find what it expected
+        topologyCache.invalidate(self.getTopologyKey())
+
+    def getTopology(self, **kwargs):
+        return {"status": "error", "payload": "Base Environment Class method getTopology not implemented for " + str(self.environmentType) + "."}
+
     def getJobSubmitDns(self, **kwargs):
         return {"status": "error", "payload": "Base Environment Class method getJobSubmitDns not implemented for " + str(self.environmentType) + "."}
 
@@ -0,0 +1,123 @@
+# Copyright 2017
+#
+# Licensed under the Apache License, Version 2.0, <LICENSE-APACHE or
+# http://apache.org/licenses/LICENSE-2.0> or the MIT license <LICENSE-MIT or
+# http://opensource.org/licenses/MIT> or the LGPL, Version 2.0 <LICENSE-LGPLv2 or
+# https://www.gnu.org/licenses/old-licenses/lgpl-2.0.txt>, at your option.
+# This file may not be copied, modified, or distributed except according to those terms.
+
+
+import asyncio
+import os
+import sys
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '../Utilities'))
+import fanOut
+import poller
+
+
+class JobMonitor(object):
+    def __init__(self, environment, jobScripts, timeout=0, initialInterval=10, maxInterval=120, backoffMultiplier=1.5, maxWorkers=16):
+        # jobScripts maps each submitted job id to the JobScript object that submitted it
+        self.environment = environment
+        self.jobScripts = jobScripts
+        self.timeout = timeout
+        self.initialInterval = float(initialInterval)
+        self.maxInterval = float(maxInterval)
+        self.backoffMultiplier = float(backoffMultiplier)
+        self.maxWorkers = int(maxWorkers)
+
+        self.executor = None
+        self.doneCount = 0
+        self.results = {}
+
+    def run(self):
+        if len(self.jobScripts) == 0:
+            return {"status": "success", "payload": {}}
+        return asyncio.run(self.monitorAll())
+
+    async def monitorAll(self):
+        startTime = time.monotonic()
+        # The paramiko and requests calls are blocking so they run on a thread pool while the event loop keeps track of every job
+        self.executor = ThreadPoolExecutor(max_workers=max(1, min(self.maxWorkers, len(self.jobScripts))))
+        tasks = {}
+        for jobId in self.jobScripts:
+            tasks[asyncio.ensure_future(self.monitorJob(jobId, self.jobScripts[jobId]))] = jobId
+
+        try:
+            pending = set(tasks)
+            while pending:
+                remaining = None
+                if self.timeout and float(self.timeout) > 0:
+                    remaining = float(self.timeout) - (time.monotonic() - startTime)
+                    if remaining <= 0:
+                        for task in pending:
+                            task.cancel()
+                        return {"status": "error", "payload": {"error": "The time limit has been reached at %s seconds" % int(time.monotonic() - startTime), "traceback": ''.join(traceback.format_stack())}}
+                done, pending = await asyncio.wait(pending, timeout=remaining, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    values = task.result()
+                    self.results[tasks[task]] = values
+                    if values['status'] != "success" and values.get('fatal'):
+                        # We could not get the state of the job at all, stop monitoring the others just like the sequential monitor did
+                        for other in pending:
+                            other.cancel()
+                        return {"status": "error", "payload": values['payload']}
+            return {"status": "success", "payload": self.results}
+        finally:
+            self.executor.shutdown(wait=False)
+
+    async def call(self, function, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, fanOut.runInContext(function), *args)
+
+    async def monitorJob(self, jobId, jobScript):
+        # The overall deadline is enforced by monitorAll, the poller only spaces out the status checks of this job
+        poll = poller.Poller("jobMonitor", maxInterval=self.maxInterval, initialInterval=self.initialInterval, multiplier=self.backoffMultiplier)
+        lastState = None
+        while True:
+            try:
+                values = await self.call(jobScript.job_state, jobId, self.environment)
+            except Exception as e:
+                values = {"status": "error", "payload": {"error": "There was a problem retrieving the state of the job " + str(jobId) + ".", "traceback": ''.join(traceback.format_exc())}}
+            if values["status"] != "success":
+                print("job_state returned", values)
+                return {"status": "error", "payload": values["payload"], "fatal": True}
+
+            jobState = values["payload"]["jobState"]
+            name = values["payload"]["jobName"]
+            if jobState == "Completed":
+                # Pull the output down the moment the job finishes instead of waiting for the rest of the batch
+                values = await self.call(jobScript.download, jobId, name)
+                if values["status"] != "success":
+                    print("The job %s encountered an error while downloading" % name)
+                    print(values)
+                    self.jobFinished()
+                    return {"status": "error", "payload": values["payload"]}
+                print("%s job is complete." % name)
+                jobScript.reportState(jobId, jobState)
+                self.jobFinished()
+                return {"status": "success", "payload": {"jobName": name, "jobState": jobState}}
+            elif jobState == "Error" or jobState == "Killed":
+                print("%s job in error state." % name)
+                jobScript.reportState(jobId, jobState)
+                self.jobFinished()
+                return {"status": "error", "payload": {"jobName": name, "jobState": jobState}}
+
+            if jobState != lastState:
+                # Poll quickly right after a state change since that is when the next change is most likely, then back off while the job sits still
+                print("The job %s is in the %s state" % (name, jobState))
+                jobScript.reportState(jobId, jobState)
+                lastState = jobState
+                poll.reset()
+            await asyncio.sleep(poll.nextInterval())
+
+    def jobFinished(self):
+        self.doneCount += 1
+        if self.doneCount == 1:
+            print("%d job is done." % self.doneCount)
+        else:
+            print("%d jobs are done" % self.doneCount)
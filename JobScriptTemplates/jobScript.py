@@ -14,8 +14,11 @@ import io
 import time
 import os
 import sys
-import requests
 import subprocess
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '../Utilities'))
+import poller
+
 paramiko.util.log_to_file("paramiko.log")
 class JobScript(object):
     def __init__(self, name, options, schedulerType, environment):
@@ -26,6 +29,21 @@ class JobScript(object):
 
         # We will set these values later on
         self.loginDNS = None
+        self.transport = None
+        self.scheduler = None
+        self.schedulerName = None
+
+        # Called with (jobScript, jobId, jobState) when the job is submitted and every time its state changes, used to record the job in the run state
+        self.stateCallback = None
+
+    def reportState(self, jobId, jobState):
+        if self.stateCallback is None:
+            return
+        try:
+            self.stateCallback(self, jobId, jobState)
+        except Exception as e:
+            print("Unable to record the state of the job " + str(jobId) + ".")
+            print(''.join(traceback.format_exc()))
 
     def createConnection(self, host, username, password, mfaToken, private_key):
         # TODO Need to implement the automated entry of the MFA token to make sure that this works with MFA but it should handle it.
@@ -113,7 +131,7 @@ class JobScript(object):
             print(url)
             with open(str(filepath), 'rb') as f:
                 file = f.read()
-            response = requests.request('PUT', url, auth=(userName, password), allow_redirects=False, data=file)
+            response = self.environment.getHttpSession(dns).put(url, auth=(userName, password), allow_redirects=False, data=file)
             print(response.text)
         except Exception as e:
             print("Error uploading file with webdav protocol")
@@ -140,8 +158,10 @@ class JobScript(object):
                 stdout.append(receivedStdout.decode())
                 stderr.append(receivedStderr.decode())
                 channelLength = len(receivedStdout)
+            # Most commands (ex: ccqsub) exit right after their output is read so start checking quickly
+            poll = poller.Poller("commandExit", maxInterval=5, initialInterval=0.05)
             while not channel.exit_status_ready():
-                time.sleep(5)
+                poll.wait()
             exitCode = channel.recv_exit_status()
             stdout = ''.join(stdout)
             stderr = ''.join(stderr)
@@ -157,16 +177,20 @@ class JobScript(object):
             return {"status": "error", "payload": {"error": "There was a problem closing the connection", "traceback": ''.join(traceback.format_exc())}}
 
     def monitor(self, jobId, scheduler, environment, schedulerName):
-        timeElapsed = 0
         timeout = self.options['timeout']
+        poll = poller.Poller("monitorJobScript", timeout=timeout, maxInterval=120)
+        lastState = None
         print("Now monitoring the status of the CCQ job. Your jobID is " + str(jobId))
         while True:
-            print("It has been " + str(int(timeElapsed)/int(60)) + " minutes since the CCQ job launched.")
+            print("It has been " + str(int(poll.elapsed() / 60)) + " minutes since the CCQ job launched.")
             values = scheduler.getJobStatus(environment, jobId, schedulerName, self.loginDNS)
             print("The job is in the %s state" % values["payload"]["jobState"])
             if values['status'] != "success":
                 return values
             else:
+                if values["payload"]["jobState"] != lastState and values["payload"]["jobState"] != "Completed":
+                    # Completed is only recorded once the output has been downloaded
+                    self.reportState(jobId, values["payload"]["jobState"])
                 if values["payload"]["jobState"] != "Running" or values["payload"]["jobState"] != "Submitted":
                     # The job is no longer running and we need to take action accordingly
                     if values["payload"]["jobState"] == "Error":
@@ -177,18 +201,18 @@ class JobScript(object):
                     elif values["payload"]["jobState"] == "Completed":
                         return {"status": "success", "payload": "The CCQ job has successfully completed.", "jobName": values["payload"]["jobName"]}
                     else:
-                        if timeout == 0 or timeElapsed < timeout:
-                            timeElapsed += 120
-                            time.sleep(120)
-                            print("The job is still creating the requested resources, waiting two minutes before checking the status again.")
-                        else:
-                            print("The time limit has been reached at %s in the state %s" % (timeElapsed, values["payload"]["jobState"]))
+                        if values["payload"]["jobState"] != lastState:
+                            # Check again quickly right after a state change, then back off while the job sits in the same state
+                            lastState = values["payload"]["jobState"]
+                            poll.reset()
+                        print("The job is still creating the requested resources, waiting before checking the status again.")
+                        if not poll.wait():
+                            print("The time limit has been reached at %s in the state %s" % (int(poll.elapsed()), values["payload"]["jobState"]))
                             sys.exit(1)
 
                 else:
-                    print("The job is still running, waiting one minute before checking the status again.")
-                    timeElapsed += 60
-                    time.sleep(60)
+                    print("The job is still running, waiting before checking the status again.")
+                    poll.wait()
 
     def job_state(self, jobId, environment):
         return self.scheduler.getJobStatus(environment, jobId, self.schedulerName, self.loginDNS)
@@ -210,6 +234,9 @@ class JobScript(object):
                         return {"status": "success", "payload": "The job script was successfully uploaded to the remote system."}
                     except Exception as e:
                         return {"status": "error", "payload": {"error": "There was a problem trying to upload the job script to the remote system.", "traceback": ''.join(traceback.format_exc())}}
+                    finally:
+                        # The transport can be shared with other job scripts so release the channel as soon as we are done with it
+                        sftpSession.close()
         elif str(self.options['uploadProtocol']).lower() == "webdav":
             kwargs = {'userName': self.environment.userName, 'password': self.environment.password, 'dns':self.loginDNS, 'filepath': self.options['localPath'], 'remotepath': self.options['remotePath'], 'filename': self.name, 'sharedDir': self.options['executeDirectory']}
             #print "self.name is "+str(self.name)
@@ -274,8 +301,6 @@ class JobScript(object):
         return {"status": "success", "payload": "Successfully checked the job script parameters."}
 
     def download(self, jobId, jobName):
-        timeElapsed = 0
-        timeout = 240
         # TODO Currently we don't support the PrivateKey or MFA for upload, we will need to do this later.
         # Create the sftp session for uploading via sftp
         values = self.createSftpSession()
@@ -284,39 +309,38 @@ class JobScript(object):
         else:
             sftpSession = values['payload']
             # Download Output's .e and .o files to current directory
-            # Create a wait loop to check if the files are in the current directory
-            while True:
-                try:
-                    remote = jobName + jobId + ".e"
-                    localErr = self.options["directory"] + "/" + remote
-                    sftpSession.get(remote, localErr)
-                    print(f"Downloading {localErr} for job {jobName}")
-
+            # Create a wait loop in case the output files have not been written out on the remote system yet
+            poll = poller.Poller("downloadOutput", timeout=240, maxInterval=20, initialInterval=1)
+            try:
+                while True:
+                    try:
+                        remote = jobName + jobId + ".e"
+                        localErr = self.options["directory"] + "/" + remote
+                        sftpSession.get(remote, localErr)
+                        print(f"Downloading {localErr} for job {jobName}")
 
-                    remote = jobName + jobId + ".o"
-                    local = self.options["directory"] + "/" + remote
-                    sftpSession.get(remote, local)
-                    print(f"Downloading {local} for job {jobName}")
+                        remote = jobName + jobId + ".o"
+                        local = self.options["directory"] + "/" + remote
+                        sftpSession.get(remote, local)
+                        print(f"Downloading {local} for job {jobName}")
 
-                    try:
-                        f = sftpSession.open(localErr, "r")
-                        f.close()
-                        f = sftpSession.open(local, "r")
-                        f.close()
+                        return {"status": "success", "payload": "The job script was successfully uploaded to the remote system."}
 
                     except IOError:
-                        if timeElapsed < timeout:
-                            print(f"Waiting 20 seconds to get {jobName}'s output")
-                            timeElapsed += 20
-                            time.sleep(20)
-                        else:
-                            raise
-
-                    return {"status": "success", "payload": "The job script was successfully uploaded to the remote system."}
+                        print(f"Waiting to get {jobName}'s output")
+                        if not poll.wait():
+                            return {"status": "error", "payload": {"error": "There was a problem trying to download the job script to the remote system.", "traceback": ''.join(traceback.format_exc())}}
+                    except Exception:
+                        return {"status": "error", "payload": {"error": "There was a problem trying to download the job script to the remote system.", "traceback": ''.join(traceback.format_exc())}}
+            finally:
+                sftpSession.close()
 
-                except Exception:
-                    return {"status": "error", "payload": {"error": "There was a problem trying to download the job script to the remote system.", "traceback": ''.join(traceback.format_exc())}}
 
+    def useSharedResources(self, loginDNS, transport, scheduler):
+        # Lets a batch of job scripts reuse one Login Instance lookup, SSH connection and API key instead of each one setting up its own
+        self.loginDNS = loginDNS
+        self.transport = transport
+        self.scheduler = scheduler
 
     def processJobScript(self):
         print("Now processing the job script: " + str(self.name))
@@ -331,10 +355,11 @@ class JobScript(object):
                 return values
             self.loginDNS = values['payload']
         
-        values = self.createConnection(self.loginDNS, self.environment.userName, self.environment.password, None, None)
-        if values['status'] != "success":
-            return values
-        
+        if self.transport is None:
+            values = self.createConnection(self.loginDNS, self.environment.userName, self.environment.password, None, None)
+            if values['status'] != "success":
+                return values
+
         # We have validated the parameters and retrieved the Login Instance DNS name. Moving on to actually uploading and submitting the job script.
         if not self.options['uploadScript']:
             return
@@ -343,13 +368,16 @@ class JobScript(object):
             return values
 
         # We successfully uploaded the file now we need to create a scheduler object based on the type of scheduler we are submitting to.
-        values = self.environment.createSchedulerClass(self.options['schedulerType'])
-        if values['status'] != "success":
-            return values
-        scheduler = values['payload']
-        values = scheduler.getOrGenerateApiKey(self.environment)
-        if values['status'] != "success":
-            return values
+        if self.scheduler is None:
+            values = self.environment.createSchedulerClass(self.options['schedulerType'])
+            if values['status'] != "success":
+                return values
+            scheduler = values['payload']
+            values = scheduler.getOrGenerateApiKey(self.environment)
+            if values['status'] != "success":
+                return values
+        else:
+            scheduler = self.scheduler
 
         # Now that we have the correct authorization api key we can create the connection to the login instance and submit the job via the commandline or the web interface.
         values = scheduler.submitJobCommandLine(self.options['remotePath'], self)
@@ -362,6 +390,7 @@ class JobScript(object):
 
         self.scheduler = scheduler
         self.schedulerName = schedulerName
+        self.reportState(jobId, "Submitted")
         # Now we monitor the job unless the user expressly states they do not want to monitor the job.
         if str(self.options['monitorJob']).lower() != "true":
             # The user chose not to monitor the job so we declare success and move on to processing the next jobscript
@@ -376,7 +405,8 @@ class JobScript(object):
             if values['status'] != "success":
                 return values
 
-            self.download(jobId, values["jobName"])
+            if self.download(jobId, values["jobName"])['status'] == "success":
+                self.reportState(jobId, "Completed")
             # The jobscript has been submitted and completed so we just return the values of the monitoring function
             values['jobId'] = jobId
             values['environment'] = self.environment
@@ -0,0 +1,142 @@
+# Copyright 2017
+#
+# Licensed under the Apache License, Version 2.0, <LICENSE-APACHE or
+# http://apache.org/licenses/LICENSE-2.0> or the MIT license <LICENSE-MIT or
+# http://opensource.org/licenses/MIT> or the LGPL, Version 2.0 <LICENSE-LGPLv2 or
+# https://www.gnu.org/licenses/old-licenses/lgpl-2.0.txt>, at your option.
+# This file may not be copied, modified, or distributed except according to those terms.
+
+
+import math
+import os
+import sys
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+import jobScript
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '../Utilities'))
+import fanOut
+
+
+class JobSubmitter(object):
+    def __init__(self, environment, jobs, maxWorkers=8, channelsPerConnection=4):
+        # jobs is the list of JobScript objects or job configurations ({"name": ..., "options": {...}}) from the Computation section
+        self.environment = environment
+        self.jobs = jobs
+        self.maxWorkers = max(1, int(maxWorkers))
+        # sshd only allows a handful of sessions per connection (MaxSessions defaults to 10) so the batch is spread over a few shared connections
+        self.channelsPerConnection = max(1, int(channelsPerConnection))
+
+        self.loginDNS = None
+        self.transports = []
+        self.schedulers = {}
+        self.schedulersLock = threading.Lock()
+
+    def createJobScript(self, job):
+        # The jobs can already be JobScript objects (built while validating the configuration) or the raw job configurations
+        if isinstance(job, jobScript.JobScript):
+            return job
+        kwargs = {"name": job['name'], "options": job['options'], "schedulerType": job['options']['schedulerType'], "environment": self.environment}
+        return jobScript.JobScript(**kwargs)
+
+    def openConnections(self, numberOfConnections):
+        for x in range(numberOfConnections):
+            connection = jobScript.JobScript(name=None, options={}, schedulerType=None, environment=self.environment)
+            values = connection.createConnection(self.loginDNS, self.environment.userName, self.environment.password, None, None)
+            if values['status'] != "success":
+                return values
+            if connection.transport is None:
+                return {"status": "error", "payload": {"error": "Unable to open the SSH connection to the Login Instance " + str(self.loginDNS) + ".", "traceback": ''.join(traceback.format_stack())}}
+            self.transports.append(connection.transport)
+        return {"status": "success", "payload": self.transports}
+
+    def getScheduler(self, schedulerType):
+        # One scheduler object (and therefore one API key lookup) per scheduler type for the whole batch
+        with self.schedulersLock:
+            if str(schedulerType).lower() in self.schedulers:
+                return {"status": "success", "payload": self.schedulers[str(schedulerType).lower()]}
+            values = self.environment.createSchedulerClass(schedulerType)
+            if values['status'] != "success":
+                return values
+            scheduler = values['payload']
+            values = scheduler.getOrGenerateApiKey(self.environment)
+            if values['status'] != "success":
+                return values
+            self.schedulers[str(schedulerType).lower()] = scheduler
+            return {"status": "success", "payload": scheduler}
+
+    def submitOne(self, newJobScript, transport):
+        try:
+            values = self.getScheduler(newJobScript.options['schedulerType'])
+            if values['status'] != "success":
+                return values
+            newJobScript.useSharedResources(self.loginDNS, transport, values['payload'])
+            values = newJobScript.processJobScript()
+            if values is None:
+                return {"status": "error", "payload": {"error": "The job script " + str(newJobScript.name) + " was not submitted.", "traceback": ''.join(traceback.format_stack())}}
+            return values
+        except Exception as e:
+            return {"status": "error", "payload": {"error": "There was a problem submitting the job script " + str(newJobScript.name) + ".", "traceback": ''.join(traceback.format_exc())}}
+
+    def prepare(self, workers):
+        # Everything that is the same for every job script is looked up once before the batch starts
+        values = self.environment.getJobSubmitDns()
+        if values['status'] != "success":
+            return values
+        self.loginDNS = values['payload']
+        return self.openConnections(int(math.ceil(workers / float(self.channelsPerConnection))))
+
+    def reattach(self, submittedJobs):
+        # Used by --resume, submittedJobs is a list of {"jobScript": ..., "jobId": ..., "schedulerName": ...} for jobs that were submitted by the interrupted run
+        # The job scripts get the same shared resources they would have had after being submitted so they can be handed straight to the JobMonitor
+        if len(submittedJobs) == 0:
+            return {"status": "success", "payload": {}}
+        values = self.prepare(min(self.maxWorkers, len(submittedJobs)))
+        if values['status'] != "success":
+            return values
+
+        jobIdDict = {}
+        for x in range(len(submittedJobs)):
+            newJobScript = self.createJobScript(submittedJobs[x]['jobScript'])
+            values = self.getScheduler(newJobScript.options['schedulerType'])
+            if values['status'] != "success":
+                return values
+            newJobScript.useSharedResources(self.loginDNS, self.transports[x % len(self.transports)], values['payload'])
+            newJobScript.schedulerName = submittedJobs[x]['schedulerName']
+            print("Resuming the monitoring of the job " + str(newJobScript.name) + " with the job ID: " + str(submittedJobs[x]['jobId']))
+            jobIdDict[submittedJobs[x]['jobId']] = newJobScript
+        return {"status": "success", "payload": jobIdDict}
+
+    def submitAll(self):
+        if len(self.jobs) == 0:
+            return {"status": "success", "payload": {}}
+
+        workers = min(self.maxWorkers, len(self.jobs))
+        values = self.prepare(workers)
+        if values['status'] != "success":
+            return values
+
+        jobScripts = [self.createJobScript(job) for job in self.jobs]
+        print("Submitting " + str(len(jobScripts)) + " job scripts using " + str(workers) + " workers over " + str(len(self.transports)) + " SSH connections.")
+
+        jobIdDict = {}
+        errors = []
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = []
+            for x in range(len(jobScripts)):
+                futures.append(fanOut.submit(executor, self.submitOne, jobScripts[x], self.transports[x % len(self.transports)]))
+            for x in range(len(futures)):
+                values = futures[x].result()
+                if values['status'] != "success" or "jobId" not in values:
+                    print("The submission of the jobscript: %s failed." % jobScripts[x].name)
+                    print(values)
+                    errors.append({"name": jobScripts[x].name, "payload": values['payload']})
+                else:
+                    print("Your job ID:", values["jobId"])
+                    jobIdDict[values["jobId"]] = jobScripts[x]
+
+        if len(jobIdDict) == 0:
+            return {"status": "error", "payload": {"error": "None of the job scripts were submitted successfully.", "traceback": ''.join(traceback.format_stack())}, "errors": errors}
+        return {"status": "success", "payload": jobIdDict, "errors": errors}
@@ -8,54 +8,119 @@
 
 
 import botocore
+import datetime
 import os
+import botocore.exceptions
 import botocore.session
+import itertools
+import threading
 import time
 import traceback
 import sys
 from resources import Resource
 import boto3
+from boto3.dynamodb.types import TypeSerializer
+from concurrent.futures import ThreadPoolExecutor
 
 sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(os.path.join(os.path.dirname(__file__), '../Utilities'))
+
+import fanOut
+import poller
+
+
+# The Botocore sessions are shared by every AwsResources object in the process (ex: all of the configurations of a fan-out run) so the credentials for a profile are only resolved once
+# Botocore sessions are not thread safe so creating clients from them is serialized, the clients themselves can be used from any thread
+botocoreSessions = {}
+botocoreSessionsLock = threading.Lock()
+
+# Creating a client loads and parses the service model, which takes from hundreds of milliseconds to seconds, so the clients are shared as well (keyed by (service, region, profile))
+# The clients refresh their credentials through the session so a cached client never goes stale
+botocoreClients = {}
+
+
+def getBotocoreSession(profile):
+    with botocoreSessionsLock:
+        session = botocoreSessions.get(profile)
+        if session is None:
+            session = botocore.session.Session(profile=profile)
+            # Resolve the credentials now so a missing or broken profile fails here instead of when the first client is created
+            if session.get_credentials() is None:
+                raise botocore.exceptions.NoCredentialsError()
+            botocoreSessions[profile] = session
+        return session
+
+
+def getBotocoreClient(service, region, profile):
+    key = (str(service), str(region), profile)
+    with botocoreSessionsLock:
+        client = botocoreClients.get(key)
+    if client is not None:
+        return client
+    session = getBotocoreSession(profile)
+    with botocoreSessionsLock:
+        # Another thread may have created the client while the session was being set up
+        client = botocoreClients.get(key)
+        if client is None:
+            client = session.create_client(str(service), region_name=str(region))
+            botocoreClients[key] = client
+        return client
+
+
+def getDefaultBotocoreClient(service, region, profile):
+    # Falls back to the default Botocore session (environment variables, instance profile, etc.) and remembers it for the profile too so the broken profile is not tried again on every call
+    defaultKey = (str(service), str(region), None)
+    with botocoreSessionsLock:
+        client = botocoreClients.get(defaultKey)
+        if client is None:
+            client = botocore.session.get_session().create_client(str(service), region_name=str(region))
+            botocoreClients[defaultKey] = client
+        botocoreClients[(str(service), str(region), profile)] = client
+        return client
 
 
 class AwsResources(Resource):
     def __init__(self, **kwargs):
         super(AwsResources, self).__init__(**kwargs)
+        # The Cloud Formation Stack Id of the Control Resources created by createControlResources
+        self.stackId = None
 
     def createBotocoreClient(self, service):
         try:
-            session = botocore.session.Session(profile=self.profile)
-            client = session.create_client(str(service), region_name=str(self.region))
+            client = getBotocoreClient(service, self.region, self.profile)
             return {"status": "success", "payload": client}
         except Exception as e:
             print("Trying second method of getting a Botocore Session")
             pass
         try:
-            session = botocore.session.get_session()
-            client = session.create_client(str(service), region_name=str(self.region))
+            client = getDefaultBotocoreClient(service, self.region, self.profile)
             return {"status": "success", "payload": client}
         except Exception as e:
             return {"status": "error", "payload": {"error": "There was an exception encountered when trying to obtain a Botocore session to" + str(service) + ".", "traceback": ''.join(traceback.format_exc())}}
 
-    def getStartupKey(self, instance, options):
+    def getStartupKey(self, instance, options, wait=True, resourceId=None):
+        # With wait=False only one attempt is made, the caller does the retrying (see probes.ProbeSet)
+        # resourceId is the Cloud Formation Stack Id of the Control Resources, it defaults to the Stack created by createControlResources (a resumed creation never calls it)
+        stackId = resourceId if resourceId is not None else self.stackId
+        if stackId is None:
+            return {"status": "error", "payload": {"error": "The Cloud Formation Stack Id of the Control Resources is needed to find the startup key.", "traceback": ''.join(traceback.format_stack())}, "final": True}
         try:
             client = self.createBotocoreClient("cloudformation")["payload"]
             correct_key = None
-            counter = 0
-            response = client.describe_stacks(StackName=self.stackId)
+            poll = poller.Poller("getStartupKey", timeout=100, maxInterval=20)
+            response = client.describe_stacks(StackName=stackId)
             for item in response["Stacks"]:
                 for output in item["Outputs"]:
                     if "InstanceID" in output["OutputKey"]:
                         instance = output["OutputValue"]
             client = self.createBotocoreClient("ec2")["payload"]
-            while not correct_key and counter < 5:
+            while not correct_key:
                 request = client.describe_tags(Filters=[{"Name": "resource-id", "Values": [instance]}])
                 for item in request["Tags"]:
                     if "startup_key" in item["Key"]:
                         return {"status": "success", "payload": item["Value"]}
-                time.sleep(20)
-                counter += 1
+                if not wait or not poll.wait():
+                    break
             if not correct_key:
                 return {"status": "error", "payload": {"error": "startup_key not found", "traceback": "".join(traceback.format_stack())}}
         except Exception as e:
@@ -104,28 +169,20 @@ class AwsResources(Resource):
         else:
             client = values['payload']
 
+        # Only the events of the deletion are followed (with some slack for the difference between our clock and the one of AWS)
+        since = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(minutes=5)
         try:
             client.delete_stack(StackName=resourceId)
         except Exception as e:
             return {"status": "error", "payload": {"error": "There was an exception encountered when trying to delete the Cloud Formation Stack.", "traceback": ''.join(traceback.format_exc())}}
 
-        values = self.monitorControlResources(resourceId, "deletion")
+        values = self.monitorControlResources(resourceId, "deletion", since)
         if values['status'] != "success":
             return {"status": "error", "payload": values['payload']}
         else:
             return {"status": "success", "payload": "Successfully deleted the Cloud Formation Stack."}
 
-    def monitorControlResources(self, resourceId, stateToFind):
-        # If we successfully got the stackId
-        status = None
-        counter = 0
-        resourceStatus = None
-        resourceType = None
-        maxTimeToWait = 1200
-        timeElapsed = 0
-        timeToWait = 60
-        done = False
-
+    def monitorControlResources(self, resourceId, stateToFind, since=None):
         values = self.createBotocoreClient("cloudformation")
         if values['status'] != "success":
             return {"status": "error", "payload": values['payload']}
@@ -133,60 +190,54 @@ class AwsResources(Resource):
             client = values['payload']
 
         # Keep tracking the state until the Stack creation has either Completed or Failed.
-        while not done:
-            try:
-                stackEvents = client.describe_stack_events(StackName=resourceId)
-                stackDict = stackEvents['StackEvents'][0]
-                resourceStatus = stackDict['ResourceStatus']
-                resourceType = stackDict['ResourceType']
+        # Only the events that are new since the last check are read, the checks start a few seconds apart and back off while nothing changes
+        follower = StackEventFollower(client, resourceId, since)
+        poll = poller.Poller("monitorControlResources", timeout=1200, maxInterval=30)
+        try:
+            while True:
                 try:
-                    for dict in stackEvents["StackEvents"]:
-                        if "ResourceStatusReason" in dict:
-                            resourceStatusReason = dict["ResourceStatusReason"]
+                    newEvents = follower.poll()
+                    for event in newEvents:
+                        print("Cloud Formation: " + follower.describeEvent(event))
+                    if len(newEvents) != 0:
+                        poll.reset()
+                    status = follower.stackStatus
+                    # If waiting for create we need to monitor the state of the Stack, if waiting for deletion we need to wait until the stack is gone
+                    if stateToFind == "creation":
+                        if status == "CREATE_COMPLETE":
+                            print("The Cloud Formation Stack has been created successfully.")
+                            return {"status": "success", "payload": "The Cloud Formation Stack has been created successfully."}
+                        elif status in ["ROLLBACK_COMPLETE", "ROLLBACK_FAILED", "CREATE_FAILED"]:
+                            return {"status": "error", "payload": {"error": "The Cloud Formation Template failed to launch properly. The error associated with the Cloud Formation Template is: " + str(follower.failureReason), "traceback": ''.join(traceback.format_stack())}}
+
+                    elif stateToFind == "deletion":
+                        if status == "DELETE_COMPLETE":
+                            print("The Cloud Formation Stack has been deleted successfully.")
+                            return {"status": "success", "payload": "The Cloud Formation Stack has been deleted successfully."}
+                        elif status == "DELETE_FAILED":
+                            return {"status": "error", "payload": {"error": "The Cloud Formation Template failed to delete properly. The error associated with the Cloud Formation Template is: " + str(follower.failureReason), "traceback": ''.join(traceback.format_stack())}}
+
                 except Exception as e:
-                    resourceStatusReason = ""
+                    # If we are monitoring for the delete of the Stack then when it deletes we will get the stack not found exception and then we can return success. Otherwise it is an error and should be returned as such
+                    if stateToFind == "deletion":
+                        if "Stack [" + str(resourceId) + "] does not exist" in ''.join(traceback.format_exc()):
+                            print("The Cloud Formation Stack has been deleted successfully.")
+                            return {"status": "success", "payload": "The Cloud Formation Stack has been deleted successfully."}
                     print(traceback.format_exc())
-                if resourceType == 'AWS::CloudFormation::Stack':
-                    status = resourceStatus
-                print("ResourceStatusReason 1 is ")
-                print(resourceStatusReason)
-                # If waiting for create we need to monitor the state of the Stack, if waiting for deletion we need to wait until the stack is gone
-                if stateToFind == "creation":
-                    if status == "CREATE_COMPLETE":
-                        print("The Cloud Formation Stack has been created successfully.")
-                        return {"status": "success", "payload": "The Cloud Formation Stack has been created successfully."}
-                    elif status == "ROLLBACK_COMPLETE" or status == "ROLLBACK_FAILED":
-                        print("ResourceStatusReason 2 is ")
-                        print(resourceStatusReason)
-                        return {"status": "error", "payload": {"error": "The Cloud Formation Template failed to launch properly. The error associated with the Cloud Formation Template is: " + str(resourceStatusReason), "traceback": ''.join(traceback.format_stack())}}
-                    elif status == "CREATE_FAILED":
-                        return {"status": "error", "payload": {"error": "The Cloud Formation Template failed to launch properly. The error associated with the Cloud Formation Template is: " + str(resourceStatusReason), "traceback": ''.join(traceback.format_stack())}}
-
-                elif stateToFind == "deletion":
-                    if status == "DELETE_COMPLETE":
-                        return {"status": "success", "payload": "The Cloud Formation Stack has been deleted successfully."}
-                    elif status == "DELETE_FAILED":
-                        return {"status": "error", "payload": {"error": "The Cloud Formation Template failed to delete properly. The error associated with the Cloud Formation Template is: " + str(resourceStatusReason), "traceback": ''.join(traceback.format_stack())}}
+                    return {"status": "error", "payload": {"error": "Encountered an error when attempting to monitor the Cloud Formation Stack.", "traceback": ''.join(traceback.format_exc())}}
 
-            except Exception as e:
-                print(traceback.format_exc())
-                # If we are monitoring for the delete of the Stack then when it deletes we will get the stack not found exception and then we can return success. Otherwise it is an error and should be returned as such
-                if stateToFind == "deletion":
-                    if "Stack [" + str(resourceId) + "] does not exist" in ''.join(traceback.format_exc()):
-                        print("The Cloud Formation Stack has been deleted successfully.")
-                        return {"status": "success", "payload": "The Cloud Formation Stack has been deleted successfully."}
-
-                return {"status": "error", "payload": {"error": "Encountered an error when attempting to monitor the Cloud Formation Stack.", "traceback": ''.join(traceback.format_exc())}}
-
-            print("You have waited " + str(counter) + " minutes for the Control Resources to enter the requested state.")
-            counter += 1
-            if maxTimeToWait < timeElapsed:
-                done = True
-            time.sleep(timeToWait)
-            timeElapsed += timeToWait
-        if done:
-            # We ran out of time waiting for the stack to come up so we print the error and exit
-            return {"status": "error", "payload": {"error": "Encountered an error when attempting to monitor the Cloud Formation Stack. The Cloud Formation Stack did not reach the desired state before the timeout.", "traceback": ''.join(traceback.format_stack())}}
+                if len(newEvents) != 0:
+                    print("You have waited " + str(int(poll.elapsed() / 60)) + " minutes for the Control Resources to enter the requested state.")
+                if not poll.wait():
+                    # We ran out of time waiting for the stack to come up so we print the error and exit
+                    return {"status": "error", "payload": {"error": "Encountered an error when attempting to monitor the Cloud Formation Stack. The Cloud Formation Stack did not reach the desired state before the timeout (" + poll.describe() + ").", "traceback": ''.join(traceback.format_stack())}}
+        finally:
+            # Show which resources took the longest so slow Control Resource creations can be tracked down
+            self.controlResourceTimeline = follower.getTimeline()
+            if len(self.controlResourceTimeline) != 0:
+                print("Cloud Formation resource timeline (" + str(stateToFind) + "), slowest first:")
+                for entry in sorted(self.controlResourceTimeline, key=lambda entry: -(entry['seconds'] or 0)):
+                    print("    " + str(entry['logicalResourceId']) + " (" + str(entry['resourceType']) + "): " + str(entry['status']) + " after " + (("%.0f" % entry['seconds']) if entry['seconds'] is not None else "?") + " seconds")
 
     def getValue(self, valueToGet, resourceId):
         #Get the output value from the Cloud Formation Stack Outputs sections
@@ -209,35 +260,245 @@ class AwsResources(Resource):
         except Exception as e:
             return {"status": "error", "payload": {"error": "Encountered an error when attempting to retrieve the value from the Cloud Formation Stack.", "traceback": ''.join(traceback.format_exc())}}
 
-    def writeObjectsToDatabase(self, lookupTableObjectList, objectTableObjectList, lookupTableName, objectTableName):
-        client = None
-        lookupTable = None
-        objectTable = None
-
+    def getDatabaseUsage(self, tableNames, period=300):
+        # The provisioned throughput of each table along with the capacity it consumed (units per second) and the requests that were throttled over the last period seconds (see throughputManager)
         try:
-            session = boto3.Session(profile_name=self.profile)
-            client = session.resource('dynamodb', region_name=str(self.region))
+            dynamodb = self.createBotocoreClient("dynamodb")
+            if dynamodb['status'] != "success":
+                return {"status": "error", "payload": dynamodb['payload']}
+            cloudwatch = self.createBotocoreClient("cloudwatch")
+            if cloudwatch['status'] != "success":
+                return {"status": "error", "payload": cloudwatch['payload']}
+            dynamodb = dynamodb['payload']
+            cloudwatch = cloudwatch['payload']
+
+            usage = {}
+            queries = []
+            for index, tableName in enumerate(tableNames):
+                table = dynamodb.describe_table(TableName=str(tableName))['Table']
+                if table.get("BillingModeSummary", {}).get("BillingMode") == "PAY_PER_REQUEST":
+                    usage[str(tableName)] = {"provisionedRead": None, "provisionedWrite": None, "consumedRead": 0.0, "consumedWrite": 0.0, "readThrottles": 0, "writeThrottles": 0}
+                    continue
+                usage[str(tableName)] = {"provisionedRead": int(table['ProvisionedThroughput']['ReadCapacityUnits']), "provisionedWrite": int(table['ProvisionedThroughput']['WriteCapacityUnits']), "consumedRead": 0.0, "consumedWrite": 0.0, "readThrottles": 0, "writeThrottles": 0}
+                for field, metricName in [("consumedRead", "ConsumedReadCapacityUnits"), ("consumedWrite", "ConsumedWriteCapacityUnits"), ("readThrottles", "ReadThrottleEvents"), ("writeThrottles", "WriteThrottleEvents")]:
+                    queries.append({"Id": "m" + str(len(queries)), "Label": str(tableName) + "\n" + field, "MetricStat": {"Metric": {"Namespace": "AWS/DynamoDB", "MetricName": metricName, "Dimensions": [{"Name": "TableName", "Value": str(tableName)}]}, "Period": int(period), "Stat": "Sum"}, "ReturnData": True})
+
+            if len(queries) != 0:
+                endTime = datetime.datetime.now(datetime.timezone.utc)
+                startTime = endTime - datetime.timedelta(seconds=int(period))
+                labels = dict((query['Id'], query['Label']) for query in queries)
+                # get_metric_data takes up to 500 queries per call
+                for start in range(0, len(queries), 500):
+                    kwargs = {"MetricDataQueries": queries[start:start + 500], "StartTime": startTime, "EndTime": endTime}
+                    while True:
+                        response = cloudwatch.get_metric_data(**kwargs)
+                        for result in response.get("MetricDataResults", []):
+                            tableName, field = labels[result['Id']].split("\n")
+                            total = sum(result.get("Values", []))
+                            if field.startswith("consumed"):
+                                usage[tableName][field] += total / float(period)
+                            else:
+                                usage[tableName][field] += int(total)
+                        if response.get("NextToken") is None:
+                            break
+                        kwargs['NextToken'] = response['NextToken']
+            return {"status": "success", "payload": usage}
         except Exception as e:
-            return {"status": "success", "payload": {"error": "There was a problem obtaining the connection to DynamoDB.", "traceback": ''.join(traceback.format_exc())}}
+            return {"status": "error", "payload": {"error": "There was a problem obtaining the usage of the Database Tables.", "traceback": ''.join(traceback.format_exc())}}
 
+    def writeObjectsToDatabase(self, lookupTableObjectList, objectTableObjectList, lookupTableName, objectTableName, workers=8):
+        # The object lists can be any iterables (ex: generators reading a CSV file) so the rows are never all held in memory. Both tables are written at the same time by a shared pool of workers.
         try:
-            lookupTable = client.Table(str(lookupTableName))
-            objectTable = client.Table(str(objectTableName))
+            client = self.createBotocoreClient("dynamodb")
+            if client['status'] != "success":
+                return {"status": "error", "payload": client['payload']}
+            client = client['payload']
         except Exception as e:
-            return {"status": "success", "payload": {"error": "There was a problem connecting to the DynamoDB tables.", "traceback": ''.join(traceback.format_exc())}}
+            return {"status": "error", "payload": {"error": "There was a problem obtaining the connection to DynamoDB.", "traceback": ''.join(traceback.format_exc())}}
+
+        progress = DynamoDbProgress()
+        with ThreadPoolExecutor(max_workers=max(1, int(workers))) as executor:
+            writers = [DynamoDbTableWriter(client, lookupTableName, executor, int(workers), progress), DynamoDbTableWriter(client, objectTableName, executor, int(workers), progress)]
+            # Each table has its own thread reading its rows and handing batches to the workers
+            with ThreadPoolExecutor(max_workers=2) as readers:
+                futures = [fanOut.submit(readers, writers[0].write, lookupTableObjectList), fanOut.submit(readers, writers[1].write, objectTableObjectList)]
+                results = [future.result() for future in futures]
+        progress.report(force=True)
 
+        if results[0]['status'] != "success":
+            return {"status": "error", "payload": {"error": "There was a problem adding the provided data to the Lookup DynamoDB table. " + str(results[0]['payload']['error']), "traceback": results[0]['payload']['traceback']}}
+        if results[1]['status'] != "success":
+            return {"status": "error", "payload": {"error": "There was a problem adding the provided data to the Object DynamoDB table. " + str(results[1]['payload']['error']), "traceback": results[1]['payload']['traceback']}}
+        return {"status": "success", "payload": "Successfully pre-populated the Lookup and Object database tables with the provided information (" + progress.describe() + ")."}
+
+
+class StackEventFollower(object):
+    # Follows the events of a Cloud Formation Stack. Each poll() only reads the events that are newer than the last one it has seen (describe_stack_events returns the newest first, so the pages are read until a known event shows up).
+    # Events older than since (a datetime, ex: when a deletion was started) are ignored so an old Stack does not replay its whole history.
+    def __init__(self, client, stackName, since=None):
+        self.client = client
+        self.stackName = str(stackName)
+        self.since = since
+        self.lastEventId = None
+        self.stackStatus = None
+        self.failureReason = None
+        self.eventCount = 0
+        # {logicalResourceId: {"logicalResourceId", "resourceType", "status", "reason", "startTime", "endTime"}}
+        self.resources = {}
+
+    def isStackEvent(self, event):
+        # Nested Stacks have the same resource type but a PhysicalResourceId of their own
+        return event.get("ResourceType") == "AWS::CloudFormation::Stack" and event.get("PhysicalResourceId") == event.get("StackId")
+
+    def readNewEvents(self):
+        newEvents = []
+        kwargs = {"StackName": self.stackName}
+        while True:
+            response = self.client.describe_stack_events(**kwargs)
+            for event in response.get("StackEvents", []):
+                if event.get("EventId") == self.lastEventId:
+                    return newEvents
+                if self.since is not None and event.get("Timestamp") is not None and event['Timestamp'] < self.since:
+                    return newEvents
+                newEvents.append(event)
+            if response.get("NextToken") is None:
+                return newEvents
+            kwargs['NextToken'] = response['NextToken']
+
+    def poll(self):
+        # Returns the new events, oldest first
+        newEvents = list(reversed(self.readNewEvents()))
+        for event in newEvents:
+            self.consume(event)
+        if len(newEvents) != 0:
+            self.lastEventId = newEvents[-1].get("EventId")
+        return newEvents
+
+    def consume(self, event):
+        self.eventCount += 1
+        status = str(event.get("ResourceStatus"))
+        reason = event.get("ResourceStatusReason")
+        timestamp = event['Timestamp'].timestamp() if event.get("Timestamp") is not None else time.time()
+        logicalResourceId = str(event.get("LogicalResourceId"))
+        resource = self.resources.get(logicalResourceId)
+        if resource is None:
+            resource = {"logicalResourceId": logicalResourceId, "resourceType": event.get("ResourceType"), "status": None, "reason": None, "startTime": timestamp, "endTime": None}
+            self.resources[logicalResourceId] = resource
+        resource['status'] = status
+        if reason is not None:
+            resource['reason'] = reason
+        if status.endswith("_COMPLETE") or status.endswith("_FAILED"):
+            resource['endTime'] = timestamp
+
+        if self.isStackEvent(event):
+            self.stackStatus = status
+            if self.failureReason is None and status.endswith("_FAILED") and reason is not None:
+                self.failureReason = reason
+        elif status.endswith("_FAILED") and reason is not None and self.failureReason is None and "cancelled" not in str(reason):
+            # The first resource that failed is the cause, the failures that follow are usually cancellations
+            self.failureReason = str(logicalResourceId) + ": " + str(reason)
+
+    def describeEvent(self, event):
+        description = str(event.get("LogicalResourceId")) + " (" + str(event.get("ResourceType")) + ") " + str(event.get("ResourceStatus"))
+        if event.get("ResourceStatusReason") is not None:
+            description += ": " + str(event['ResourceStatusReason'])
+        return description
+
+    def getTimeline(self):
+        # One entry per resource in the order they started, seconds is None while the resource is still in progress
+        timeline = []
+        for resource in sorted(self.resources.values(), key=lambda resource: resource['startTime']):
+            entry = dict(resource)
+            entry['seconds'] = resource['endTime'] - resource['startTime'] if resource['endTime'] is not None else None
+            timeline.append(entry)
+        return timeline
+
+
+class DynamoDbProgress(object):
+    # Rows written per table, printed at most every interval seconds with the overall rows/s
+    def __init__(self, interval=30):
+        self.interval = float(interval)
+        self.rows = {}
+        self.startTime = time.monotonic()
+        self.lastReport = self.startTime
+        self.lock = threading.Lock()
+
+    def add(self, tableName, rows):
+        with self.lock:
+            self.rows[tableName] = self.rows.get(tableName, 0) + rows
+        self.report()
+
+    def describe(self):
+        with self.lock:
+            total = sum(self.rows.values())
+            tables = ", ".join(str(tableName) + ": " + str(rows) for tableName, rows in self.rows.items())
+        elapsed = max(time.monotonic() - self.startTime, 0.001)
+        return str(total) + " rows in " + str(int(elapsed)) + " seconds, " + str(int(total / elapsed)) + " rows/s (" + tables + ")"
+
+    def report(self, force=False):
+        with self.lock:
+            if not force and time.monotonic() - self.lastReport < self.interval:
+                return
+            self.lastReport = time.monotonic()
+        print("DynamoDB pre-population: " + self.describe())
+
+
+class DynamoDbTableWriter(object):
+    # Writes the rows of one table with batch_write_item (25 rows per request) spread over the shared executor. Only a few batches per worker are read ahead so memory stays flat no matter how many rows there are.
+    batchSize = 25
+
+    def __init__(self, client, tableName, executor, workers, progress):
+        self.client = client
+        self.tableName = str(tableName)
+        self.executor = executor
+        self.progress = progress
+        self.inFlight = threading.BoundedSemaphore(max(1, int(workers)) * 2)
+        self.serializer = TypeSerializer()
+        self.error = None
+
+    def serialize(self, item):
+        return {"PutRequest": {"Item": dict((str(key), self.serializer.serialize(value)) for key, value in item.items())}}
+
+    def writeBatch(self, requests):
         try:
-            with lookupTable.batch_writer() as batch:
-                for item in lookupTableObjectList:
-                    batch.put_item(Item=item)
+            # Throttled writes come back as UnprocessedItems, those are sent again with a growing (jittered) backoff
+            poll = poller.Poller("dynamoDbBatchWrite", timeout=600, maxInterval=20, initialInterval=0.05)
+            rows = len(requests)
+            while True:
+                try:
+                    response = self.client.batch_write_item(RequestItems={self.tableName: requests})
+                    requests = response.get("UnprocessedItems", {}).get(self.tableName, [])
+                except botocore.exceptions.ClientError as e:
+                    if e.response.get("Error", {}).get("Code") not in ["ProvisionedThroughputExceededException", "ThrottlingException", "RequestLimitExceeded", "InternalServerError"]:
+                        raise
+                if len(requests) == 0:
+                    self.progress.add(self.tableName, rows)
+                    return
+                if not poll.wait():
+                    raise Exception(str(len(requests)) + " rows were still unprocessed by DynamoDB after " + poll.describe() + ".")
         except Exception as e:
-            return {"status": "success", "payload": {"error": "There was a problem adding the provided data to the Lookup DynamoDB table.", "traceback": ''.join(traceback.format_exc())}}
+            if self.error is None:
+                self.error = {"error": "Unable to write a batch of rows to the " + self.tableName + " table.", "traceback": ''.join(traceback.format_exc())}
+        finally:
+            self.inFlight.release()
 
+    def write(self, items):
+        futures = []
         try:
-            with objectTable.batch_writer() as batch:
-                for item in objectTableObjectList:
-                    batch.put_item(Item=item)
+            iterator = iter(items)
+            while self.error is None:
+                batch = [self.serialize(item) for item in itertools.islice(iterator, self.batchSize)]
+                if len(batch) == 0:
+                    break
+                self.inFlight.acquire()
+                futures.append(fanOut.submit(self.executor, self.writeBatch, batch))
+                # Forget the batches that are already done so the list does not grow with the table
+                if len(futures) > 1000:
+                    futures = [future for future in futures if not future.done()]
         except Exception as e:
-            return {"status": "success", "payload": {"error": "There was a problem adding the provided data to the Object DynamoDB table.", "traceback": ''.join(traceback.format_exc())}}
-
-        return {"status": "success", "payload": "Successfully pre-populated the Lookup and Object database tables with the provided information."}
+            self.error = self.error or {"error": "Unable to read the rows for the " + self.tableName + " table.", "traceback": ''.join(traceback.format_exc())}
+        for future in futures:
+            future.result()
+        if self.error is not None:
+            return {"status": "error", "payload": self.error}
+        return {"status": "success", "payload": self.tableName}
@@ -3,7 +3,13 @@ import time
 import traceback
 import sys
 from resources import Resource 
-import googleapiclient.discovery
+
+import googleapiclient.errors
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '../Utilities'))
+import gcpClients
+import gcpOperations
+import poller
 
 
 class GcpResources(Resource):
@@ -11,19 +17,21 @@ class GcpResources(Resource):
         super(GcpResources, self).__init__(**kwargs)
 
     def createClient(self, service, version):
-        # Creating a GCP api client
+        # Getting a GCP api client, the clients are cached per thread and built from a discovery document that is only read once (see gcpClients)
         try:
-            compute = googleapiclient.discovery.build(service, version, cache_discovery=False)
+            compute = gcpClients.getClient(service, version)
             return {"status": "success", "payload": compute}
         except Exception as e:
             return {"status": "error", "payload": {"error": "There was an exception encountered when trying to obtain a google api session.", "traceback": ''.join(traceback.format_exc())}}
 
-    def getStartupKey(self, instance, options):
+    def getStartupKey(self, instance, options, wait=True, resourceId=None):
+        # With wait=False only one attempt is made, the caller does the retrying (see probes.ProbeSet)
+        # resourceId is only used on AWS, the instance name identifies the Control Node on GCP
         try:
             client = self.createClient("compute", "v1")["payload"]
             correct_key = None
-            counter = 0
-            while not correct_key and counter < 5:
+            poll = poller.Poller("getStartupKey", timeout=100, maxInterval=20)
+            while not correct_key:
                 request = client.instances().get(project=options['projectid'], zone=options['zone'], instance=instance)
                 response = request.execute()
                 metadata = response["metadata"]
@@ -32,8 +40,8 @@ class GcpResources(Resource):
                         if attribute["key"] == "startup_key":
                             correct_key = attribute["value"]
                             return {"status": "success", "payload": correct_key}
-                time.sleep(20)
-                counter += 1
+                if not wait or not poll.wait():
+                    break
             if not correct_key:
                 return {"status": "error", "payload": {"error": "startup_key not found", "traceback": "".join(traceback.format_stack())}}
         except Exception as e:
@@ -55,34 +63,45 @@ class GcpResources(Resource):
         body = self.makeBody(resourceName, options)
         instance = client.instances().insert(project=options['projectid'], zone=options['zone'], body=body)
         request = instance.execute()
-        response = self.createClient(service, version)
+
+        # Returns as soon as the insert operation is done (see gcpOperations)
+        values = gcpOperations.wait(options['projectid'], options['zone'], request['name'], timeout=1200)
+        if values['status'] != "success":
+            return values
+        print("GCP Control Node has been created")
+        # The instance can take a few seconds to show up as RUNNING after the insert operation is done
+        return self.getControlInstanceAddress(client, resourceName, options, timeout=60)
+
+    def getControlInstanceAddress(self, client, resourceName, options, timeout):
+        print("Obtaining the IP address from the " + str(resourceName) + " Control Resources.")
+        listPoll = poller.Poller("listControlInstance", timeout=timeout, maxInterval=10)
+        result = client.instances().list(project=options['projectid'], zone=options['zone'], filter='(status eq RUNNING) (name eq ' + str(resourceName) + ')').execute()
+        while len(result.get('items', [])) == 0 and listPoll.wait():
+            result = client.instances().list(project=options['projectid'], zone=options['zone'], filter='(status eq RUNNING) (name eq ' + str(resourceName) + ')').execute()
+        if len(result.get('items', [])) == 0:
+            return {"status": "error", "payload": {"error": "The Control Node " + str(resourceName) + " was not running before the timeout (" + listPoll.describe() + ").", "traceback": ''.join(traceback.format_stack())}}
+        #print str(result)
+        remoteIp = result['items'][0]['networkInterfaces'][0]['accessConfigs'][0]['natIP']
+        instance = result["items"][0]["name"]
+        #return {"status": "success", "payload": request['name'], "controlIP": str(remoteIp)}
+        return {"status": "success", "payload": str(remoteIp), "instance": instance}
+
+    def resumeControlResources(self, resourceName, options):
+        # Picks up a Control Node whose creation was interrupted: an instance that already exists is waited on until it is RUNNING, the insert is only sent again if the instance was never created
+        response = self.createClient("compute", "v1")
         if response['status'] != "success":
-            return{"status": "error"}
+            return {"status": "error", "payload": response['payload']}
         else:
             client = response['payload']
-
-        counter = 0
-        while True:
-            result = client.zoneOperations().get(project=options['projectid'], zone=options['zone'], operation=str(request['name'])).execute()
-            if result['status'] == 'DONE':
-                print("GCP Control Node has been created")
-                if "error" in result:
-                    return {"status": "error", "payload": {"error": str(result['error']), "traceback": ''.join(traceback.format_stack())}}
-                else:
-                    print("Obtaining the IP address from the " + str(resourceName) + " Control Resources.")
-                    time.sleep(10)
-                    response = self.createClient(service, version)
-                    client = response['payload']
-                    result = client.instances().list(project=options['projectid'], zone=options['zone'], filter='(status eq RUNNING) (name eq ' + str(resourceName) + ')').execute()
-                    #print str(result)
-                    remoteIp = result['items'][0]['networkInterfaces'][0]['accessConfigs'][0]['natIP']
-                    instance = result["items"][0]["name"]
-                    #return {"status": "success", "payload": request['name'], "controlIP": str(remoteIp)}
-                    return {"status": "success", "payload": str(remoteIp), "instance": instance}
-            else:
-                print("You have waited " + str(counter) + " minutes for the Control Resources to enter the requested state.")
-                counter += 1
-            time.sleep(60)
+        try:
+            client.instances().get(project=options['projectid'], zone=options['zone'], instance=resourceName).execute()
+        except googleapiclient.errors.HttpError as e:
+            if e.status_code != 404:
+                return {"status": "error", "payload": {"error": "Unable to look up the Control Node " + str(resourceName) + ".", "traceback": ''.join(traceback.format_exc())}}
+            print("The Control Node " + str(resourceName) + " was never created, creating it now.")
+            return self.createControlResources(None, resourceName, options)
+        print("The Control Node " + str(resourceName) + " already exists, waiting for it to be running.")
+        return self.getControlInstanceAddress(client, resourceName, options, timeout=1200)
 
     #####Delete the Google Cloud control node with the web route.  
     def deleteControlResources(self, resourceName, options):
@@ -94,14 +113,11 @@ class GcpResources(Resource):
         params = {}
         instance = client.instances().delete(project=options['projectid'], zone=options['zone'], instance=resourceName)
         request = instance.execute()
-        while True:
-            result = client.zoneOperations().get(project=options['projectid'], zone=options['zone'], operation=request['name']).execute()
-            if result['status'] == 'DONE':
-                print("GCP Control Node has been Deleted")
-                if "error" in result:
-                    return {"status": "error", "payload": {"error": str(result['error']), "traceback": ''.join(traceback.format_stack())}}
-                else:
-                    return {"status": "success", "payload": request['name']}        
+        values = gcpOperations.wait(options['projectid'], options['zone'], request['name'], timeout=1200)
+        if values['status'] != "success":
+            return values
+        print("GCP Control Node has been Deleted")
+        return {"status": "success", "payload": request['name']}
 
     def makeBody(self, resourceName, options):
         with open(str(options['pubkeypath']), 'r') as f:
@@ -19,6 +19,9 @@ class Resource(object):
     def deleteControlResources(self, **kwargs):
         return {"status": "error", "payload": "Base Resource Class method deleteControlResources not implemented for " + str(self.cloudType) + "."}
 
+    def resumeControlResources(self, **kwargs):
+        return {"status": "error", "payload": "Base Resource Class method resumeControlResources not implemented for " + str(self.cloudType) + "."}
+
     def monitorControlResources(self, **kwargs):
         return {"status": "error", "payload": "Base Resource Class method monitorControlResources not implemented for " + str(self.cloudType) + "."}
 
@@ -27,3 +30,6 @@ class Resource(object):
 
     def writeObjectsToDatabase(self, **kwargs):
         return {"status": "error", "payload": "Base Resource Class method writeObjectsToDatabase not implemented for " + str(self.cloudType) + "."}
+
+    def getDatabaseUsage(self, **kwargs):
+        return {"status": "error", "payload": "Base Resource Class method getDatabaseUsage not implemented for " + str(self.cloudType) + "."}
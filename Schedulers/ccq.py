@@ -10,15 +10,22 @@
 import sys
 import os
 import hashlib
-import requests
-import json
 import traceback
 import subprocess
 import io
+import threading
+import time
 
 from scheduler import Scheduler
 
 sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(os.path.join(os.path.dirname(__file__), '../Utilities'))
+import apiKeyCache
+import responseModels
+
+# Bulk ccqstat results shared by every Ccq object, keyed by Login Instance, scheduler name and user
+statusCaches = {}
+statusCachesLock = threading.Lock()
 
 
 class Ccq(Scheduler):
@@ -26,6 +33,13 @@ class Ccq(Scheduler):
     def __init__(self, **kwargs):
         super(Ccq, self).__init__(**kwargs)
 
+        # How long (in seconds) one bulk ccqstat listing can answer the status requests of the other jobs
+        self.statusCacheMaxAge = 5
+
+        # SSH transports that already have the API key file uploaded, a batch of job scripts can share one transport
+        self.keyFileTransports = set()
+        self.keyFileLock = threading.Lock()
+
     def generateParentJobScriptHeader(self, numNodes, numCores, wallTime):
         print("Not yet implemented.")
         return {"status": "success", "payload": "Not yet implemented."}
@@ -56,14 +70,13 @@ class Ccq(Scheduler):
             return {"status": "error", "payload": "There was a problem trying to get the Login Instance's DNS name that is required to submit the job."}
         else:
             ccqsubURL = "https://" + str(loginDomainName) + "/srv/ccqsub"
-            results = requests.post(ccqsubURL, cookies=sessionCookies, json=final)
+            results = self.getHttpSession(loginDomainName).post(ccqsubURL, cookies=sessionCookies, json=final)
 
-            jobOutput = json.loads(results.content)
-            if jobOutput['status'] == "success":
-                jobId = jobOutput['payload']['message'].split(":")[1][1:5]
-                return {"status": "success", "payload": {"message": "The job has been successfully submitted to ccq.", "jobId": str(jobId)}}
+            submitResult = responseModels.CcqSubmitResult.parse(results)
+            if submitResult.success:
+                return {"status": "success", "payload": {"message": "The job has been successfully submitted to ccq.", "jobId": str(submitResult.jobId)}}
             else:
-                return {"status": "error", "payload": {"error": jobOutput['payload'], "traceback": ''.join(traceback.format_stack())}}
+                return {"status": "error", "payload": {"error": submitResult.error, "traceback": ''.join(traceback.format_stack())}}
 
     def generateCcqSubmitParameters(self, environment, jobWorkDir, jobScriptText, options):
         # We have to build the object that the ccqsub utility would have built for us. This allows for the dynamic creation of the instances.
@@ -102,6 +115,14 @@ class Ccq(Scheduler):
         return {"status": "success", "payload": {"ccOptionsParsed": ccOptionsParsed, "jobMD5Hash": newJobScriptMD5Hash}}
 
     def getOrGenerateApiKey(self, environment):
+        # The key is looked up (or generated) once per Control Node and user and then shared by every Ccq object, concurrent submissions wait for the first lookup instead of all making their own
+        values = apiKeyCache.get(environment.dnsName, environment.userName, lambda: self.lookUpOrGenerateApiKey(environment))
+        if values['status'] != "success":
+            return values
+        self.apiKey = values['payload']
+        return {"status": "success", "payload": self.apiKey}
+
+    def lookUpOrGenerateApiKey(self, environment):
         # Need to get the CC Access Key for the username provided, if none exist then we need to generate one for them and use it
         apiKey = None
         values = environment.getApiKey()
@@ -116,60 +137,145 @@ class Ccq(Scheduler):
                     return {"status": "error", "payload": {"error": "There was a problem obtaining the newly generated API key.", "traceback": values['payload']['traceback']}}
                 else:
                     apiKey = values['payload']
-                    self.apiKey = apiKey
                     return {"status": "success", "payload": apiKey}
         else:
             # We got our API key and don't need to generate a new one
             apiKey = values['payload']
-            self.apiKey = apiKey
             return {"status": "success", "payload": apiKey}
 
-    def getJobStatus(self, environment, jobId, schedulerName, loginDNS):
+    def getApiKeyForStatus(self, environment):
         # Need to get the CC Access Key for the username provided, if none exist then we need to generate one for them and use it
-        apiKey = None
         if self.apiKey is None:
             values = self.getOrGenerateApiKey(environment)
             if values['status'] != "success":
                 return values
-            else:
-                apiKey = values['payload']
+            return {"status": "success", "payload": values['payload']}
         else:
             # We have already retrieved the API key so we no longer have to go get it.
-            apiKey = self.apiKey
-
-        # Now that we have the API key we can move on to getting the actual job status
+            return {"status": "success", "payload": self.apiKey}
+
+    def isApiKeyRejected(self, message):
+        # ccq answers a request made with a key it does not know with a message saying the key is not valid
+        message = str(message).lower()
+        return "key" in message and ("not valid" in message or "invalid" in message)
+
+    def refreshApiKey(self, environment, rejectedKey):
+        # The cached key (possibly loaded from disk by an earlier invocation) was rejected, drop it and look up or generate a fresh one
+        print("ccq did not accept the cached API key for " + str(environment.userName) + ", looking up a new one.")
+        apiKeyCache.reject(environment.dnsName, environment.userName, rejectedKey)
+        self.apiKey = None
+        with self.keyFileLock:
+            self.keyFileTransports = set()
+        return self.getOrGenerateApiKey(environment)
+
+    def generateCcqstatRequest(self, jobId, verbose, schedulerName, apiKey, remoteUserName):
         encodedUserName = ""
         encodedPassword = ""
         valKey = ""
         dateExpires = ""
         certLength = 1
 
-        final = {"jobId": str(jobId), "userName": str(encodedUserName), "password": str(encodedPassword), "verbose": False, "instanceId": None, "jobNameInScheduler": None, "schedulerName": str(schedulerName), "schedulerHostName": None, 'schedulerType': None, 'schedulerInstanceId': None, 'schedulerInstanceName': None, 'schedulerInstanceIp': None, "printJobOwner": "False", "printSubmissionTime": "False", "printDispatchTime": "False", "printSubmitHost": "False", "printNumCPUs": "False", 'printErrors': "False", "valKey": str(valKey), "dateExpires": str(dateExpires), "certLength": str(certLength), "jobInfoRequest": False, "ccAccessKey": str(apiKey), "printOutputLocation": "False", "printInstancesForJob": "False", "remoteUserName": environment.userName, "databaseInfo": None}
+        return {"jobId": str(jobId), "userName": str(encodedUserName), "password": str(encodedPassword), "verbose": verbose, "instanceId": None, "jobNameInScheduler": None, "schedulerName": str(schedulerName), "schedulerHostName": None, 'schedulerType': None, 'schedulerInstanceId': None, 'schedulerInstanceName': None, 'schedulerInstanceIp': None, "printJobOwner": "False", "printSubmissionTime": "False", "printDispatchTime": "False", "printSubmitHost": "False", "printNumCPUs": "False", 'printErrors': "False", "valKey": str(valKey), "dateExpires": str(dateExpires), "certLength": str(certLength), "jobInfoRequest": False, "ccAccessKey": str(apiKey), "printOutputLocation": "False", "printInstancesForJob": "False", "remoteUserName": remoteUserName, "databaseInfo": None}
+
+    def parseCcqstatTable(self, message):
+        # Returns {jobId: (jobState, jobName)} for the rows of a ccqstat table
+        rows = responseModels.CcqstatResult.parseTable(message)
+        return dict((jobId, (row.state, row.name)) for jobId, row in rows.items())
+
+    def getJobStatuses(self, environment, schedulerName, loginDNS, maxAge=None):
+        # Returns {jobId: (jobState, jobName)} for every job of the user in one ccqstat round trip. Results are shared by all Ccq objects polling the same Login Instance for up to maxAge seconds and only one request is in flight per Login Instance at a time.
+        if maxAge is None:
+            maxAge = self.statusCacheMaxAge
+        key = (str(loginDNS), str(schedulerName), str(environment.userName))
+        with statusCachesLock:
+            cache = statusCaches.get(key)
+            if cache is None:
+                cache = {"lock": threading.Lock(), "time": None, "payload": None}
+                statusCaches[key] = cache
+
+        with cache["lock"]:
+            if cache["time"] is not None and time.monotonic() - cache["time"] < float(maxAge):
+                return {"status": "success", "payload": cache["payload"]}
+
+            values = self.getApiKeyForStatus(environment)
+            if values['status'] != "success":
+                return values
+            apiKey = values['payload']
 
+            ccqstatURL = "https://" + str(loginDNS) + "/srv/ccqstat"
+            for attempt in range(2):
+                final = self.generateCcqstatRequest("all", False, schedulerName, apiKey, environment.userName)
+                try:
+                    results = self.getHttpSession(loginDNS).post(ccqstatURL, cookies=environment.sessionCookies, json=final)
+                    ccqstatResult = responseModels.CcqstatResult.parse(results)
+                except Exception as e:
+                    return {"status": "error", "payload": {"error": "There was a problem retrieving the status of the jobs from ccq.", "traceback": ''.join(traceback.format_exc())}}
+                if ccqstatResult.success or attempt > 0 or not self.isApiKeyRejected(ccqstatResult.error):
+                    break
+                values = self.refreshApiKey(environment, apiKey)
+                if values['status'] != "success":
+                    return values
+                apiKey = values['payload']
+
+            if not ccqstatResult.success:
+                return {"status": "error", "payload": ccqstatResult.error}
+
+            jobStatuses = dict((jobId, (row.state, row.name)) for jobId, row in ccqstatResult.rows.items())
+            cache["time"] = time.monotonic()
+            cache["payload"] = jobStatuses
+            return {"status": "success", "payload": jobStatuses}
+
+    def getJobStatus(self, environment, jobId, schedulerName, loginDNS):
+        values = self.getJobStatuses(environment, schedulerName, loginDNS)
+        if values['status'] == "success" and str(jobId) in values['payload']:
+            jobState, jobName = values['payload'][str(jobId)]
+            return {"status": "success", "payload": {"jobState": jobState, "jobName": jobName}}
+
+        # The job is not in the bulk listing (or the listing failed) so ask ccq about this specific job
+        return self.getSingleJobStatus(environment, jobId, schedulerName, loginDNS)
+
+    def getSingleJobStatus(self, environment, jobId, schedulerName, loginDNS):
+        values = self.getApiKeyForStatus(environment)
+        if values['status'] != "success":
+            return values
+        apiKey = values['payload']
+
+        # Now that we have the API key we can move on to getting the actual job status
         ccqstatURL = "https://" + str(loginDNS) + "/srv/ccqstat"
-        results = requests.post(ccqstatURL, cookies=environment.sessionCookies, json=final)
+        for attempt in range(2):
+            final = self.generateCcqstatRequest(jobId, False, schedulerName, apiKey, environment.userName)
+            results = self.getHttpSession(loginDNS).post(ccqstatURL, cookies=environment.sessionCookies, json=final)
+            ccqstatResult = responseModels.CcqstatResult.parse(results)
+            if ccqstatResult.success or attempt > 0 or not self.isApiKeyRejected(ccqstatResult.error):
+                break
+            values = self.refreshApiKey(environment, apiKey)
+            if values['status'] != "success":
+                return values
+            apiKey = values['payload']
 
-        jobOutput = json.loads(results.content)
-        if jobOutput['status'] == "success":
+        if ccqstatResult.success:
             # Check and make sure the job was not deleted at some point
-            if "The specified job Id does not exist in the database." not in str(jobOutput['payload']['message']):
-                splitText = jobOutput['payload']['message'].split("\n")[2].split()
-                jobState = splitText[4].replace("\n", "")
-                jobName = splitText[1].replace("\n", "")
-                return {"status": "success", "payload": {"jobState": jobState, "jobName": jobName}}
+            # Only the row of this job counts, a listing without it means the job is gone
+            row = ccqstatResult.rows.get(str(jobId))
+            if not ccqstatResult.jobMissing() and row is not None:
+                return {"status": "success", "payload": {"jobState": row.state, "jobName": row.name}}
             else:
                 return {"status": "error", "payload": "The job no longer exists within ccq, it was probably deleted by someone using the ccqdel command within the CloudyCluster Environments."}
         else:
-            return {"status": "error", "payload": jobOutput['payload']}
+            return {"status": "error", "payload": ccqstatResult.error}
 
-    def submitJobCommandLine(self, jobScriptLocation, jobScriptInfo):
+    def submitJobCommandLine(self, jobScriptLocation, jobScriptInfo, retryRejectedKey=True):
         try:
-            file_name = self.apiKey.split(":")[0] + ".key"
+            apiKey = self.apiKey
+            file_name = apiKey.split(":")[0] + ".key"
 
-            client_session = jobScriptInfo.createSftpSession()["payload"]
-            f = io.StringIO(self.apiKey)
-            client_session.putfo(f, file_name)
-            client_session.close()
+            with self.keyFileLock:
+                if jobScriptInfo.transport not in self.keyFileTransports:
+                    client_session = jobScriptInfo.createSftpSession()["payload"]
+                    f = io.StringIO(apiKey)
+                    client_session.putfo(f, file_name)
+                    client_session.close()
+                    self.keyFileTransports.add(jobScriptInfo.transport)
 
             values = jobScriptInfo.executeCommand("ccqsub -js " + str(jobScriptLocation) + " -i " + file_name)
             if values['status'] != "success":
@@ -179,6 +285,11 @@ class Ccq(Scheduler):
                     jobId = str(values['payload']['stdout']).split("job id is: ")[1].split(" ")[0]
                     schedulerName = str(values['payload']['stdout']).split("been submitted to the scheduler ")[1].split(" ")[0]
                     return {"status": "success", "payload": {"jobId": str(jobId), "schedulerName": str(schedulerName), "message": values['payload']['stdout']}}
-                return values
+                if retryRejectedKey and self.isApiKeyRejected(values['payload']['stdout'] + values['payload']['stderr']):
+                    values = self.refreshApiKey(jobScriptInfo.environment, apiKey)
+                    if values['status'] != "success":
+                        return values
+                    return self.submitJobCommandLine(jobScriptLocation, jobScriptInfo, retryRejectedKey=False)
+                return {"status": "error", "payload": {"error": "ccqsub did not submit the job: " + str(values['payload']['stdout']) + str(values['payload']['stderr']), "traceback": ''.join(traceback.format_stack())}}
         except Exception as e:
             return {"status": "error", "payload": {"error": "There was a problem encountered when trying to submit the job to the ccq scheduler.", "traceback": ''.join(traceback.format_exc(e))}}
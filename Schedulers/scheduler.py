@@ -6,6 +6,12 @@
 # https://www.gnu.org/licenses/old-licenses/lgpl-2.0.txt>, at your option.
 # This file may not be copied, modified, or distributed except according to those terms.
 
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '../Utilities'))
+import httpSessions
+
 
 class Scheduler(object):
 
@@ -15,6 +21,10 @@ class Scheduler(object):
         # Placeholder for API Key that can be used to submit things to the scheduler
         self.apiKey = None
 
+    def getHttpSession(self, host):
+        # Schedulers share the same pooled sessions as the Environment classes so the Login Instance connections stay open between polls
+        return httpSessions.getSession(host)
+
     def generateParentJobScriptHeader(self, **kwargs):
         return {"status": "error", "payload": "Base Scheduler Class method generateParentJobScriptHeader not implemented for " + str(self.schedType) + "."}
 
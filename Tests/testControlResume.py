@@ -0,0 +1,100 @@
+# Copyright 2017
+#
+# Licensed under the Apache License, Version 2.0, <LICENSE-APACHE or
+# http://apache.org/licenses/LICENSE-2.0> or the MIT license <LICENSE-MIT or
+# http://opensource.org/licenses/MIT> or the LGPL, Version 2.0 <LICENSE-LGPLv2 or
+# https://www.gnu.org/licenses/old-licenses/lgpl-2.0.txt>, at your option.
+# This file may not be copied, modified, or distributed except according to those terms.
+
+
+# Resuming an interrupted AWS Control Resource creation (--resume) against stubbed Cloud Formation and EC2 clients.
+# Run with: python -m unittest discover -s Tests -p "test*.py"
+
+import datetime
+import os
+import sys
+import unittest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "Environments"))
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "Resources"))
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "Utilities"))
+
+import awsResources
+import cloudycluster
+
+region = "us-east-1"
+stackId = "arn:aws:cloudformation:us-east-1:123456789012:stack/ctl-resumed/0a1b2c3d"
+instanceId = "i-0a1b2c3d4e5f"
+startupKey = "resumedStartupKey"
+
+
+class StubCloudFormation(object):
+    def __init__(self):
+        self.stackNames = []
+
+    def create_stack(self, **kwargs):
+        raise AssertionError("A resumed creation must not create a new Stack.")
+
+    def describe_stacks(self, StackName):
+        self.stackNames.append(StackName)
+        return {"Stacks": [{"StackId": stackId, "Outputs": [{"OutputKey": "InstanceID", "OutputValue": instanceId}, {"OutputKey": "InstanceIP", "OutputValue": "10.0.0.5"}]}]}
+
+    def describe_stack_events(self, StackName, NextToken=None):
+        self.stackNames.append(StackName)
+        return {"StackEvents": [{"EventId": "1", "StackId": stackId, "PhysicalResourceId": stackId, "LogicalResourceId": "ctl-resumed", "ResourceType": "AWS::CloudFormation::Stack", "ResourceStatus": "CREATE_COMPLETE", "Timestamp": datetime.datetime.now(datetime.timezone.utc)}]}
+
+
+class StubEc2(object):
+    def __init__(self):
+        self.resourceIds = []
+
+    def describe_tags(self, Filters):
+        self.resourceIds.extend(Filters[0]['Values'])
+        return {"Tags": [{"Key": "startup_key", "Value": startupKey}]}
+
+
+class ControlResumeTest(unittest.TestCase):
+    def setUp(self):
+        self.cloudFormation = StubCloudFormation()
+        self.ec2 = StubEc2()
+        self.savedClients = dict(awsResources.botocoreClients)
+        awsResources.botocoreClients[("cloudformation", region, "default")] = self.cloudFormation
+        awsResources.botocoreClients[("ec2", region, "default")] = self.ec2
+
+        self.environment = cloudycluster.CloudyCluster(environmentType="CloudyCluster", name="resumed", cloudType="aws", userName="user", password="password", controlParameters={"region": region}, ccEnvironmentParameters={}, generalParameters={}, firstName="first", lastName="last", pempath=None, region=region, profile=None)
+        # The Control Node itself is not part of the test
+        self.validatedKeys = []
+        self.environment.getControlDns = lambda ipAddress: self.setDnsName("ctl-resumed.example.com")
+        self.environment.requestDatabaseTableNames = lambda: {"status": "success", "payload": ["table"]}
+        self.environment.validateControl = lambda resourceClass, instance, startupKey=None, resourceId=None: self.validatedKeys.append(startupKey) or {"status": "success", "payload": None}
+        self.environment.getSession = lambda useCache=True: {"status": "success", "payload": None}
+        self.environment.genApiKey = lambda: {"status": "success", "payload": None}
+        self.environment.writeOutEfsObjectToDb = lambda: {"status": "success", "payload": None}
+
+    def tearDown(self):
+        awsResources.botocoreClients.clear()
+        awsResources.botocoreClients.update(self.savedClients)
+
+    def setDnsName(self, dnsName):
+        self.environment.dnsName = dnsName
+        return {"status": "success", "payload": dnsName}
+
+    def testResumeFindsTheStartupKeyOfTheExistingStack(self):
+        values = self.environment.createSingleControl(None, "ctl-resumed", resourceId=stackId)
+        self.assertEqual(values['status'], "success", values)
+        self.assertEqual(values['payload'], "ctl-resumed.example.com")
+        self.assertEqual(self.environment.controlStack, stackId)
+        self.assertEqual(set(self.cloudFormation.stackNames), set([stackId]))
+        self.assertIn(instanceId, self.ec2.resourceIds)
+        self.assertEqual(self.validatedKeys, [startupKey])
+
+    def testStartupKeyNeedsAStackId(self):
+        resourceClass = awsResources.AwsResources(cloudType="aws", region=region)
+        values = resourceClass.getStartupKey("ctl-resumed", {}, wait=False)
+        self.assertEqual(values['status'], "error")
+        self.assertTrue(values.get("final"))
+        self.assertEqual(self.cloudFormation.stackNames, [])
+
+
+if __name__ == "__main__":
+    unittest.main()
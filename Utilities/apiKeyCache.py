@@ -0,0 +1,157 @@
+# Copyright 2017
+#
+# Licensed under the Apache License, Version 2.0, <LICENSE-APACHE or
+# http://apache.org/licenses/LICENSE-2.0> or the MIT license <LICENSE-MIT or
+# http://opensource.org/licenses/MIT> or the LGPL, Version 2.0 <LICENSE-LGPLv2 or
+# https://www.gnu.org/licenses/old-licenses/lgpl-2.0.txt>, at your option.
+# This file may not be copied, modified, or distributed except according to those terms.
+
+
+import glob
+import hashlib
+import json
+import os
+import threading
+import traceback
+
+
+# The CC API key of a user on a Control Node does not change once it has been generated, so it is looked up once per (Control Node, user) and shared by every job submission in the process.
+# Only one thread looks up (or generates) a key at a time, the others wait for its result. Keys can also be kept on disk so later invocations skip the lookup altogether.
+
+
+class ApiKeyCache(object):
+    def __init__(self, directory=None):
+        # Keys are only written to disk when a directory is configured
+        self.directory = directory
+        self.keys = {}
+        self.resolveLocks = {}
+        self.lock = threading.Lock()
+
+    def configure(self, directory=None):
+        with self.lock:
+            if directory is not None:
+                self.directory = os.path.expanduser(str(directory)) if str(directory) != "" else None
+
+    def getResolveLock(self, key):
+        with self.lock:
+            if key not in self.resolveLocks:
+                self.resolveLocks[key] = threading.Lock()
+            return self.resolveLocks[key]
+
+    def getPath(self, key):
+        return os.path.join(self.directory, hashlib.sha256("\n".join(key).encode()).hexdigest() + ".json")
+
+    def loadFromDisk(self, key):
+        if self.directory is None:
+            return None
+        try:
+            with open(self.getPath(key), "r") as f:
+                entry = json.load(f)
+            if [entry['dnsName'], entry['userName']] == list(key):
+                return entry['apiKey']
+        except Exception as e:
+            pass
+        return None
+
+    def saveToDisk(self, key, apiKey):
+        if self.directory is None:
+            return
+        path = self.getPath(key)
+        temporaryPath = path + "." + str(os.getpid()) + "." + str(threading.get_ident())
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory, mode=0o700)
+            descriptor = os.open(temporaryPath, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(descriptor, "w") as f:
+                json.dump({"dnsName": key[0], "userName": key[1], "apiKey": apiKey}, f)
+            os.replace(temporaryPath, path)
+        except Exception as e:
+            print("Unable to save the API key for " + str(key[1]) + " to " + str(self.directory) + ".")
+            print(''.join(traceback.format_exc()))
+            try:
+                os.remove(temporaryPath)
+            except Exception as e:
+                pass
+
+    def get(self, dnsName, userName, resolve):
+        # resolve() returns the usual {"status": ..., "payload": apiKey} dictionary and is only called when the key is not cached
+        key = (str(dnsName), str(userName))
+        with self.lock:
+            apiKey = self.keys.get(key)
+        if apiKey is not None:
+            return {"status": "success", "payload": apiKey}
+        with self.getResolveLock(key):
+            with self.lock:
+                apiKey = self.keys.get(key)
+            if apiKey is None:
+                apiKey = self.loadFromDisk(key)
+            if apiKey is None:
+                values = resolve()
+                if values['status'] != "success":
+                    return values
+                apiKey = values['payload']
+                self.saveToDisk(key, apiKey)
+            with self.lock:
+                self.keys[key] = apiKey
+            return {"status": "success", "payload": apiKey}
+
+    def invalidate(self, dnsName, userName=None):
+        # Without a userName the keys of every user on the Control Node are dropped (ex: when the Control Resources are deleted), including the ones saved on disk by other invocations
+        with self.lock:
+            keys = [key for key in self.keys if key[0] == str(dnsName) and (userName is None or key[1] == str(userName))]
+            for key in keys:
+                self.keys.pop(key, None)
+        if self.directory is None:
+            return
+        if userName is not None:
+            self.removeFromDisk((str(dnsName), str(userName)))
+            return
+        # The files are named after a hash of the Control Node and the user so every file has to be opened to find the ones of this Control Node
+        for path in glob.glob(os.path.join(self.directory, "*.json")):
+            try:
+                with open(path, "r") as f:
+                    entry = json.load(f)
+                if entry.get("dnsName") == str(dnsName):
+                    os.remove(path)
+            except Exception as e:
+                pass
+
+    def reject(self, dnsName, userName, apiKey):
+        # Called when ccq did not accept apiKey (ex: a key saved on disk for a Control Node that was replaced under the same DNS name). The key is only dropped if it is still the cached one, so a fresh key that another thread already looked up is kept.
+        key = (str(dnsName), str(userName))
+        with self.getResolveLock(key):
+            with self.lock:
+                if self.keys.get(key) not in (None, apiKey):
+                    return
+                self.keys.pop(key, None)
+            if self.directory is not None and self.loadFromDisk(key) == apiKey:
+                self.removeFromDisk(key)
+
+    def removeFromDisk(self, key):
+        try:
+            os.remove(self.getPath(key))
+        except Exception as e:
+            pass
+
+
+# Process wide cache shared by all of the Scheduler objects
+apiKeyCache = ApiKeyCache()
+
+
+def configureFromParameters(parameters):
+    # Reads the optional apiKeyCacheDirectory field from a configuration file section (normally General)
+    if not parameters:
+        return
+    apiKeyCache.configure(directory=parameters.get("apikeycachedirectory"))
+
+
+def get(dnsName, userName, resolve):
+    return apiKeyCache.get(dnsName, userName, resolve)
+
+
+def invalidate(dnsName, userName=None):
+    apiKeyCache.invalidate(dnsName, userName)
+
+
+def reject(dnsName, userName, apiKey):
+    apiKeyCache.reject(dnsName, userName, apiKey)
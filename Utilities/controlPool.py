@@ -0,0 +1,142 @@
+# Copyright 2017
+#
+# Licensed under the Apache License, Version 2.0, <LICENSE-APACHE or
+# http://apache.org/licenses/LICENSE-2.0> or the MIT license <LICENSE-MIT or
+# http://opensource.org/licenses/MIT> or the LGPL, Version 2.0 <LICENSE-LGPLv2 or
+# https://www.gnu.org/licenses/old-licenses/lgpl-2.0.txt>, at your option.
+# This file may not be copied, modified, or distributed except according to those terms.
+
+
+import hashlib
+import hmac
+import json
+import os
+import secrets
+import time
+
+
+# A pool of validated Control Resources that are kept running between runs. A run leases a Control Node instead of creating one (cc) and hands it back instead of deleting it (dc).
+# The pool lives in the run state database (see stateStore.py) so every ccAutomaton process on the machine shares it, leases are taken inside a transaction so two runs never get the same Control Node.
+#
+# status is one of:
+#     available  - validated and idle, can be leased
+#     leased     - in use by the run in leasedBy until leaseExpiresAt
+#     expiring   - idle for longer than the idle timeout and being deleted
+#     abandoned  - the lease ran out without the run handing the Control Node back (ex: it crashed), it may still have that run's Environments so it needs to be checked and cleaned up by hand
+#     unhealthy  - failed a health check or could not be deleted, needs to be cleaned up by hand
+
+# The poolKey is an HMAC of the configuration keyed with a secret that is created once per machine, so the password that is part of the configuration is never stored
+defaultSecretPath = os.path.join(os.path.expanduser("~"), ".ccAutomaton", "controlPoolSecret")
+
+
+def getSecret(path=None):
+    if path is None:
+        path = defaultSecretPath
+    try:
+        with open(path, "r") as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        pass
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+    try:
+        # O_EXCL so two runs starting at the same time end up with the same secret
+        descriptor = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(descriptor, "w") as f:
+            f.write(secrets.token_hex(32))
+    except FileExistsError:
+        pass
+    with open(path, "r") as f:
+        return f.read().strip()
+
+
+def makePoolKey(values, secretPath=None):
+    return hmac.new(getSecret(secretPath).encode(), json.dumps(values, default=str).encode(), hashlib.sha256).hexdigest()
+
+
+class ControlPool(object):
+    def __init__(self, store, poolKey, size=1, idleTimeout=3600, leaseTimeout=86400):
+        # Only Control Resources created from the same configuration (cloud, region, profile, user and Control parameters) share a poolKey and can be swapped for each other
+        self.store = store
+        self.poolKey = str(poolKey)
+        self.size = int(size)
+        self.idleTimeout = float(idleTimeout)
+        self.leaseTimeout = float(leaseTimeout)
+
+    def transaction(self, statements):
+        # statements is a function that is given the connection, it runs inside a single transaction while holding the store lock
+        with self.store.lock:
+            with self.store.connection:
+                return statements(self.store.connection)
+
+    def takeAbandoned(self):
+        # Marks the Control Nodes whose lease ran out as abandoned and returns them. They are not leased again: the run that crashed may have left Environments on them.
+        def statements(connection):
+            rows = connection.execute("SELECT * FROM controlPool WHERE poolKey = ? AND status = 'leased' AND leaseExpiresAt < ?", (self.poolKey, time.time())).fetchall()
+            for row in rows:
+                connection.execute("UPDATE controlPool SET status = 'abandoned', leaseExpiresAt = NULL WHERE controlResourceName = ?", (row['controlResourceName'],))
+            return [dict(row) for row in rows]
+        return self.transaction(statements)
+
+    def lease(self, runId):
+        def statements(connection):
+            now = time.time()
+            rows = connection.execute("SELECT * FROM controlPool WHERE poolKey = ? AND status = 'available' ORDER BY lastUsedAt DESC LIMIT 1", (self.poolKey,)).fetchall()
+            if len(rows) == 0:
+                return None
+            connection.execute("UPDATE controlPool SET status = 'leased', leasedBy = ?, leaseExpiresAt = ? WHERE controlResourceName = ?", (str(runId), now + self.leaseTimeout, rows[0]['controlResourceName']))
+            return dict(rows[0])
+        return self.transaction(statements)
+
+    def getLease(self, runId):
+        # The Control Node already leased by this run (ex: when the run is resumed)
+        rows = self.store.execute("SELECT * FROM controlPool WHERE poolKey = ? AND status = 'leased' AND leasedBy = ?", (self.poolKey, str(runId)))
+        if len(rows) == 0:
+            return None
+        return dict(rows[0])
+
+    def getNode(self, controlResourceName):
+        rows = self.store.execute("SELECT * FROM controlPool WHERE controlResourceName = ?", (str(controlResourceName),))
+        if len(rows) == 0:
+            return None
+        return dict(rows[0])
+
+    def add(self, controlResourceName, dnsName, controlStack=None, runId=None):
+        # Control Resources created by a run are added as leased by that run, the ones created to fill the pool are added as available
+        now = time.time()
+        if runId is None:
+            values = (str(controlResourceName), self.poolKey, dnsName, controlStack, "available", None, None, now, now)
+        else:
+            values = (str(controlResourceName), self.poolKey, dnsName, controlStack, "leased", str(runId), now + self.leaseTimeout, now, now)
+        self.store.execute("INSERT OR REPLACE INTO controlPool (controlResourceName, poolKey, dnsName, controlStack, status, leasedBy, leaseExpiresAt, lastUsedAt, createdAt) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", values)
+
+    def release(self, runId, controlResourceName):
+        # Returns True when the Control Node went back into the pool and False when the pool is already full and the Control Node should be deleted
+        def statements(connection):
+            # The Control Node is counted against its own pool, the run releasing it may not have the Control parameters that make up the poolKey (ex: dc on its own)
+            rows = connection.execute("SELECT COUNT(*) AS available FROM controlPool WHERE poolKey = (SELECT poolKey FROM controlPool WHERE controlResourceName = ?) AND status = 'available'", (str(controlResourceName),)).fetchall()
+            if rows[0]['available'] >= self.size:
+                connection.execute("UPDATE controlPool SET status = 'expiring', leasedBy = NULL, leaseExpiresAt = NULL WHERE controlResourceName = ? AND leasedBy = ?", (str(controlResourceName), str(runId)))
+                return False
+            connection.execute("UPDATE controlPool SET status = 'available', leasedBy = NULL, leaseExpiresAt = NULL, lastUsedAt = ? WHERE controlResourceName = ? AND leasedBy = ?", (time.time(), str(controlResourceName), str(runId)))
+            return True
+        return self.transaction(statements)
+
+    def takeExpired(self):
+        # Marks the Control Nodes that have been idle for longer than the idle timeout as expiring and returns them so the caller can delete them
+        def statements(connection):
+            rows = connection.execute("SELECT * FROM controlPool WHERE poolKey = ? AND status = 'available' AND lastUsedAt < ?", (self.poolKey, time.time() - self.idleTimeout)).fetchall()
+            for row in rows:
+                connection.execute("UPDATE controlPool SET status = 'expiring' WHERE controlResourceName = ?", (row['controlResourceName'],))
+            return [dict(row) for row in rows]
+        return self.transaction(statements)
+
+    def setStatus(self, controlResourceName, status):
+        self.store.execute("UPDATE controlPool SET status = ?, leasedBy = NULL, leaseExpiresAt = NULL WHERE controlResourceName = ?", (str(status), str(controlResourceName)))
+
+    def remove(self, controlResourceName):
+        self.store.execute("DELETE FROM controlPool WHERE controlResourceName = ?", (str(controlResourceName),))
+
+    def countAvailable(self):
+        return self.store.execute("SELECT COUNT(*) AS available FROM controlPool WHERE poolKey = ? AND status = 'available'", (self.poolKey,))[0]['available']
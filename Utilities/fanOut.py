@@ -0,0 +1,175 @@
+# Copyright 2017
+#
+# Licensed under the Apache License, Version 2.0, <LICENSE-APACHE or
+# http://apache.org/licenses/LICENSE-2.0> or the MIT license <LICENSE-MIT or
+# http://opensource.org/licenses/MIT> or the LGPL, Version 2.0 <LICENSE-LGPLv2 or
+# https://www.gnu.org/licenses/old-licenses/lgpl-2.0.txt>, at your option.
+# This file may not be copied, modified, or distributed except according to those terms.
+
+
+import contextvars
+import json
+import os
+import sys
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+
+# Runs the whole pipeline for several configuration files at the same time in one process so they share the HTTP session pool, the AWS credentials, the run state database, etc.
+# The output of each member goes to its own log file and to the console prefixed with the member name.
+
+# The member the current code is running for. Work handed to other threads has to go through submit() (or runInContext) so the member follows it.
+currentMember = contextvars.ContextVar("fanOutMember", default=None)
+
+
+def submit(executor, function, *args):
+    # executor.submit() that carries the current member (and any other context) over to the worker thread
+    return executor.submit(contextvars.copy_context().run, function, *args)
+
+
+def runInContext(function):
+    # For callers that hand a function to something other than executor.submit (ex: loop.run_in_executor)
+    context = contextvars.copy_context()
+
+    def run(*args):
+        return context.run(function, *args)
+    return run
+
+
+class MemberOutput(object):
+    # Replaces sys.stdout while fanning out. Output from a member is written to the member's log file and echoed to the console one full line at a time with the member name in front, everything else goes straight to the console.
+    def __init__(self, console):
+        self.console = console
+        self.logFiles = {}
+        self.partialLines = {}
+        self.lock = threading.Lock()
+
+    def addMember(self, name, logPath):
+        with self.lock:
+            self.logFiles[name] = open(logPath, "a")
+            self.partialLines[name] = ""
+
+    def removeMember(self, name):
+        with self.lock:
+            if self.partialLines.get(name):
+                self.console.write("[" + str(name) + "] " + self.partialLines[name] + "\n")
+            self.partialLines.pop(name, None)
+            logFile = self.logFiles.pop(name, None)
+        if logFile is not None:
+            logFile.close()
+
+    def write(self, text):
+        name = currentMember.get()
+        with self.lock:
+            if name is None or name not in self.logFiles:
+                return self.console.write(text)
+            self.logFiles[name].write(text)
+            self.logFiles[name].flush()
+            lines = (self.partialLines[name] + text).split("\n")
+            self.partialLines[name] = lines.pop()
+            for line in lines:
+                self.console.write("[" + str(name) + "] " + line + "\n")
+            return len(text)
+
+    def flush(self):
+        with self.lock:
+            self.console.flush()
+
+    def __getattr__(self, attribute):
+        return getattr(self.console, attribute)
+
+
+class FanOut(object):
+    def __init__(self, configFilePaths, function, maxWorkers=4, outputDirectory=None):
+        # function is called as function(configFilePath) for every configuration file and returns the usual {"status": ..., "payload": ...} dictionary
+        self.configFilePaths = list(configFilePaths)
+        self.function = function
+        self.maxWorkers = max(1, int(maxWorkers))
+        if outputDirectory is None:
+            outputDirectory = "fanOut-" + time.strftime("%Y%m%d-%H%M%S")
+        self.outputDirectory = str(outputDirectory)
+        self.members = []
+
+    def memberNames(self):
+        # The log of each member is named after its configuration file (ex: aws_slurm.conf -> aws_slurm.log)
+        names = []
+        for configFilePath in self.configFilePaths:
+            name = os.path.splitext(os.path.basename(str(configFilePath)))[0]
+            candidate = name
+            count = 2
+            while candidate in names:
+                candidate = name + "-" + str(count)
+                count += 1
+            names.append(candidate)
+        return names
+
+    def runMember(self, member, output):
+        currentMember.set(member['name'])
+        output.addMember(member['name'], member['logPath'])
+        member['startTime'] = time.time()
+        try:
+            values = self.function(member['configFilePath'])
+        except SystemExit as e:
+            # Configuration problems are reported by printing the problem and calling sys.exit, only this member stops
+            values = {"status": "error" if e.code else "success", "payload": {"error": "The run exited with code " + str(e.code) + ", see " + str(member['logPath']) + " for the details.", "traceback": ''.join(traceback.format_exc())}}
+        except Exception as e:
+            values = {"status": "error", "payload": {"error": "The run raised an exception, see " + str(member['logPath']) + " for the details.", "traceback": ''.join(traceback.format_exc())}}
+            print(values['payload']['traceback'])
+        member['endTime'] = time.time()
+        output.removeMember(member['name'])
+        return values
+
+    def run(self):
+        if not os.path.isdir(self.outputDirectory):
+            os.makedirs(self.outputDirectory)
+
+        names = self.memberNames()
+        for x in range(len(self.configFilePaths)):
+            self.members.append({"name": names[x], "configFilePath": self.configFilePaths[x], "logPath": os.path.join(self.outputDirectory, names[x] + ".log"), "startTime": None, "endTime": None, "result": None})
+
+        print("Running " + str(len(self.members)) + " configuration files with up to " + str(self.maxWorkers) + " at a time. The output of each one is written to " + str(self.outputDirectory) + ".")
+        output = MemberOutput(sys.stdout)
+        sys.stdout = output
+        try:
+            with ThreadPoolExecutor(max_workers=min(self.maxWorkers, len(self.members))) as executor:
+                futures = [submit(executor, self.runMember, member, output) for member in self.members]
+                for x in range(len(futures)):
+                    self.members[x]['result'] = futures[x].result()
+        finally:
+            sys.stdout = output.console
+
+        report = self.createReport()
+        with open(os.path.join(self.outputDirectory, "report.json"), "w") as f:
+            json.dump(report, f, indent=4, default=str)
+        self.printReport(report)
+
+        failed = [member['name'] for member in report['members'] if member['status'] != "success"]
+        if len(failed) != 0:
+            return {"status": "error", "payload": {"error": "The runs for " + ", ".join(failed) + " failed.", "traceback": ''.join(traceback.format_stack())}, "report": report}
+        return {"status": "success", "payload": report}
+
+    def createReport(self):
+        members = []
+        for member in self.members:
+            result = member['result'] or {}
+            entry = {"name": member['name'], "configFilePath": member['configFilePath'], "logPath": member['logPath'], "status": result.get("status", "error"), "seconds": None}
+            if member['startTime'] is not None and member['endTime'] is not None:
+                entry['seconds'] = int(member['endTime'] - member['startTime'])
+            payload = result.get("payload")
+            if isinstance(payload, dict):
+                # runPipeline returns the run ID and the status and duration of each stage
+                for key in ["runId", "stages", "failedStage", "error"]:
+                    if key in payload:
+                        entry[key] = payload[key]
+            members.append(entry)
+        seconds = [member['seconds'] for member in members if member['seconds'] is not None]
+        return {"members": members, "succeeded": len([member for member in members if member['status'] == "success"]), "failed": len([member for member in members if member['status'] != "success"]), "seconds": max(seconds) if seconds else 0}
+
+    def printReport(self, report):
+        print("")
+        print("%-30s %-10s %-10s %-20s %s" % ("Configuration", "Status", "Seconds", "Failed Stage", "Log"))
+        for member in report['members']:
+            print("%-30s %-10s %-10s %-20s %s" % (member['name'], member['status'], member['seconds'], member.get("failedStage") or "", member['logPath']))
+        print(str(report['succeeded']) + " succeeded and " + str(report['failed']) + " failed, the slowest took " + str(report['seconds']) + " seconds. The report was written to " + os.path.join(self.outputDirectory, "report.json") + ".")
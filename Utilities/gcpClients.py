@@ -0,0 +1,119 @@
+# Copyright 2017
+#
+# Licensed under the Apache License, Version 2.0, <LICENSE-APACHE or
+# http://apache.org/licenses/LICENSE-2.0> or the MIT license <LICENSE-MIT or
+# http://opensource.org/licenses/MIT> or the LGPL, Version 2.0 <LICENSE-LGPLv2 or
+# https://www.gnu.org/licenses/old-licenses/lgpl-2.0.txt>, at your option.
+# This file may not be copied, modified, or distributed except according to those terms.
+
+
+import json
+import os
+import threading
+import traceback
+
+import google.auth
+import google_auth_httplib2
+import googleapiclient.discovery
+import httplib2
+from googleapiclient import discovery_cache
+import requests
+
+
+# GCP API clients built from discovery documents that are read (and parsed) once per process instead of on every googleapiclient.discovery.build call.
+# The documents come from the gcpDiscoveryDirectory (if configured), then from the documents bundled with googleapiclient and only then from the discovery service, in which case the document is saved to the directory for the next run.
+# The clients are not thread safe (each one owns an httplib2 connection), so every thread gets its own client built from the shared document and credentials.
+
+discoveryUrl = "https://www.googleapis.com/discovery/v1/apis/%s/%s/rest"
+defaultScopes = ["https://www.googleapis.com/auth/cloud-platform"]
+
+# Seconds before a request gives up, longer than the two minutes a zoneOperations.wait call can be held open by GCP (see gcpOperations)
+httpTimeout = 150
+
+
+class GcpClientCache(object):
+    def __init__(self, directory=None):
+        self.directory = directory
+        self.documents = {}
+        self.credentials = None
+        self.threadClients = threading.local()
+        self.lock = threading.Lock()
+
+    def configure(self, directory=None):
+        with self.lock:
+            if directory is not None:
+                self.directory = os.path.expanduser(str(directory)) if str(directory) != "" else None
+
+    def getPath(self, service, version):
+        return os.path.join(self.directory, str(service) + "." + str(version) + ".json")
+
+    def loadDocument(self, service, version):
+        if self.directory is not None:
+            try:
+                with open(self.getPath(service, version), "r") as f:
+                    return f.read()
+            except Exception as e:
+                pass
+        content = discovery_cache.get_static_doc(str(service), str(version))
+        if content is not None:
+            return content
+        print("Fetching the discovery document for " + str(service) + " " + str(version) + ".")
+        response = requests.get(discoveryUrl % (service, version), timeout=60)
+        response.raise_for_status()
+        content = response.text
+        if self.directory is not None:
+            try:
+                if not os.path.isdir(self.directory):
+                    os.makedirs(self.directory)
+                temporaryPath = self.getPath(service, version) + "." + str(os.getpid())
+                with open(temporaryPath, "w") as f:
+                    f.write(content)
+                os.replace(temporaryPath, self.getPath(service, version))
+            except Exception as e:
+                print("Unable to save the discovery document for " + str(service) + " " + str(version) + " to " + str(self.directory) + ".")
+                print(''.join(traceback.format_exc()))
+        return content
+
+    def getDocument(self, service, version):
+        key = (str(service), str(version))
+        with self.lock:
+            document = self.documents.get(key)
+            if document is None:
+                document = json.loads(self.loadDocument(service, version))
+                self.documents[key] = document
+            return document
+
+    def getCredentials(self):
+        # The Application Default Credentials are looked up once and shared, each client refreshes them as needed
+        with self.lock:
+            if self.credentials is None:
+                self.credentials = google.auth.default(scopes=defaultScopes)[0]
+            return self.credentials
+
+    def getClient(self, service, version):
+        key = (str(service), str(version))
+        clients = getattr(self.threadClients, "clients", None)
+        if clients is None:
+            clients = {}
+            self.threadClients.clients = clients
+        client = clients.get(key)
+        if client is None:
+            http = google_auth_httplib2.AuthorizedHttp(self.getCredentials(), http=httplib2.Http(timeout=httpTimeout))
+            client = googleapiclient.discovery.build_from_document(self.getDocument(service, version), http=http)
+            clients[key] = client
+        return client
+
+
+# Process wide cache shared by all of the GCP code paths
+gcpClientCache = GcpClientCache()
+
+
+def configureFromParameters(parameters):
+    # Reads the optional gcpDiscoveryDirectory field from a configuration file section (normally General)
+    if not parameters:
+        return
+    gcpClientCache.configure(directory=parameters.get("gcpdiscoverydirectory"))
+
+
+def getClient(service, version):
+    return gcpClientCache.getClient(service, version)
@@ -0,0 +1,92 @@
+# Copyright 2017
+#
+# Licensed under the Apache License, Version 2.0, <LICENSE-APACHE or
+# http://apache.org/licenses/LICENSE-2.0> or the MIT license <LICENSE-MIT or
+# http://opensource.org/licenses/MIT> or the LGPL, Version 2.0 <LICENSE-LGPLv2 or
+# https://www.gnu.org/licenses/old-licenses/lgpl-2.0.txt>, at your option.
+# This file may not be copied, modified, or distributed except according to those terms.
+
+
+import socket
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+import googleapiclient.errors
+
+import fanOut
+import gcpClients
+import poller
+
+
+# Waits for GCP operations (ex: an instance insert or delete) with zoneOperations.wait. GCP holds each wait call open until the operation is DONE or about two minutes have passed, so the caller finds out as soon as the operation finishes without polling.
+# Transient failures (rate limits, server errors, dropped connections) are retried with the shared poller backoff until the deadline. Every waiting thread uses its own client (see gcpClients) so many operations can be awaited at the same time.
+
+# HTTP status codes worth sending the wait again for
+retryStatusCodes = [429, 500, 502, 503, 504]
+
+
+class OperationWaiter(object):
+    def __init__(self, workers=8):
+        self.workers = max(1, int(workers))
+        # Setting the event stops every wait in progress (ex: when the run is being torn down)
+        self.cancelEvent = threading.Event()
+
+    def waitOnce(self, client, project, zone, operation):
+        # Zone operations (instances) are waited on in their zone, the others (ex: images, firewalls) are global
+        if zone is not None:
+            return client.zoneOperations().wait(project=project, zone=zone, operation=operation).execute()
+        return client.globalOperations().wait(project=project, operation=operation).execute()
+
+    def wait(self, project, zone, operation, timeout=1200):
+        # Returns the finished operation as the payload, or an error when the operation failed, could not be waited on or did not finish before the timeout
+        try:
+            client = gcpClients.getClient("compute", "v1")
+        except Exception as e:
+            return {"status": "error", "payload": {"error": "There was an exception encountered when trying to obtain a google api session.", "traceback": ''.join(traceback.format_exc())}}
+
+        poll = poller.Poller("gcpOperationWait", timeout=timeout, maxInterval=30, initialInterval=1, cancelEvent=self.cancelEvent)
+        while True:
+            try:
+                result = self.waitOnce(client, project, zone, str(operation))
+                if result.get("status") == "DONE":
+                    if "error" in result:
+                        return {"status": "error", "payload": {"error": "The GCP operation " + str(operation) + " failed: " + str(result['error']), "traceback": ''.join(traceback.format_stack())}}
+                    return {"status": "success", "payload": result}
+                # The wait ended before the operation did, the next call is made right away
+                if not poll.expired() and not poll.cancelled():
+                    poll.reset()
+                    continue
+            except googleapiclient.errors.HttpError as e:
+                if e.status_code not in retryStatusCodes:
+                    return {"status": "error", "payload": {"error": "Unable to wait for the GCP operation " + str(operation) + ".", "traceback": ''.join(traceback.format_exc())}}
+                print("Waiting for the GCP operation " + str(operation) + " failed with " + str(e.status_code) + ", trying again.")
+            except (socket.timeout, ConnectionError) as e:
+                print("The connection used to wait for the GCP operation " + str(operation) + " was dropped, trying again.")
+            except Exception as e:
+                return {"status": "error", "payload": {"error": "Unable to wait for the GCP operation " + str(operation) + ".", "traceback": ''.join(traceback.format_exc())}}
+            if not poll.wait():
+                return {"status": "error", "payload": {"error": "The GCP operation " + str(operation) + " did not finish before the timeout (" + poll.describe() + ").", "traceback": ''.join(traceback.format_stack())}}
+
+    def waitAll(self, operations, timeout=1200):
+        # operations is a list of (project, zone, operation) tuples, the results come back in the same order
+        if len(operations) == 0:
+            return []
+        with ThreadPoolExecutor(max_workers=min(self.workers, len(operations))) as executor:
+            futures = [fanOut.submit(executor, self.wait, project, zone, operation, timeout) for project, zone, operation in operations]
+            return [future.result() for future in futures]
+
+    def cancel(self):
+        self.cancelEvent.set()
+
+
+# Process wide waiter shared by all of the GCP code paths
+operationWaiter = OperationWaiter()
+
+
+def wait(project, zone, operation, timeout=1200):
+    return operationWaiter.wait(project, zone, operation, timeout)
+
+
+def waitAll(operations, timeout=1200):
+    return operationWaiter.waitAll(operations, timeout)
@@ -0,0 +1,234 @@
+# Copyright 2017
+#
+# Licensed under the Apache License, Version 2.0, <LICENSE-APACHE or
+# http://apache.org/licenses/LICENSE-2.0> or the MIT license <LICENSE-MIT or
+# http://opensource.org/licenses/MIT> or the LGPL, Version 2.0 <LICENSE-LGPLv2 or
+# https://www.gnu.org/licenses/old-licenses/lgpl-2.0.txt>, at your option.
+# This file may not be copied, modified, or distributed except according to those terms.
+
+
+import json
+import os
+import threading
+import time
+import traceback
+from urllib.parse import urlsplit
+
+
+# Every REST call made through the pooled sessions (see httpSessions) is recorded per (host, method, endpoint): a latency histogram, the status codes, the errors, the retries and the bytes sent and received.
+# At the end of a run the metrics are written as JSON and in the Prometheus text format so slow runs can be traced to the Control Node, the Login Instance or our own polling.
+
+# Upper bounds (in seconds) of the latency histogram buckets, the last bucket (+Inf) is implied
+defaultBuckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class EndpointMetrics(object):
+    def __init__(self, buckets):
+        self.buckets = buckets
+        # bucketCounts[i] counts the requests that took at most buckets[i] (and more than buckets[i - 1]), the last entry counts the slower ones
+        self.bucketCounts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.totalSeconds = 0.0
+        self.minSeconds = None
+        self.maxSeconds = None
+        self.statusCodes = {}
+        self.errors = {}
+        self.retries = {}
+        self.bytesSent = 0
+        self.bytesReceived = 0
+
+    def observe(self, seconds):
+        index = len(self.buckets)
+        for bucket, upperBound in enumerate(self.buckets):
+            if seconds <= upperBound:
+                index = bucket
+                break
+        self.bucketCounts[index] += 1
+        self.count += 1
+        self.totalSeconds += seconds
+        self.minSeconds = seconds if self.minSeconds is None else min(self.minSeconds, seconds)
+        self.maxSeconds = seconds if self.maxSeconds is None else max(self.maxSeconds, seconds)
+
+    def cumulativeCounts(self):
+        # Prometheus histograms count every request at or below each bound
+        counts = []
+        total = 0
+        for count in self.bucketCounts:
+            total += count
+            counts.append(total)
+        return counts
+
+    def toDict(self):
+        bounds = [str(bound) for bound in self.buckets] + ["+Inf"]
+        return {"count": self.count, "seconds": {"sum": self.totalSeconds, "min": self.minSeconds, "max": self.maxSeconds, "mean": self.totalSeconds / self.count if self.count else None}, "histogram": dict(zip(bounds, self.cumulativeCounts())), "statusCodes": dict(self.statusCodes), "errors": dict(self.errors), "retries": dict(self.retries), "bytesSent": self.bytesSent, "bytesReceived": self.bytesReceived}
+
+
+def escapeLabel(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def getEndpoint(url):
+    # Returns (host, endpoint), the query string is left out so every call to a route ends up in the same series
+    parts = urlsplit(str(url))
+    return parts.netloc, parts.path or "/"
+
+
+def getBodySize(body):
+    if body is None:
+        return 0
+    if isinstance(body, (bytes, bytearray, str)):
+        return len(body)
+    # Streamed bodies (ex: the files uploaded with webdav) are counted when they have a known size
+    try:
+        return os.fstat(body.fileno()).st_size
+    except Exception as e:
+        return 0
+
+
+class HttpMetrics(object):
+    def __init__(self, buckets=defaultBuckets, path="httpMetrics.json", prometheusPath="httpMetrics.prom"):
+        self.buckets = tuple(float(bucket) for bucket in buckets)
+        # The files written by write(), None (or an empty value in the configuration file) turns a file off
+        self.path = path
+        self.prometheusPath = prometheusPath
+        self.endpoints = {}
+        self.startTime = time.time()
+        self.lock = threading.Lock()
+
+    def configure(self, path=None, prometheusPath=None):
+        with self.lock:
+            if path is not None:
+                self.path = str(path) if str(path) != "" else None
+            if prometheusPath is not None:
+                self.prometheusPath = str(prometheusPath) if str(prometheusPath) != "" else None
+
+    def getEndpointMetrics(self, host, method, endpoint):
+        key = (str(host), str(method).upper(), str(endpoint))
+        metrics = self.endpoints.get(key)
+        if metrics is None:
+            metrics = EndpointMetrics(self.buckets)
+            self.endpoints[key] = metrics
+        return metrics
+
+    def recordRequest(self, request, response, seconds, error=None, stream=False):
+        # request is the PreparedRequest that was sent and response is None when the request failed with an exception
+        host, endpoint = getEndpoint(request.url)
+        bytesSent = getBodySize(request.body)
+        bytesReceived = 0
+        retries = 0
+        if response is not None:
+            if not stream:
+                bytesReceived = len(response.content or b"")
+            else:
+                try:
+                    bytesReceived = int(response.headers.get("Content-Length") or 0)
+                except Exception as e:
+                    bytesReceived = 0
+            try:
+                # The connection retries made by urllib3 before this response (see httpSessions.createSession)
+                retries = len(response.raw.retries.history)
+            except Exception as e:
+                retries = 0
+        with self.lock:
+            metrics = self.getEndpointMetrics(host, request.method, endpoint)
+            metrics.observe(seconds)
+            metrics.bytesSent += bytesSent
+            metrics.bytesReceived += bytesReceived
+            if response is not None:
+                metrics.statusCodes[str(response.status_code)] = metrics.statusCodes.get(str(response.status_code), 0) + 1
+            if error is not None:
+                metrics.errors[str(error)] = metrics.errors.get(str(error), 0) + 1
+            if retries:
+                metrics.retries["connect"] = metrics.retries.get("connect", 0) + retries
+
+    def recordRetry(self, url, method, kind):
+        # Retries made above the session (ex: kind "session" when the request is sent again after logging in again)
+        host, endpoint = getEndpoint(url)
+        with self.lock:
+            metrics = self.getEndpointMetrics(host, method, endpoint)
+            metrics.retries[str(kind)] = metrics.retries.get(str(kind), 0) + 1
+
+    def getMetrics(self):
+        with self.lock:
+            endpoints = [dict(metrics.toDict(), host=key[0], method=key[1], endpoint=key[2]) for key, metrics in sorted(self.endpoints.items())]
+        return {"startTime": self.startTime, "endTime": time.time(), "buckets": list(self.buckets), "endpoints": endpoints}
+
+    def toPrometheus(self):
+        lines = []
+        with self.lock:
+            items = sorted(self.endpoints.items())
+            lines.append("# HELP ccautomaton_http_request_duration_seconds Time taken by the REST calls to the Control Node and the Login Instances, including reading the response.")
+            lines.append("# TYPE ccautomaton_http_request_duration_seconds histogram")
+            for key, metrics in items:
+                labels = "host=\"%s\",method=\"%s\",endpoint=\"%s\"" % tuple(escapeLabel(value) for value in key)
+                bounds = [repr(bound) for bound in self.buckets] + ["+Inf"]
+                for bound, count in zip(bounds, metrics.cumulativeCounts()):
+                    lines.append("ccautomaton_http_request_duration_seconds_bucket{%s,le=\"%s\"} %d" % (labels, bound, count))
+                lines.append("ccautomaton_http_request_duration_seconds_sum{%s} %r" % (labels, metrics.totalSeconds))
+                lines.append("ccautomaton_http_request_duration_seconds_count{%s} %d" % (labels, metrics.count))
+
+            counters = [("ccautomaton_http_responses_total", "Responses by status code.", "code", "statusCodes"), ("ccautomaton_http_request_errors_total", "Requests that failed without a response, by exception.", "error", "errors"), ("ccautomaton_http_retries_total", "Requests sent again, by kind (connect: by urllib3 before a response, session: after logging in again).", "kind", "retries")]
+            for name, description, labelName, attribute in counters:
+                lines.append("# HELP " + name + " " + description)
+                lines.append("# TYPE " + name + " counter")
+                for key, metrics in items:
+                    labels = "host=\"%s\",method=\"%s\",endpoint=\"%s\"" % tuple(escapeLabel(value) for value in key)
+                    for value, count in sorted(getattr(metrics, attribute).items()):
+                        lines.append("%s{%s,%s=\"%s\"} %d" % (name, labels, labelName, escapeLabel(value), count))
+
+            for name, description, attribute in [("ccautomaton_http_request_bytes_total", "Bytes sent in the request bodies.", "bytesSent"), ("ccautomaton_http_response_bytes_total", "Bytes received in the response bodies.", "bytesReceived")]:
+                lines.append("# HELP " + name + " " + description)
+                lines.append("# TYPE " + name + " counter")
+                for key, metrics in items:
+                    labels = "host=\"%s\",method=\"%s\",endpoint=\"%s\"" % tuple(escapeLabel(value) for value in key)
+                    lines.append("%s{%s} %d" % (name, labels, getattr(metrics, attribute)))
+        return "\n".join(lines) + "\n"
+
+    def write(self):
+        # Writes the JSON and Prometheus files, a failure to write them never fails the run
+        with self.lock:
+            path = self.path
+            prometheusPath = self.prometheusPath
+            empty = len(self.endpoints) == 0
+        if empty:
+            return {"status": "success", "payload": []}
+        written = []
+        try:
+            if path is not None:
+                with open(path, "w") as f:
+                    json.dump(self.getMetrics(), f, indent=4)
+                written.append(path)
+            if prometheusPath is not None:
+                with open(prometheusPath, "w") as f:
+                    f.write(self.toPrometheus())
+                written.append(prometheusPath)
+            return {"status": "success", "payload": written}
+        except Exception as e:
+            return {"status": "error", "payload": {"error": "Unable to write the HTTP metrics.", "traceback": ''.join(traceback.format_exc())}}
+
+
+# Process wide metrics shared by all of the pooled sessions
+httpMetrics = HttpMetrics()
+
+
+def configureFromParameters(parameters):
+    # Reads the optional httpMetricsPath and httpMetricsPrometheusPath fields from a configuration file section (normally General)
+    if not parameters:
+        return
+    httpMetrics.configure(path=parameters.get("httpmetricspath"), prometheusPath=parameters.get("httpmetricsprometheuspath"))
+
+
+def recordRequest(request, response, seconds, error=None, stream=False):
+    httpMetrics.recordRequest(request, response, seconds, error, stream)
+
+
+def recordRetry(url, method, kind):
+    httpMetrics.recordRetry(url, method, kind)
+
+
+def getMetrics():
+    return httpMetrics.getMetrics()
+
+
+def write():
+    return httpMetrics.write()
@@ -0,0 +1,117 @@
+# Copyright 2017
+#
+# Licensed under the Apache License, Version 2.0, <LICENSE-APACHE or
+# http://apache.org/licenses/LICENSE-2.0> or the MIT license <LICENSE-MIT or
+# http://opensource.org/licenses/MIT> or the LGPL, Version 2.0 <LICENSE-LGPLv2 or
+# https://www.gnu.org/licenses/old-licenses/lgpl-2.0.txt>, at your option.
+# This file may not be copied, modified, or distributed except according to those terms.
+
+
+import os
+import sys
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+sys.path.append(os.path.dirname(__file__))
+import httpMetrics
+
+
+class MeteredSession(requests.Session):
+    # Records the latency, status code, retries and size of every request in httpMetrics. The time includes reading the response body unless the request is streamed.
+    def send(self, request, **kwargs):
+        startTime = time.monotonic()
+        try:
+            response = super(MeteredSession, self).send(request, **kwargs)
+        except Exception as e:
+            httpMetrics.recordRequest(request, None, time.monotonic() - startTime, error=type(e).__name__)
+            raise
+        httpMetrics.recordRequest(request, response, time.monotonic() - startTime, stream=kwargs.get("stream", False))
+        return response
+
+
+class HttpSessionPool(object):
+    def __init__(self, poolConnections=4, poolMaxSize=16, maxRetries=3, backoffFactor=0.5):
+        self.poolConnections = int(poolConnections)
+        self.poolMaxSize = int(poolMaxSize)
+        self.maxRetries = int(maxRetries)
+        self.backoffFactor = float(backoffFactor)
+
+        # One keep-alive session per host (Control Node, Login Node, etc) so that every request to the same node reuses the open TCP/TLS connections
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    def configure(self, poolConnections=None, poolMaxSize=None, maxRetries=None, backoffFactor=None):
+        # The new values only apply to sessions created after this call, existing sessions keep their adapters
+        with self.lock:
+            if poolConnections is not None:
+                self.poolConnections = int(poolConnections)
+            if poolMaxSize is not None:
+                self.poolMaxSize = int(poolMaxSize)
+            if maxRetries is not None:
+                self.maxRetries = int(maxRetries)
+            if backoffFactor is not None:
+                self.backoffFactor = float(backoffFactor)
+
+    def createSession(self):
+        # Only retry the failures where the request never made it to the node (DNS, refused/reset connections). Retrying reads or status codes could submit the same ccq job twice.
+        retries = Retry(total=self.maxRetries, connect=self.maxRetries, read=0, redirect=0, status=0, backoff_factor=self.backoffFactor, raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=self.poolConnections, pool_maxsize=self.poolMaxSize, max_retries=retries)
+        session = MeteredSession()
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+
+    def getSession(self, host):
+        with self.lock:
+            session = self.sessions.get(str(host))
+            if session is None:
+                session = self.createSession()
+                self.sessions[str(host)] = session
+            return session
+
+    def setCookies(self, host, cookies):
+        if cookies is not None:
+            self.getSession(host).cookies.update(cookies)
+
+    def closeSession(self, host):
+        with self.lock:
+            session = self.sessions.pop(str(host), None)
+        if session is not None:
+            session.close()
+
+    def closeAll(self):
+        with self.lock:
+            sessions = list(self.sessions.values())
+            self.sessions = {}
+        for session in sessions:
+            session.close()
+
+
+# Process wide pool shared by all of the Environment and Scheduler classes
+sessionPool = HttpSessionPool()
+
+
+def configure(**kwargs):
+    sessionPool.configure(**kwargs)
+
+
+def configureFromParameters(parameters):
+    # Reads the optional http* fields from a configuration file section (normally General)
+    if not parameters:
+        return
+    sessionPool.configure(poolConnections=parameters.get("httppoolconnections"), poolMaxSize=parameters.get("httppoolmaxsize"), maxRetries=parameters.get("httpmaxretries"), backoffFactor=parameters.get("httpbackofffactor"))
+
+
+def getSession(host):
+    return sessionPool.getSession(host)
+
+
+def setCookies(host, cookies):
+    sessionPool.setCookies(host, cookies)
+
+
+def closeAll():
+    sessionPool.closeAll()
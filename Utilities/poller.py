@@ -0,0 +1,151 @@
+# Copyright 2017
+#
+# Licensed under the Apache License, Version 2.0, <LICENSE-APACHE or
+# http://apache.org/licenses/LICENSE-2.0> or the MIT license <LICENSE-MIT or
+# http://opensource.org/licenses/MIT> or the LGPL, Version 2.0 <LICENSE-LGPLv2 or
+# https://www.gnu.org/licenses/old-licenses/lgpl-2.0.txt>, at your option.
+# This file may not be copied, modified, or distributed except according to those terms.
+
+
+import random
+import threading
+import time
+
+
+# Process wide defaults, these can be tuned in the General section of the configuration file (see configureFromParameters)
+defaults = {"initialInterval": 2.0, "multiplier": 2.0, "jitter": 0.2}
+
+# Running totals for every named poller so the whole run can be tuned from one place
+statistics = {}
+statisticsLock = threading.Lock()
+
+
+class Poller(object):
+    # Usage:
+    #     poll = poller.Poller("getDatabaseTableNames", timeout=300, maxInterval=30)
+    #     while True:
+    #         ... check the thing we are waiting on, return when it is done ...
+    #         if not poll.wait():
+    #             return the timeout error
+    #
+    # The first checks happen quickly and the interval then grows exponentially (with jitter so parallel pollers spread out) up to maxInterval.
+    def __init__(self, name="poll", timeout=None, maxInterval=60, initialInterval=None, multiplier=None, jitter=None, cancelEvent=None):
+        self.name = str(name)
+        self.maxInterval = float(maxInterval)
+        if initialInterval is None:
+            initialInterval = defaults["initialInterval"]
+        self.initialInterval = min(float(initialInterval), self.maxInterval)
+        if multiplier is None:
+            multiplier = defaults["multiplier"]
+        self.multiplier = max(1.0, float(multiplier))
+        if jitter is None:
+            jitter = defaults["jitter"]
+        self.jitter = min(max(0.0, float(jitter)), 1.0)
+
+        # The deadline is absolute so slow checks count against the timeout, a timeout of None or 0 waits forever
+        self.startTime = time.monotonic()
+        self.deadline = None
+        if timeout is not None and float(timeout) > 0:
+            self.deadline = self.startTime + float(timeout)
+
+        # Setting the event (directly or through cancel()) wakes up a sleeping poller and stops it
+        if cancelEvent is None:
+            cancelEvent = threading.Event()
+        self.cancelEvent = cancelEvent
+
+        self.interval = self.initialInterval
+        self.attempts = 0
+        self.totalWait = 0.0
+        self.finished = False
+
+        with statisticsLock:
+            if self.name not in statistics:
+                statistics[self.name] = {"polls": 0, "waits": 0, "totalWait": 0.0}
+            statistics[self.name]["polls"] += 1
+
+    def elapsed(self):
+        return time.monotonic() - self.startTime
+
+    def remaining(self):
+        if self.deadline is None:
+            return None
+        return max(0.0, self.deadline - time.monotonic())
+
+    def expired(self):
+        return self.deadline is not None and time.monotonic() >= self.deadline
+
+    def cancelled(self):
+        return self.cancelEvent.is_set()
+
+    def cancel(self):
+        self.cancelEvent.set()
+
+    def reset(self):
+        # Go back to the fast interval, used when the thing being polled changes state
+        self.interval = self.initialInterval
+
+    def setMaxInterval(self, maxInterval):
+        # Used to check more often once the expected completion time gets close
+        self.maxInterval = max(0.0, float(maxInterval))
+        self.interval = min(self.interval, self.maxInterval)
+
+    def nextInterval(self):
+        # Returns the next wait without sleeping (for callers that sleep on their own, ex: asyncio) and advances the backoff
+        interval = self.interval * random.uniform(1.0 - self.jitter, 1.0 + self.jitter)
+        interval = min(interval, self.maxInterval)
+        self.interval = min(self.interval * self.multiplier, self.maxInterval)
+        remaining = self.remaining()
+        if remaining is not None:
+            interval = min(interval, remaining)
+        return max(0.0, interval)
+
+    def wait(self):
+        # Called after an unsuccessful check. Returns True when it is time to check again and False once the deadline has passed or the poller was cancelled.
+        self.attempts += 1
+        if self.expired() or self.cancelled():
+            self.finished = True
+            return False
+        interval = self.nextInterval()
+        startWait = time.monotonic()
+        cancelled = self.cancelEvent.wait(interval)
+        waited = time.monotonic() - startWait
+        self.totalWait += waited
+        with statisticsLock:
+            statistics[self.name]["waits"] += 1
+            statistics[self.name]["totalWait"] += waited
+        if cancelled:
+            self.finished = True
+            return False
+        return True
+
+    def stats(self):
+        # When the poller stopped on its own the last wait() call was for the final attempt, otherwise the check that succeeded has not been counted yet
+        attempts = self.attempts
+        if not self.finished:
+            attempts += 1
+        return {"name": self.name, "attempts": attempts, "totalWait": round(self.totalWait, 3), "elapsed": round(self.elapsed(), 3)}
+
+    def describe(self):
+        values = self.stats()
+        return "%s attempts over %s seconds" % (values["attempts"], int(values["elapsed"]))
+
+
+def configure(initialInterval=None, multiplier=None, jitter=None):
+    if initialInterval is not None:
+        defaults["initialInterval"] = float(initialInterval)
+    if multiplier is not None:
+        defaults["multiplier"] = float(multiplier)
+    if jitter is not None:
+        defaults["jitter"] = float(jitter)
+
+
+def configureFromParameters(parameters):
+    # Reads the optional poll* fields from a configuration file section (normally General)
+    if not parameters:
+        return
+    configure(initialInterval=parameters.get("pollinitialinterval"), multiplier=parameters.get("pollbackoffmultiplier"), jitter=parameters.get("polljitter"))
+
+
+def getStatistics():
+    with statisticsLock:
+        return dict((name, dict(values)) for name, values in statistics.items())
@@ -0,0 +1,147 @@
+# Copyright 2017
+#
+# Licensed under the Apache License, Version 2.0, <LICENSE-APACHE or
+# http://apache.org/licenses/LICENSE-2.0> or the MIT license <LICENSE-MIT or
+# http://opensource.org/licenses/MIT> or the LGPL, Version 2.0 <LICENSE-LGPLv2 or
+# https://www.gnu.org/licenses/old-licenses/lgpl-2.0.txt>, at your option.
+# This file may not be copied, modified, or distributed except according to those terms.
+
+
+import os
+import socket
+import sys
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.append(os.path.dirname(__file__))
+import fanOut
+import poller
+
+
+# Small network checks used to decide when a newly created node is actually usable instead of sleeping for a fixed amount of time
+
+
+def splitHostPort(host, port):
+    # The host can carry its own port (ex: localhost:8443), the same way the SSH connections of the job scripts accept it
+    host = str(host)
+    if host.count(":") == 1:
+        (host, port) = host.split(":")
+    return host, int(port)
+
+
+def resolves(host, port=22):
+    try:
+        (host, port) = splitHostPort(host, port)
+        addresses = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+        return {"status": "success", "payload": [address[4][0] for address in addresses]}
+    except Exception as e:
+        return {"status": "error", "payload": {"error": "The DNS name " + str(host) + " does not resolve yet.", "traceback": ''.join(traceback.format_exc())}}
+
+
+def acceptsSsh(host, port=22, timeout=5):
+    # The port being open is not enough, sshd has to answer with its identification string (ex: SSH-2.0-OpenSSH_7.4)
+    sock = None
+    (host, port) = splitHostPort(host, port)
+    try:
+        sock = socket.create_connection((str(host), int(port)), timeout=float(timeout))
+        banner = sock.recv(256)
+        if not banner.startswith(b"SSH-"):
+            return {"status": "error", "payload": {"error": "The service on " + str(host) + ":" + str(port) + " did not answer like an SSH server.", "traceback": ''.join(traceback.format_stack())}}
+        return {"status": "success", "payload": banner.decode(errors="replace").strip()}
+    except Exception as e:
+        return {"status": "error", "payload": {"error": "Unable to open an SSH connection to " + str(host) + ":" + str(port) + ".", "traceback": ''.join(traceback.format_exc())}}
+    finally:
+        if sock is not None:
+            sock.close()
+
+
+class ProbeSet(object):
+    # Runs a set of readiness checks at the same time, each one retried with its own short, growing interval until it succeeds. A check that depends on others starts as soon as they have succeeded.
+    # Usage:
+    #     probeSet = probes.ProbeSet("controlReadiness", timeout=600)
+    #     probeSet.add("dns", checkDns)
+    #     probeSet.add("tables", checkTables, dependsOn=["dns"])
+    #     values = probeSet.run()    # {"status": "success", "payload": {"dns": ..., "tables": ...}}
+    #
+    # check() returns the usual {"status": ..., "payload": ...} dictionary (with "final": True when an error should not be retried). When one check runs out of time the others are cancelled and the error names the check that failed.
+    def __init__(self, name, timeout=600, initialInterval=1, maxInterval=15):
+        self.name = str(name)
+        self.timeout = timeout
+        self.initialInterval = initialInterval
+        self.maxInterval = maxInterval
+        self.probes = []
+        self.cancelEvent = threading.Event()
+        # The first check to fail, the checks cancelled because of it are not reported
+        self.failedProbe = None
+        self.lock = threading.Lock()
+
+    def add(self, name, check, dependsOn=None, maxInterval=None, attempts=None):
+        # attempts limits the number of tries for checks that already retry on their own or must not be repeated
+        self.probes.append({"name": str(name), "check": check, "dependsOn": list(dependsOn or []), "maxInterval": maxInterval if maxInterval is not None else self.maxInterval, "attempts": attempts, "done": threading.Event(), "result": None, "seconds": None})
+
+    def getProbe(self, name):
+        for probe in self.probes:
+            if probe['name'] == name:
+                return probe
+        return None
+
+    def runProbe(self, probe, startTime):
+        poll = poller.Poller(self.name + "." + probe['name'], timeout=self.timeout, maxInterval=probe['maxInterval'], initialInterval=self.initialInterval, cancelEvent=self.cancelEvent)
+        try:
+            for dependency in probe['dependsOn']:
+                dependencyProbe = self.getProbe(dependency)
+                while not dependencyProbe['done'].wait(0.5):
+                    if self.cancelEvent.is_set():
+                        return {"status": "error", "payload": {"error": "Cancelled before the " + str(dependency) + " check finished.", "traceback": ''.join(traceback.format_stack())}}
+                if dependencyProbe['result']['status'] != "success":
+                    return {"status": "error", "payload": {"error": "The " + str(dependency) + " check failed.", "traceback": ''.join(traceback.format_stack())}}
+            tries = 0
+            while True:
+                tries += 1
+                try:
+                    values = probe['check']()
+                except Exception as e:
+                    values = {"status": "error", "payload": {"error": "The " + str(probe['name']) + " check raised an exception.", "traceback": ''.join(traceback.format_exc())}}
+                if values['status'] == "success":
+                    print("The " + str(probe['name']) + " check passed after " + str(int(time.monotonic() - startTime)) + " seconds.")
+                    return values
+                # A check can tell that retrying will not help by returning "final": True with its error
+                if values.get("final") or (probe['attempts'] is not None and tries >= probe['attempts']):
+                    return values
+                if not poll.wait():
+                    return values
+        finally:
+            probe['seconds'] = round(time.monotonic() - startTime, 3)
+
+    def runAndRecord(self, probe, startTime):
+        try:
+            probe['result'] = self.runProbe(probe, startTime)
+        except Exception as e:
+            probe['result'] = {"status": "error", "payload": {"error": "The " + str(probe['name']) + " check raised an exception.", "traceback": ''.join(traceback.format_exc())}}
+        if probe['result']['status'] != "success":
+            # No point in waiting on the other checks once one of them has failed
+            with self.lock:
+                if self.failedProbe is None:
+                    self.failedProbe = probe
+            self.cancelEvent.set()
+        probe['done'].set()
+
+    def run(self):
+        startTime = time.monotonic()
+        with ThreadPoolExecutor(max_workers=max(1, len(self.probes))) as executor:
+            futures = [fanOut.submit(executor, self.runAndRecord, probe, startTime) for probe in self.probes]
+            for future in futures:
+                future.result()
+
+        probe = self.failedProbe
+        if probe is not None:
+            try:
+                error = probe['result']['payload']['error']
+                tb = probe['result']['payload']['traceback']
+            except Exception as e:
+                error = str(probe['result']['payload'])
+                tb = ''.join(traceback.format_stack())
+            return {"status": "error", "payload": {"error": "The " + str(probe['name']) + " check of " + self.name + " did not pass (" + str(int(probe['seconds'] or 0)) + " seconds): " + str(error), "traceback": tb}, "probe": probe['name']}
+        return {"status": "success", "payload": dict((probe['name'], probe['result']['payload']) for probe in self.probes), "seconds": dict((probe['name'], probe['seconds']) for probe in self.probes)}
@@ -0,0 +1,180 @@
+# Copyright 2017
+#
+# Licensed under the Apache License, Version 2.0, <LICENSE-APACHE or
+# http://apache.org/licenses/LICENSE-2.0> or the MIT license <LICENSE-MIT or
+# http://opensource.org/licenses/MIT> or the LGPL, Version 2.0 <LICENSE-LGPLv2 or
+# https://www.gnu.org/licenses/old-licenses/lgpl-2.0.txt>, at your option.
+# This file may not be copied, modified, or distributed except according to those terms.
+
+
+import json
+import re
+
+
+# Small typed views of the Control Node and ccq REST responses. Each response body is decoded once (decode) and the models are built from the decoded dictionary, so the call sites no longer dig through nested dictionaries or split strings by hand.
+# The parse functions only take bytes/strings so they can be timed without a Control Node (ex: python -m timeit -s "import responseModels" "responseModels.CcqstatResult.parse(body)").
+
+# The Control Node returns the state of each instance as the string form of the cloud's state dictionary (ex: "{'Code': 16, 'Name': 'running'}"), only the Name is needed
+stateNamePattern = re.compile(r"""['"]Name['"]\s*:\s*['"]([^'"]+)['"]""")
+bareStatePattern = re.compile(r"^\w+$")
+
+# ccqsub answers with a message ending in the new job id (ex: "The job has been submitted. The job id is: 1234")
+jobIdPattern = re.compile(r":\s*([0-9A-Za-z]+)")
+
+
+def decode(response):
+    # Accepts a requests response, bytes or a string
+    content = getattr(response, "content", response)
+    if isinstance(content, bytes):
+        content = content.decode("utf-8", errors="replace")
+    return json.loads(content)
+
+
+def parseInstanceState(state):
+    # Returns the lower case state name (ex: running) or None when the state can not be parsed
+    if state is None:
+        return None
+    if isinstance(state, dict):
+        return str(state.get("Name")).lower()
+    match = stateNamePattern.search(str(state))
+    if match is not None:
+        return match.group(1).lower()
+    if bareStatePattern.match(str(state).strip()):
+        # Some clouds report the state name on its own (ex: RUNNING)
+        return str(state).strip().lower()
+    return None
+
+
+class Instance(object):
+    __slots__ = ("instanceId", "role", "domainName", "state")
+
+    def __init__(self, instanceId, role=None, domainName=None, state=None):
+        self.instanceId = str(instanceId)
+        self.role = role
+        self.domainName = domainName
+        # The parsed state name (ex: running)
+        self.state = state
+
+    @classmethod
+    def fromDict(cls, instanceId, values):
+        return cls(instanceId, values.get("RecType"), values.get("domainName"), parseInstanceState(values.get("State")))
+
+    def toDict(self):
+        return {"role": self.role, "domainName": self.domainName, "state": self.state}
+
+
+class InstanceGroup(object):
+    # One group of /srv/getSpinningClusterPart (ex: groupName "Utility" of type "Utility" or "VPC Info" of type "Network")
+    __slots__ = ("groupName", "groupType", "instances")
+
+    def __init__(self, groupName, groupType, instances):
+        self.groupName = groupName
+        self.groupType = groupType
+        # {instanceId: Instance}
+        self.instances = instances
+
+    @classmethod
+    def fromDict(cls, values, groupName, groupType):
+        instances = {}
+        for instanceId, instance in values[groupType][groupName]['instances'].items():
+            # Not every entry in the group is an instance
+            if isinstance(instance, dict):
+                instances[str(instanceId)] = Instance.fromDict(instanceId, instance)
+        return cls(groupName, groupType, instances)
+
+    @classmethod
+    def parse(cls, content, groupName, groupType):
+        return cls.fromDict(decode(content), groupName, groupType)
+
+    def withRole(self, role):
+        return [instance for instance in self.instances.values() if instance.role == role]
+
+
+class ClusterStatus(object):
+    # The answer of /srv/getSpinningCluster while an Environment is being created
+    __slots__ = ("spunUp", "error")
+
+    def __init__(self, spunUp, error):
+        self.spunUp = spunUp
+        # None while there is no error
+        self.error = error
+
+    @classmethod
+    def fromDict(cls, values):
+        error = values.get("clusterError")
+        if str(error) == "none":
+            error = None
+        return cls(str(values.get("clusterSpunUp")) == "true", error)
+
+    @classmethod
+    def parse(cls, content):
+        return cls.fromDict(decode(content))
+
+
+class CcqSubmitResult(object):
+    __slots__ = ("success", "jobId", "message", "error")
+
+    def __init__(self, success, jobId=None, message=None, error=None):
+        self.success = success
+        self.jobId = jobId
+        self.message = message
+        self.error = error
+
+    @classmethod
+    def fromDict(cls, values):
+        if values.get("status") != "success":
+            return cls(False, error=values.get("payload"))
+        message = str(values['payload']['message'])
+        match = jobIdPattern.search(message)
+        if match is None:
+            return cls(False, message=message, error="Unable to find the job id in the ccqsub response: " + message)
+        return cls(True, jobId=match.group(1), message=message)
+
+    @classmethod
+    def parse(cls, content):
+        return cls.fromDict(decode(content))
+
+
+class CcqstatRow(object):
+    __slots__ = ("jobId", "name", "state")
+
+    def __init__(self, jobId, name, state):
+        self.jobId = jobId
+        self.name = name
+        self.state = state
+
+
+class CcqstatResult(object):
+    # The ccqstat table has a header row, a separator row and then one row per job: JOBID NAME ... STATE
+    __slots__ = ("success", "message", "rows", "error")
+
+    def __init__(self, success, message=None, rows=None, error=None):
+        self.success = success
+        self.message = message
+        # {jobId: CcqstatRow}
+        self.rows = rows if rows is not None else {}
+        self.error = error
+
+    @staticmethod
+    def parseTable(message):
+        rows = {}
+        for line in str(message).split("\n"):
+            columns = line.split()
+            if len(columns) < 5 or "JOBID" in line or line.strip().strip("-= ") == "":
+                continue
+            rows[columns[0]] = CcqstatRow(columns[0], columns[1], columns[4])
+        return rows
+
+    @classmethod
+    def fromDict(cls, values):
+        if values.get("status") != "success":
+            return cls(False, error=values.get("payload"))
+        message = values['payload']['message']
+        return cls(True, message=message, rows=cls.parseTable(message))
+
+    @classmethod
+    def parse(cls, content):
+        return cls.fromDict(decode(content))
+
+    def jobMissing(self):
+        return "The specified job Id does not exist in the database." in str(self.message)
@@ -0,0 +1,122 @@
+# Copyright 2017
+#
+# Licensed under the Apache License, Version 2.0, <LICENSE-APACHE or
+# http://apache.org/licenses/LICENSE-2.0> or the MIT license <LICENSE-MIT or
+# http://opensource.org/licenses/MIT> or the LGPL, Version 2.0 <LICENSE-LGPLv2 or
+# https://www.gnu.org/licenses/old-licenses/lgpl-2.0.txt>, at your option.
+# This file may not be copied, modified, or distributed except according to those terms.
+
+
+import hashlib
+import json
+import os
+import threading
+import time
+import traceback
+from requests.cookies import RequestsCookieJar
+
+
+# The Control Node session cookies are kept on disk so separate ccAutomaton invocations (ex: -rj, then -de, then -dc) can reuse the same login instead of logging in again every time.
+# There is one file per Control Node DNS name and user, the files are only readable by the current user because the cookies are as good as the password until they expire.
+
+defaultDirectory = os.path.join(os.path.expanduser("~"), ".ccAutomaton", "sessions")
+
+
+class SessionCache(object):
+    def __init__(self, directory=None, maxAge=43200):
+        # Cookies older than maxAge seconds are not used, a maxAge of 0 turns the cache off
+        if directory is None:
+            directory = defaultDirectory
+        self.directory = str(directory)
+        self.maxAge = float(maxAge)
+        self.lock = threading.Lock()
+
+    def configure(self, directory=None, maxAge=None):
+        with self.lock:
+            if directory is not None:
+                self.directory = os.path.expanduser(str(directory))
+            if maxAge is not None:
+                self.maxAge = float(maxAge)
+
+    def enabled(self):
+        return self.maxAge > 0
+
+    def getPath(self, dnsName, userName):
+        key = hashlib.sha256((str(dnsName) + "\n" + str(userName)).encode()).hexdigest()
+        return os.path.join(self.directory, key + ".json")
+
+    def load(self, dnsName, userName):
+        # Returns the cached cookies as a RequestsCookieJar or None when there are none (or they are too old)
+        if not self.enabled() or dnsName is None:
+            return None
+        path = self.getPath(dnsName, userName)
+        try:
+            with open(path, "r") as f:
+                entry = json.load(f)
+        except Exception as e:
+            return None
+        if entry.get("dnsName") != str(dnsName) or entry.get("userName") != str(userName) or time.time() - float(entry.get("savedAt", 0)) > self.maxAge:
+            self.remove(dnsName, userName)
+            return None
+        jar = RequestsCookieJar()
+        for cookie in entry.get("cookies", []):
+            if cookie.get("expires") is not None and cookie["expires"] < time.time():
+                continue
+            jar.set(cookie['name'], cookie['value'], domain=cookie.get("domain"), path=cookie.get("path"), secure=cookie.get("secure", False), expires=cookie.get("expires"))
+        if len(jar) == 0:
+            return None
+        return jar
+
+    def save(self, dnsName, userName, cookies):
+        if not self.enabled() or dnsName is None or cookies is None:
+            return
+        entry = {"dnsName": str(dnsName), "userName": str(userName), "savedAt": time.time(), "cookies": []}
+        for cookie in cookies:
+            entry['cookies'].append({"name": cookie.name, "value": cookie.value, "domain": cookie.domain, "path": cookie.path, "secure": cookie.secure, "expires": cookie.expires})
+        path = self.getPath(dnsName, userName)
+        temporaryPath = path + "." + str(os.getpid()) + "." + str(threading.get_ident())
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory, mode=0o700)
+            # The file is written under a temporary name and renamed so another process never reads half of it
+            descriptor = os.open(temporaryPath, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(descriptor, "w") as f:
+                json.dump(entry, f)
+            os.replace(temporaryPath, path)
+        except Exception as e:
+            # The cache only saves a login, a failure to write it is not a reason to stop the run
+            print("Unable to save the session for " + str(dnsName) + " to " + str(self.directory) + ".")
+            print(''.join(traceback.format_exc()))
+            try:
+                os.remove(temporaryPath)
+            except Exception as e:
+                pass
+
+    def remove(self, dnsName, userName):
+        try:
+            os.remove(self.getPath(dnsName, userName))
+        except Exception as e:
+            pass
+
+
+# Process wide cache shared by all of the Environment classes
+sessionCache = SessionCache()
+
+
+def configureFromParameters(parameters):
+    # Reads the optional sessionCache* fields from a configuration file section (normally General)
+    if not parameters:
+        return
+    sessionCache.configure(directory=parameters.get("sessioncachedirectory"), maxAge=parameters.get("sessioncachemaxage"))
+
+
+def load(dnsName, userName):
+    return sessionCache.load(dnsName, userName)
+
+
+def save(dnsName, userName, cookies):
+    sessionCache.save(dnsName, userName, cookies)
+
+
+def remove(dnsName, userName):
+    sessionCache.remove(dnsName, userName)
@@ -0,0 +1,132 @@
+# Copyright 2017
+#
+# Licensed under the Apache License, Version 2.0, <LICENSE-APACHE or
+# http://apache.org/licenses/LICENSE-2.0> or the MIT license <LICENSE-MIT or
+# http://opensource.org/licenses/MIT> or the LGPL, Version 2.0 <LICENSE-LGPLv2 or
+# https://www.gnu.org/licenses/old-licenses/lgpl-2.0.txt>, at your option.
+# This file may not be copied, modified, or distributed except according to those terms.
+
+
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+import fanOut
+
+
+class Stage(object):
+    def __init__(self, name, function, dependsOn, description):
+        self.name = name
+        self.function = function
+        self.dependsOn = dependsOn
+        self.description = description
+
+        # We will set these values when the stage runs
+        self.status = "pending"
+        self.result = None
+        self.startTime = None
+        self.endTime = None
+
+
+class StageGraph(object):
+    # Runs a set of stages (functions that return the usual {"status": ..., "payload": ...} dictionary) as soon as the stages they depend on have succeeded.
+    # Stages that do not depend on each other run at the same time. Once a stage fails no new stages are started, the running ones are allowed to finish and the error is returned.
+    def __init__(self, maxWorkers=4, stageCallback=None):
+        self.maxWorkers = int(maxWorkers)
+        self.stages = {}
+        self.order = []
+        # Called with (name, status) every time a stage changes status, used to record the progress of the run
+        self.stageCallback = stageCallback
+
+    def addStage(self, name, function, dependsOn=None, description=None):
+        if name in self.stages:
+            return {"status": "error", "payload": {"error": "The stage " + str(name) + " has already been added.", "traceback": ''.join(traceback.format_stack())}}
+        self.stages[name] = Stage(name, function, list(dependsOn or []), description or name)
+        self.order.append(name)
+        return {"status": "success", "payload": self.stages[name]}
+
+    def resolveDependencies(self):
+        # Dependencies on stages that were not requested for this run are dropped (ex: running only -rj does not wait on cc)
+        for name in self.order:
+            stage = self.stages[name]
+            stage.dependsOn = [dependency for dependency in stage.dependsOn if dependency in self.stages]
+
+        # Make sure there are no cycles, otherwise the stages in the cycle would never start
+        remaining = dict((name, set(self.stages[name].dependsOn)) for name in self.order)
+        while remaining:
+            ready = [name for name in remaining if len(remaining[name]) == 0]
+            if len(ready) == 0:
+                return {"status": "error", "payload": {"error": "The stages " + str(sorted(remaining)) + " depend on each other and can never run.", "traceback": ''.join(traceback.format_stack())}}
+            for name in ready:
+                del remaining[name]
+            for name in remaining:
+                remaining[name].difference_update(ready)
+        return {"status": "success", "payload": None}
+
+    def setStatus(self, stage, status):
+        stage.status = status
+        if self.stageCallback is not None:
+            try:
+                self.stageCallback(stage.name, status)
+            except Exception as e:
+                print("Unable to record the " + str(status) + " status of the " + str(stage.name) + " stage.")
+                print(''.join(traceback.format_exc()))
+
+    def runStage(self, stage):
+        stage.startTime = time.time()
+        try:
+            values = stage.function()
+            if values is None:
+                values = {"status": "success", "payload": None}
+        except BaseException as e:
+            # BaseException so that a stray sys.exit() in a stage fails the stage instead of silently killing the worker thread
+            values = {"status": "error", "payload": {"error": "The " + str(stage.description) + " stage raised an exception.", "traceback": ''.join(traceback.format_exc())}}
+        stage.endTime = time.time()
+        return values
+
+    def run(self):
+        values = self.resolveDependencies()
+        if values['status'] != "success":
+            return values
+
+        failedStage = None
+        running = {}
+        with ThreadPoolExecutor(max_workers=max(1, self.maxWorkers)) as executor:
+            while True:
+                if failedStage is None:
+                    for name in self.order:
+                        stage = self.stages[name]
+                        if stage.status != "pending":
+                            continue
+                        if all(self.stages[dependency].status == "success" for dependency in stage.dependsOn):
+                            self.setStatus(stage, "running")
+                            running[fanOut.submit(executor, self.runStage, stage)] = stage
+
+                if len(running) == 0:
+                    break
+
+                done, notDone = wait(list(running), return_when=FIRST_COMPLETED)
+                for future in done:
+                    stage = running.pop(future)
+                    stage.result = future.result()
+                    if stage.result['status'] == "success":
+                        self.setStatus(stage, "success")
+                    else:
+                        self.setStatus(stage, "error")
+                        if failedStage is None:
+                            failedStage = stage
+
+        if failedStage is not None:
+            for name in self.order:
+                if self.stages[name].status == "pending":
+                    self.setStatus(self.stages[name], "skipped")
+            return {"status": "error", "payload": failedStage.result['payload'], "stage": failedStage.name}
+        return {"status": "success", "payload": dict((name, self.stages[name].result) for name in self.order)}
+
+    def printSummary(self):
+        for name in self.order:
+            stage = self.stages[name]
+            if stage.startTime is not None and stage.endTime is not None:
+                print("The " + str(stage.description) + " stage (" + str(name) + ") finished with status " + str(stage.status) + " in " + str(int(stage.endTime - stage.startTime)) + " seconds.")
+            else:
+                print("The " + str(stage.description) + " stage (" + str(name) + ") was " + str(stage.status) + ".")
@@ -0,0 +1,180 @@
+# Copyright 2017
+#
+# Licensed under the Apache License, Version 2.0, <LICENSE-APACHE or
+# http://apache.org/licenses/LICENSE-2.0> or the MIT license <LICENSE-MIT or
+# http://opensource.org/licenses/MIT> or the LGPL, Version 2.0 <LICENSE-LGPLv2 or
+# https://www.gnu.org/licenses/old-licenses/lgpl-2.0.txt>, at your option.
+# This file may not be copied, modified, or distributed except according to those terms.
+
+
+import json
+import os
+import sqlite3
+import threading
+import time
+import traceback
+import uuid
+
+
+# Every run of ccAutomaton records the resources it creates, the stages it has finished and the jobs it has submitted in a small SQLite database.
+# Each change is written in its own transaction as soon as it happens so a run that crashes can be resumed (--resume) or cleaned up (-dff) from the last recorded state.
+
+defaultPath = "ccAutomatonState.db"
+
+# The job states after which a job is no longer monitored
+finishedJobStates = ["Completed", "Error", "Killed"]
+
+schema = [
+    "CREATE TABLE IF NOT EXISTS runs (runId TEXT PRIMARY KEY, environmentType TEXT, configFilePath TEXT, stages TEXT, status TEXT, createdAt REAL, updatedAt REAL)",
+    "CREATE TABLE IF NOT EXISTS stages (runId TEXT, stage TEXT, status TEXT, updatedAt REAL, PRIMARY KEY (runId, stage))",
+    "CREATE TABLE IF NOT EXISTS resources (runId TEXT, kind TEXT, value TEXT, status TEXT, updatedAt REAL, PRIMARY KEY (runId, kind))",
+    "CREATE TABLE IF NOT EXISTS jobs (runId TEXT, name TEXT, jobName TEXT, jobId TEXT, schedulerName TEXT, state TEXT, updatedAt REAL, PRIMARY KEY (runId, name))",
+    # The warm Control Resources shared between runs, see controlPool.py
+    "CREATE TABLE IF NOT EXISTS controlPool (controlResourceName TEXT PRIMARY KEY, poolKey TEXT, dnsName TEXT, controlStack TEXT, status TEXT, leasedBy TEXT, leaseExpiresAt REAL, lastUsedAt REAL, createdAt REAL)",
+]
+
+# The resource statuses after which a resource no longer belongs to the run, released is used for Control Resources that were handed back to the Control Node pool
+goneStatuses = ["deleted", "released"]
+
+
+class StateStore(object):
+    def __init__(self, path=None):
+        if path is None:
+            path = defaultPath
+        self.path = str(path)
+        # The stages and the job monitor write from several threads so the single connection is shared behind a lock
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        self.connection.row_factory = sqlite3.Row
+        with self.lock:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            with self.connection:
+                for statement in schema:
+                    self.connection.execute(statement)
+
+    def execute(self, statement, parameters=()):
+        # Each call is its own transaction, it is committed before execute returns
+        with self.lock:
+            with self.connection:
+                return self.connection.execute(statement, parameters).fetchall()
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+    def createRun(self, environmentType, configFilePath, stages):
+        runId = str(uuid.uuid4())
+        now = time.time()
+        if configFilePath is not None:
+            # Runs are looked up by their configuration file (see getLatestResource) so the path is stored the same way no matter where ccAutomaton was started from
+            configFilePath = os.path.abspath(str(configFilePath))
+        self.execute("INSERT INTO runs (runId, environmentType, configFilePath, stages, status, createdAt, updatedAt) VALUES (?, ?, ?, ?, ?, ?, ?)", (runId, environmentType, configFilePath, json.dumps(list(stages)), "running", now, now))
+        return RunState(self, runId)
+
+    def getRun(self, runId=None, configFilePath=None):
+        # Without a runId the most recent run that did not finish successfully is returned, limited to the runs of configFilePath when it is given
+        if runId is None and configFilePath is not None:
+            rows = self.execute("SELECT * FROM runs WHERE status IN ('running', 'error') AND configFilePath = ? ORDER BY createdAt DESC LIMIT 1", (os.path.abspath(str(configFilePath)),))
+        elif runId is None:
+            rows = self.execute("SELECT * FROM runs WHERE status IN ('running', 'error') ORDER BY createdAt DESC LIMIT 1")
+        else:
+            rows = self.execute("SELECT * FROM runs WHERE runId = ?", (str(runId),))
+        if len(rows) == 0:
+            if runId is None:
+                error = "There are no unfinished runs recorded in " + str(self.path) + "."
+            else:
+                error = "The run " + str(runId) + " is not recorded in " + str(self.path) + "."
+            return {"status": "error", "payload": {"error": error, "traceback": ''.join(traceback.format_stack())}}
+        return {"status": "success", "payload": RunState(self, rows[0]['runId'])}
+
+    def getLatestResource(self, kind, configFilePath=None):
+        # Used when a stage is run on its own (ex: -rj or -dff) and needs the resources created by an earlier run
+        # When several configuration files share the database only the runs of the same configuration file are used. The run imported from a legacy infoFile does not say which configuration file it belongs to, so it is only used while no other configuration file has runs in the database.
+        if configFilePath is None:
+            rows = self.execute("SELECT resources.runId, resources.value FROM resources WHERE kind = ? AND status NOT IN ('deleted', 'released') ORDER BY updatedAt DESC LIMIT 1", (str(kind),))
+        else:
+            configFilePath = os.path.abspath(str(configFilePath))
+            others = self.execute("SELECT COUNT(*) AS count FROM runs WHERE configFilePath IS NOT NULL AND configFilePath != ?", (configFilePath,))
+            if others[0]['count'] == 0:
+                rows = self.execute("SELECT resources.runId, resources.value FROM resources JOIN runs ON resources.runId = runs.runId WHERE resources.kind = ? AND resources.status NOT IN ('deleted', 'released') AND (runs.configFilePath = ? OR runs.configFilePath IS NULL) ORDER BY runs.configFilePath IS NULL, resources.updatedAt DESC LIMIT 1", (str(kind), configFilePath))
+            else:
+                rows = self.execute("SELECT resources.runId, resources.value FROM resources JOIN runs ON resources.runId = runs.runId WHERE resources.kind = ? AND resources.status NOT IN ('deleted', 'released') AND runs.configFilePath = ? ORDER BY resources.updatedAt DESC LIMIT 1", (str(kind), configFilePath))
+        if len(rows) == 0:
+            return None
+        return {"runId": rows[0]['runId'], "value": rows[0]['value']}
+
+    def importInfoFile(self, path="infoFile"):
+        # Older versions of ccAutomaton wrote the run state to a plain text infoFile (controlResources=, controlDNS=, envName=), it is imported once as a run of its own
+        if not os.path.isfile(path):
+            return None
+        values = {}
+        with open(path, 'r') as f:
+            for line in f:
+                if "=" in line:
+                    location = line.index('=')
+                    values[line[:location].strip()] = line[location+1:].strip()
+        runState = self.createRun(None, None, [])
+        if values.get("controlResources"):
+            runState.setResource("controlResources", values["controlResources"], "created")
+        if values.get("controlDNS"):
+            runState.setResource("controlDNS", values["controlDNS"], "created")
+        if values.get("envName"):
+            runState.setResource("environment", values["envName"], "created")
+        runState.finish("imported")
+        os.rename(path, path + ".imported")
+        print("Imported the run state from the legacy " + str(path) + " file.")
+        return runState
+
+
+class RunState(object):
+    # The state of a single run, passed to the stages and the Environment so they can record changes as they happen
+    def __init__(self, store, runId):
+        self.store = store
+        self.runId = runId
+
+    def getRun(self):
+        rows = self.store.execute("SELECT * FROM runs WHERE runId = ?", (self.runId,))
+        run = dict(rows[0])
+        run['stages'] = json.loads(run['stages'] or "[]")
+        return run
+
+    def finish(self, status):
+        self.store.execute("UPDATE runs SET status = ?, updatedAt = ? WHERE runId = ?", (str(status), time.time(), self.runId))
+
+    def setStage(self, stage, status):
+        self.store.execute("INSERT OR REPLACE INTO stages (runId, stage, status, updatedAt) VALUES (?, ?, ?, ?)", (self.runId, str(stage), str(status), time.time()))
+
+    def getStages(self):
+        return dict((row['stage'], row['status']) for row in self.store.execute("SELECT stage, status FROM stages WHERE runId = ?", (self.runId,)))
+
+    def setResource(self, kind, value, status):
+        # kind is one of controlResources, controlStack, controlDNS or environment. The status moves from creating to created to deleted (or released).
+        self.store.execute("INSERT OR REPLACE INTO resources (runId, kind, value, status, updatedAt) VALUES (?, ?, ?, ?, ?)", (self.runId, str(kind), str(value), str(status), time.time()))
+
+    def setResourceStatus(self, kind, status):
+        self.store.execute("UPDATE resources SET status = ?, updatedAt = ? WHERE runId = ? AND kind = ?", (str(status), time.time(), self.runId, str(kind)))
+
+    def getResources(self):
+        # Returns {kind: {"value": ..., "status": ...}}
+        return dict((row['kind'], {"value": row['value'], "status": row['status']}) for row in self.store.execute("SELECT kind, value, status FROM resources WHERE runId = ?", (self.runId,)))
+
+    def getResource(self, kind, includeDeleted=False):
+        resource = self.getResources().get(str(kind))
+        if resource is None or (resource['status'] in goneStatuses and not includeDeleted):
+            return None
+        return resource['value']
+
+    def setJob(self, name, jobName=None, jobId=None, schedulerName=None, state=None):
+        # name is the key of the job in the Computation section (ex: jobscript1), values that are not passed in keep what was recorded before
+        with self.store.lock:
+            with self.store.connection:
+                rows = self.store.connection.execute("SELECT jobName, jobId, schedulerName, state FROM jobs WHERE runId = ? AND name = ?", (self.runId, str(name))).fetchall()
+                if len(rows) != 0:
+                    jobName = jobName if jobName is not None else rows[0]['jobName']
+                    jobId = jobId if jobId is not None else rows[0]['jobId']
+                    schedulerName = schedulerName if schedulerName is not None else rows[0]['schedulerName']
+                    state = state if state is not None else rows[0]['state']
+                self.store.connection.execute("INSERT OR REPLACE INTO jobs (runId, name, jobName, jobId, schedulerName, state, updatedAt) VALUES (?, ?, ?, ?, ?, ?, ?)", (self.runId, str(name), jobName, None if jobId is None else str(jobId), schedulerName, state, time.time()))
+
+    def getJobs(self):
+        return dict((row['name'], dict(row)) for row in self.store.execute("SELECT name, jobName, jobId, schedulerName, state FROM jobs WHERE runId = ?", (self.runId,)))
@@ -0,0 +1,220 @@
+# Copyright 2017
+#
+# Licensed under the Apache License, Version 2.0, <LICENSE-APACHE or
+# http://apache.org/licenses/LICENSE-2.0> or the MIT license <LICENSE-MIT or
+# http://opensource.org/licenses/MIT> or the LGPL, Version 2.0 <LICENSE-LGPLv2 or
+# https://www.gnu.org/licenses/old-licenses/lgpl-2.0.txt>, at your option.
+# This file may not be copied, modified, or distributed except according to those terms.
+
+
+import math
+import threading
+import time
+import traceback
+
+
+# Keeps the provisioned throughput of the Control Node's Database Tables in line with the load while jobs are running.
+# A background thread samples the consumed capacity and the throttled requests every interval seconds (sample) and applies new capacities (apply) when the tables throttle or sit mostly idle. The capacity is also raised before a batch of jobs is submitted, the capacity held for the jobs shrinks as each one finishes and it is brought back down once all of them have drained.
+#
+# Usage:
+#     manager = throughputManager.ThroughputManager(sample, apply, baseRead=5, baseWrite=5, maxRead=100, maxWrite=100)
+#     manager.start()
+#     manager.prepareForJobs(len(jobs))
+#     ... submit and monitor the jobs, calling manager.jobFinished() once for each job that is done ...
+#     manager.stop()
+#
+# sample() returns the usual {"status": ..., "payload": usage} dictionary where usage maps each table name to {"provisionedRead", "provisionedWrite", "consumedRead", "consumedWrite", "readThrottles", "writeThrottles"} (the consumed capacity is in units per second), None for a provisioned value means the table is billed per request.
+# apply(read, write) changes the capacity of every table and returns the usual dictionary.
+
+
+class ThroughputManager(object):
+    def __init__(self, sample, apply, baseRead, baseWrite, maxRead=None, maxWrite=None, capacityPerJob=1, interval=60, highUtilization=0.8, lowUtilization=0.2, decreaseCooldown=3600):
+        self.sample = sample
+        self.apply = apply
+        self.baseRead = max(1, int(baseRead))
+        self.baseWrite = max(1, int(baseWrite))
+        # Without a maximum the capacity can grow to four times the configured capacity
+        self.maxRead = max(self.baseRead, int(maxRead)) if maxRead is not None else self.baseRead * 4
+        self.maxWrite = max(self.baseWrite, int(maxWrite)) if maxWrite is not None else self.baseWrite * 4
+        self.capacityPerJob = max(0.0, float(capacityPerJob))
+        self.interval = max(1.0, float(interval))
+        self.highUtilization = float(highUtilization)
+        self.lowUtilization = float(lowUtilization)
+        # DynamoDB only allows a few decreases per table per day, the decreases made because the tables are idle are spaced out by this many seconds (the one made when the jobs have drained is always made)
+        self.decreaseCooldown = max(0.0, float(decreaseCooldown))
+
+        # The capacity we last applied (None until the first sample or adjustment)
+        self.read = None
+        self.write = None
+        self.pendingJobs = 0
+        self.lastDecrease = None
+        self.adjustments = []
+        self.stopEvent = threading.Event()
+        self.thread = None
+        self.lock = threading.Lock()
+        # Held while a new capacity is applied so only one change is in flight at a time, the bookkeeping lock is not held during apply
+        self.applyLock = threading.Lock()
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="throughputManager", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopEvent.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def getFloor(self):
+        # The capacity held while jobs are pending, it goes back to the base capacity once they have drained
+        return min(self.maxRead, int(math.ceil(self.baseRead + self.pendingJobs * self.capacityPerJob))), min(self.maxWrite, int(math.ceil(self.baseWrite + self.pendingJobs * self.capacityPerJob)))
+
+    def readCurrent(self):
+        # The capacity the tables have before we change anything, so preparing for jobs never lowers it
+        with self.lock:
+            if self.read is not None:
+                return
+        values = self.sample()
+        if values['status'] != "success" or len(values['payload']) == 0:
+            return
+        usage = values['payload'].values()
+        if any(table['provisionedRead'] is None or table['provisionedWrite'] is None for table in usage):
+            return
+        with self.lock:
+            if self.read is None:
+                self.read = max(table['provisionedRead'] for table in usage)
+                self.write = max(table['provisionedWrite'] for table in usage)
+
+    def prepareForJobs(self, jobs):
+        # Raises the capacity ahead of a batch submission instead of waiting for the tables to throttle
+        self.readCurrent()
+        with self.lock:
+            self.pendingJobs += max(0, int(jobs))
+
+        def target():
+            floorRead, floorWrite = self.getFloor()
+            read = max(floorRead, self.read or 0)
+            write = max(floorWrite, self.write or 0)
+            if (read, write) == (self.read, self.write):
+                return None
+            return read, write, "preparing for " + str(jobs) + " jobs (" + str(self.pendingJobs) + " pending)"
+        return self.adjust(target)
+
+    def jobFinished(self):
+        # Called once for every job that is done (or was never submitted), the capacity goes back to the base capacity when the last one finishes
+        with self.lock:
+            self.pendingJobs = max(0, self.pendingJobs - 1)
+            if self.pendingJobs > 0:
+                return {"status": "success", "payload": None}
+        return self.drain()
+
+    def jobsDrained(self):
+        with self.lock:
+            self.pendingJobs = 0
+        return self.drain()
+
+    def drain(self):
+        def target():
+            # Jobs may have been prepared again since the last one finished
+            if self.pendingJobs > 0 or self.read is None or (self.read, self.write) == (self.baseRead, self.baseWrite):
+                return None
+            return self.baseRead, self.baseWrite, "the jobs have drained"
+        return self.adjust(target)
+
+    def adjust(self, target):
+        # target is called with the lock held and returns (read, write, reason), or None when the capacity is fine as it is.
+        # It is only worked out once any earlier change has been applied so it never starts from stale values, and apply (which waits for the tables to be active again) runs without the lock so the job bookkeeping is never held up by it.
+        with self.applyLock:
+            with self.lock:
+                change = target()
+                if change is None:
+                    return {"status": "success", "payload": None}
+                read, write, reason = change
+                fromRead, fromWrite = self.read, self.write
+            print("DynamoDB throughput: read " + str(fromRead) + " -> " + str(read) + ", write " + str(fromWrite) + " -> " + str(write) + " (" + reason + ").")
+            values = self.apply(read, write)
+            with self.lock:
+                entry = {"time": time.time(), "fromRead": fromRead, "toRead": read, "fromWrite": fromWrite, "toWrite": write, "reason": reason, "status": values['status']}
+                self.adjustments.append(entry)
+                if values['status'] == "success":
+                    if (fromRead is not None and read < fromRead) or (fromWrite is not None and write < fromWrite):
+                        self.lastDecrease = time.monotonic()
+                    self.read = read
+                    self.write = write
+            if values['status'] != "success":
+                print("Unable to change the DynamoDB throughput.")
+                try:
+                    print(values['payload']['error'])
+                except Exception as e:
+                    print(values.get("payload"))
+            return values
+
+    def decide(self, provisioned, consumed, throttles, floor, maximum, allowDecrease):
+        # Returns the new capacity for one dimension (read or write)
+        if provisioned is None:
+            return None
+        utilization = consumed / float(provisioned) if provisioned else 1.0
+        if throttles > 0 or utilization > self.highUtilization:
+            # Enough capacity for the consumed units to sit at half of it, at least double what is there
+            return max(provisioned, min(maximum, max(provisioned * 2, int(math.ceil(consumed / 0.5)), floor)))
+        if allowDecrease and utilization < self.lowUtilization and provisioned > floor:
+            return max(floor, int(math.ceil(consumed / 0.5)))
+        return max(provisioned, floor)
+
+    def check(self):
+        values = self.sample()
+        if values['status'] != "success":
+            print("Unable to sample the DynamoDB throughput, trying again in " + str(int(self.interval)) + " seconds.")
+            try:
+                print(values['payload']['error'])
+            except Exception as e:
+                print(values.get("payload"))
+            return values
+        usage = values['payload']
+        if len(usage) == 0:
+            return {"status": "success", "payload": None}
+        if any(table['provisionedRead'] is None or table['provisionedWrite'] is None for table in usage.values()):
+            return {"status": "error", "payload": {"error": "The Database Tables are billed per request, there is no throughput to manage.", "traceback": ''.join(traceback.format_stack())}, "final": True}
+
+        # Every table gets the same capacity (see apply) so the busiest table decides
+        provisionedRead = max(table['provisionedRead'] for table in usage.values())
+        provisionedWrite = max(table['provisionedWrite'] for table in usage.values())
+        consumedRead = max(table['consumedRead'] for table in usage.values())
+        consumedWrite = max(table['consumedWrite'] for table in usage.values())
+        readThrottles = sum(table['readThrottles'] for table in usage.values())
+        writeThrottles = sum(table['writeThrottles'] for table in usage.values())
+
+        def target():
+            if self.read is None:
+                self.read, self.write = provisionedRead, provisionedWrite
+            floorRead, floorWrite = self.getFloor()
+            allowDecrease = self.lastDecrease is None or time.monotonic() - self.lastDecrease >= self.decreaseCooldown
+            read = self.decide(self.read, consumedRead, readThrottles, floorRead, self.maxRead, allowDecrease)
+            write = self.decide(self.write, consumedWrite, writeThrottles, floorWrite, self.maxWrite, allowDecrease)
+            if (read, write) == (self.read, self.write):
+                return None
+            reasons = []
+            if readThrottles or writeThrottles:
+                reasons.append(str(readThrottles) + " throttled reads and " + str(writeThrottles) + " throttled writes")
+            reasons.append("consuming %.1f read and %.1f write units per second" % (consumedRead, consumedWrite))
+            return read, write, ", ".join(reasons)
+        return self.adjust(target)
+
+    def run(self):
+        while not self.stopEvent.wait(self.interval):
+            try:
+                values = self.check()
+                if values.get("final"):
+                    print(values['payload']['error'])
+                    return
+            except Exception as e:
+                print("There was a problem managing the DynamoDB throughput.")
+                print(''.join(traceback.format_exc()))
+
+    def getPendingJobs(self):
+        with self.lock:
+            return self.pendingJobs
+
+    def describe(self):
+        with self.lock:
+            return str(len(self.adjustments)) + " throughput adjustments, read " + str(self.read) + ", write " + str(self.write)
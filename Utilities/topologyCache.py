@@ -0,0 +1,96 @@
+# Copyright 2017
+#
+# Licensed under the Apache License, Version 2.0, <LICENSE-APACHE or
+# http://apache.org/licenses/LICENSE-2.0> or the MIT license <LICENSE-MIT or
+# http://opensource.org/licenses/MIT> or the LGPL, Version 2.0 <LICENSE-LGPLv2 or
+# https://www.gnu.org/licenses/old-licenses/lgpl-2.0.txt>, at your option.
+# This file may not be copied, modified, or distributed except according to those terms.
+
+
+import threading
+import time
+
+
+# The instance groups of each Environment (which instances exist, their role and their DNS name) rarely change once the Environment is up, so they are fetched from the Control Node once and shared by every job script, workflow and scheduler call.
+# A topology is a dictionary of {groupName: {instanceId: {"role": ..., "domainName": ..., "state": ...}}}. Entries expire after the TTL and are dropped explicitly when the Environment is created, changed or deleted.
+
+
+class TopologyCache(object):
+    def __init__(self, ttl=300):
+        self.ttl = float(ttl)
+        self.entries = {}
+        # One lock per Environment so that only one thread fetches a topology while the others wait for it
+        self.fetchLocks = {}
+        self.lock = threading.Lock()
+
+    def configure(self, ttl=None):
+        with self.lock:
+            if ttl is not None:
+                self.ttl = float(ttl)
+
+    def getFetchLock(self, key):
+        with self.lock:
+            if key not in self.fetchLocks:
+                self.fetchLocks[key] = threading.Lock()
+            return self.fetchLocks[key]
+
+    def getCached(self, key, maxAge=None):
+        if maxAge is None:
+            maxAge = self.ttl
+        with self.lock:
+            entry = self.entries.get(key)
+        if entry is not None and time.time() - entry['fetchedAt'] <= maxAge:
+            return entry['topology']
+        return None
+
+    def get(self, key, fetch, maxAge=None):
+        # fetch() returns the usual {"status": ..., "payload": topology} dictionary and is only called when there is no cached topology younger than maxAge
+        topology = self.getCached(key, maxAge)
+        if topology is not None:
+            return {"status": "success", "payload": topology}
+        with self.getFetchLock(key):
+            # Another thread may have fetched it while we were waiting for the lock
+            topology = self.getCached(key, maxAge)
+            if topology is not None:
+                return {"status": "success", "payload": topology}
+            values = fetch()
+            if values['status'] == "success":
+                with self.lock:
+                    self.entries[key] = {"topology": values['payload'], "fetchedAt": time.time()}
+            return values
+
+    def invalidate(self, key=None):
+        with self.lock:
+            if key is None:
+                self.entries = {}
+            else:
+                self.entries.pop(key, None)
+
+    def invalidateControl(self, dnsName):
+        # Drops the topologies of every Environment on the Control Resources
+        with self.lock:
+            for key in [key for key in self.entries if key[0] == str(dnsName)]:
+                self.entries.pop(key, None)
+
+
+# Process wide cache shared by all of the Environment classes (and their copies)
+topologyCache = TopologyCache()
+
+
+def configureFromParameters(parameters):
+    # Reads the optional topologyCacheTtl field from a configuration file section (normally General)
+    if not parameters:
+        return
+    topologyCache.configure(ttl=parameters.get("topologycachettl"))
+
+
+def get(key, fetch, maxAge=None):
+    return topologyCache.get(key, fetch, maxAge)
+
+
+def invalidate(key=None):
+    topologyCache.invalidate(key)
+
+
+def invalidateControl(dnsName):
+    topologyCache.invalidateControl(dnsName)
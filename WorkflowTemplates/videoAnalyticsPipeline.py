@@ -16,6 +16,9 @@ from workflow import Workflow
 
 sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
 sys.path.append(os.path.join(os.path.dirname(__file__), '../Schedulers'))
+sys.path.append(os.path.join(os.path.dirname(__file__), '../Utilities'))
+
+import poller
 
 
 class VideoAnalyticsPipeline(Workflow):
@@ -53,7 +56,7 @@ class VideoAnalyticsPipeline(Workflow):
         else:
             ccOptionsParsed = values['payload']['ccOptionsParsed']
             jobMD5Hash = values['payload']['jobMD5Hash']
-            values = self.environment.getApiKey()
+            values = self.ccq.getOrGenerateApiKey(self.environment)
             if values['status'] != "success":
                 return {"status": "error", "payload": values['payload']}
             else:
@@ -95,6 +98,7 @@ class VideoAnalyticsPipeline(Workflow):
     def monitor(self, jobId, apiKey, loginDomain, jobPrefixString, startTime):
         # We have successfully submitted the job to ccq the instances and experiments should be creating/running now. We now need to monitor the job's statuses to see when they finish
         jobCompleted = False
+        jobPoll = poller.Poller("workflowJob", maxInterval=120)
         print("Now monitoring the status of the CCQ job.")
         resourceTime = None
         while not jobCompleted:
@@ -121,16 +125,17 @@ class VideoAnalyticsPipeline(Workflow):
                         print("The CCQ job has successfully completed.")
                         jobCompleted = True
                     else:
-                        print("The job is still creating the requested resources, waiting two minutes before checking the status again.")
-                        time.sleep(120)
+                        print("The job is still creating the requested resources, waiting before checking the status again.")
+                        jobPoll.wait()
                 else:
-                    print("The job is still running, waiting two minutes before checking the status again.")
-                    time.sleep(120)
+                    print("The job is still running, waiting before checking the status again.")
+                    jobPoll.wait()
 
         # Check the status of the jobs that are submitted by the experiment and exit when they finish properly.
         workflowJobsCompleted = False
+        workflowPoll = poller.Poller("workflowJobs", maxInterval=30)
         while not workflowJobsCompleted:
-            time.sleep(30)
+            workflowPoll.wait()
             values = self.environment.getJobState("all", apiKey, self.options['schedulerToUse'], loginDomain, True, jobPrefixString, self.schedulerType)
             if values['status'] != "success":
                 return {"status": "error", "payload": values['payload']}
@@ -139,7 +144,7 @@ class VideoAnalyticsPipeline(Workflow):
                     workflowJobsCompleted = True
                     print("All of the jobs submitted by the workflow have completed.")
                 else:
-                    print("The jobs submitted by the experiment are still running, checking again in 30 seconds.")
+                    print("The jobs submitted by the experiment are still running, checking again shortly.")
         endTime = time.time()
         tempTime = endTime - startTime
         print("Total time elapsed is: " + str(tempTime) + " seconds.")
@@ -14,7 +14,8 @@ import termios
 import time
 from urllib.request import Request, urlopen
 
-import googleapiclient.discovery
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), "Utilities"))
+import gcpClients
 
 logger = logging.getLogger("tester")
 
@@ -484,18 +485,9 @@ def make_cft(url, output):
     json.dump(template, f)
     f.close()
 
-def main():
-    if len(sys.argv) > 1:
-        filename = sys.argv[1]
-    else:
-        filename = "tester.config"
-
-    try:
-        os.stat(filename)
-    except FileNotFoundError:
-        logger.critical(f"configuration file {filename} not found")
-        sys.exit(1)
-
+def prepare(filename, output_dir, output_name, name=None):
+    # Reads one tester configuration, builds the image if needed and writes out the automaton configuration file and template for it.
+    # name is only set when several tester configurations are run together, it keeps their files apart.
     cp = configparser.ConfigParser()
     cp.read_file(open(filename))
 
@@ -531,20 +523,12 @@ def main():
         subnet_id = cp.get("tester", "subnet_id")
         cft_url = cp.get("tester", "cft_url")
 
-    try:
-        output_part1 = cp.get("tester", "output_part1")
-        output_part2 = cp.get("tester", "output_part2")
-    except configparser.NoSectionError:
-        logger.critical("missing configuration section")
-        sys.exit(1)
-    except configparser.NoOptionError:
-        logger.critical("Error: missing options in config file")
-        sys.exit(1)
-
-    output_part2 = time.strftime(output_part2)
-    output_dir = output_part1 + output_part2
-    start = time.time()
-    os.mkdir(output_dir)
+    template_name = "tester_template"
+    cft_file = "cloudyClusterCloudFormationTemplate.json"
+    if name:
+        confFile = f"{name}_{confFile}"
+        template_name = f"{name}_{template_name}"
+        cft_file = f"{name}_{cft_file}"
 
     if dev_image == "true":
         dev_image = True
@@ -577,19 +561,6 @@ def main():
         logger.critical("email not set to true or false")
         sys.exit(1)
 
-    stdout_handler = logging.StreamHandler(sys.stdout)
-    logging.root.addHandler(stdout_handler)
-
-    file_handler = logging.FileHandler(f"{output_dir}/tester.log", "a", "utf-8")
-    formatter = logging.Formatter("%(asctime)s>%(levelname)s:%(module)s:%(funcName)s-%(message)s")
-    file_handler.setFormatter(formatter)
-    logging.root.addHandler(file_handler)
-
-    logging.root.setLevel(logging.INFO)
-    
-    logger.info(f"The start time is: {output_part2}")
-
-    
     if not dev_image:
         os.chdir("../CloudyCluster")
         output, fail = run(["git", "pull", "--ff-only"], die=False)
@@ -597,7 +568,7 @@ def main():
             logger.warning("could not update CloudyCluster; continuing anyway")
         os.chdir("Build")
         current_build = run(["git", "describe", "--always"])[0].strip()
-        compute = googleapiclient.discovery.build("compute", "v1")
+        compute = gcpClients.getClient("compute", "v1")
         images = compute.images().list(project=project_name).execute()
         image_id = None
         for image in images["items"]:
@@ -651,7 +622,7 @@ def main():
 
         ready = False
         while not ready:
-            compute_client = googleapiclient.discovery.build("compute", "v1")
+            compute_client = gcpClients.getClient("compute", "v1")
             request = compute_client.images().get(project=project_name, image=image)
             res = request.execute()
             if res["status"] != "READY":
@@ -717,12 +688,12 @@ publicSubnet: {subnet_id}
 capabilities: CAPABILITY_IAM
 region: {region}
 ImageId: {sourceimage}
-templateLocation: cloudyClusterCloudFormationTemplate.json
+templateLocation: {cft_file}
 
 # Can use a pre-created template if the user doesn't want to do the advanced stuff
 # This is the section that will be run when spinning up a new environment
 [CloudyClusterEnvironment]
-templateName: tester_template
+templateName: {template_name}
 keyName: {KeyName}
 region: {region}
 az: {az}
@@ -734,7 +705,7 @@ az: {az}
 {job_config}
 
 # Template definitions
-[tester_template]
+[{template_name}]
 description: Creates a CloudyCluster Environment that contains a single {env_instance_type} CCQ enabled {scheduler} Scheduler, a {env_instance_type} Login instance, EFS backed shared home directories, a EFS backed shared filesystem, and a {env_instance_type} NAT instance.
 vpcCidr: 10.0.0.0/16
 fsChoice: OrangeFS
@@ -746,7 +717,7 @@ s3: {{"name": "testerbucket", "type": "common", "encrypt": "true"}}
 """)
         f.close()
 
-        make_cft(cft_url, "cloudyClusterCloudFormationTemplate.json")
+        make_cft(cft_url, cft_file)
 
     else:
         f = open(f"ConfigurationFiles/{confFile}", "w")
@@ -780,7 +751,7 @@ projectId: {project_name}
 serviceaccountemail: {service_account}
 
 [CloudyClusterEnvironment]
-templateName: tester_template
+templateName: {template_name}
 keyName: {username}
 region: {region}
 az: {az}
@@ -792,7 +763,7 @@ az: {az}
 
 {job_config}
 
-[tester_template]
+[{template_name}]
 description: Creates a CloudyCluster Environment that contains a single {env_instance_type} CCQ enabled {scheduler} Scheduler, a {env_instance_type} Login instance, a 100GB OrangeFS Filesystem, and a {env_instance_type} NAT instance.
 vpcCidr: 10.0.0.0/16
 fsChoice: OrangeFS
@@ -803,10 +774,17 @@ nat1: {{'instanceType': '{env_instance_type}', 'accessFrom': '0.0.0.0/0'}}
 """)
         f.close()
 
-    run(["python3", "CreateEnvironmentTemplates.py", "-et", "CloudyCluster", "-cf", f"ConfigurationFiles/{confFile}", "-tn", "tester_template"], timeout=30, output=output_dir + "/template.log")
+    run(["python3", "CreateEnvironmentTemplates.py", "-et", "CloudyCluster", "-cf", f"ConfigurationFiles/{confFile}", "-tn", template_name], timeout=30, output=output_dir + "/template.log")
 
-    running_automaton, fail = run(["python3", "Create_Processing_Environment.py", "-et", "CloudyCluster", "-cf", f"ConfigurationFiles/{confFile}", "-all", "-nd"], timeout=7200, die=False, output=output_dir + "/automaton.log")
+    member = {"name": name, "confFile": confFile, "jobs": jobs, "output_dir": output_dir, "output_name": output_name, "dev_image": dev_image, "testimage": testimage, "sourceimage": sourceimage, "delete_on_failure": delete_on_failure, "email_flag": email_flag}
+    if email_flag:
+        member.update({"smtp_port": smtp_port, "port": port, "from_addr": from_addr, "to_addr": to_addr, "output_url": output_url})
+    return member
 
+def evaluate(member, running_automaton):
+    jobs = member["jobs"]
+    if member["name"]:
+        logger.info(f"Results for {member['name']}:")
     for job in jobs:
         job.cleanup_job()
 
@@ -856,45 +834,126 @@ nat1: {{'instanceType': '{env_instance_type}', 'accessFrom': '0.0.0.0/0'}}
         logger.info("Status: Success")
         status = "succeeded"
 
-    if dev_image == True:
-        image = f"Used the dev image: {testimage}"
+    if member["dev_image"] == True:
+        image = f"Used the dev image: {member['testimage']}"
     else:
-        image = f"Used the userapps image: {sourceimage}.\nCreated dev image: {testimage}"
+        image = f"Used the userapps image: {member['sourceimage']}.\nCreated dev image: {member['testimage']}"
 
-    if email_flag:
-        message = f"""From: {from_addr}
-To: {to_addr}
+    if member["email_flag"]:
+        message = f"""From: {member['from_addr']}
+To: {member['to_addr']}
 Subject: CloudyCluster: {success_count} of {success_count + fail_count} jobs successful
 Date: {email.utils.formatdate()}
 Message-Id: {email.utils.make_msgid()}
 
 {image}.
 
-Full output is available at {output_url}{output_part2}.
+Full output is available at {member['output_url']}{member['output_name']}.
 """
 
         context = ssl.create_default_context()
 
         try:
-            server = smtplib.SMTP(smtp_port, port)
+            server = smtplib.SMTP(member["smtp_port"], member["port"])
             server.starttls(context=context)
-            server.sendmail(from_addr, to_addr, message)
+            server.sendmail(member["from_addr"], member["to_addr"], message)
         except Exception as e:
             logger.error(e)
         finally:
             server.quit()
-    
-    if "failed" in status:
-        if delete_on_failure:
-            logger.error("There was a problem with the last run of automaton. Initiating a cleanup.")
-            fail = run(["python3", "Create_Processing_Environment.py", "-et", "CloudyCluster", "-cf", f"ConfigurationFiles/{confFile}", "-dff"], timeout=3600, die=False)[1]
 
-            if fail:
-                logger.critical("Could not cleanup. You will have to manually delete the created resources.")
-                sys.exit(1)
+    return status
+
+def main():
+    filenames = sys.argv[1:]
+    if len(filenames) == 0:
+        filenames = ["tester.config"]
+
+    for filename in filenames:
+        try:
+            os.stat(filename)
+        except FileNotFoundError:
+            logger.critical(f"configuration file {filename} not found")
+            sys.exit(1)
+
+    # The output directory comes from the first configuration, when several are given (ex: aws_slurm.config gcp_torque.config) each one gets a subdirectory named after it
+    cp = configparser.ConfigParser()
+    cp.read_file(open(filenames[0]))
+    try:
+        output_part1 = cp.get("tester", "output_part1")
+        output_part2 = cp.get("tester", "output_part2")
+    except configparser.NoSectionError:
+        logger.critical("missing configuration section")
+        sys.exit(1)
+    except configparser.NoOptionError:
+        logger.critical("Error: missing options in config file")
+        sys.exit(1)
+
+    output_part2 = time.strftime(output_part2)
+    output_dir = output_part1 + output_part2
+    start = time.time()
+    os.mkdir(output_dir)
+
+    stdout_handler = logging.StreamHandler(sys.stdout)
+    logging.root.addHandler(stdout_handler)
+
+    file_handler = logging.FileHandler(f"{output_dir}/tester.log", "a", "utf-8")
+    formatter = logging.Formatter("%(asctime)s>%(levelname)s:%(module)s:%(funcName)s-%(message)s")
+    file_handler.setFormatter(formatter)
+    logging.root.addHandler(file_handler)
 
-    elif "succeeded" in status:
-        run(["python3", "Create_Processing_Environment.py", "-et", "CloudyCluster", "-cf", f"ConfigurationFiles/{confFile}", "-dff"], timeout=3600, die=False)
+    logging.root.setLevel(logging.INFO)
+    
+    logger.info(f"The start time is: {output_part2}")
+
+    members = []
+    if len(filenames) == 1:
+        members.append(prepare(filenames[0], output_dir, output_part2))
+    else:
+        for filename in filenames:
+            name = os.path.splitext(os.path.basename(filename))[0]
+            os.mkdir(f"{output_dir}/{name}")
+            members.append(prepare(filename, f"{output_dir}/{name}", f"{output_part2}/{name}", name))
+
+    if len(members) == 1:
+        running_automaton, fail = run(["python3", "Create_Processing_Environment.py", "-et", "CloudyCluster", "-cf", f"ConfigurationFiles/{members[0]['confFile']}", "-all", "-nd"], timeout=7200, die=False, output=output_dir + "/automaton.log")
+        outputs = [running_automaton]
+    else:
+        # All of the configurations are provisioned and run by one automaton process at the same time, so the matrix takes as long as its slowest member
+        fan_out_dir = f"{output_dir}/automaton"
+        conf_files = [f"ConfigurationFiles/{member['confFile']}" for member in members]
+        run(["python3", "Create_Processing_Environment.py", "-et", "CloudyCluster", "-cf"] + conf_files + ["-all", "-nd", "-fw", str(len(members)), "-fo", fan_out_dir], timeout=7200, die=False, output=output_dir + "/automaton.log")
+        outputs = []
+        for member in members:
+            try:
+                f = open(f"{fan_out_dir}/{os.path.splitext(member['confFile'])[0]}.log")
+                outputs.append(f.read())
+                f.close()
+            except FileNotFoundError:
+                logger.error(f"no automaton output found for {member['name']}")
+                outputs.append("")
+
+    cleanup = []
+    cleanup_on_failure = []
+    for member, running_automaton in zip(members, outputs):
+        status = evaluate(member, running_automaton)
+        if "failed" in status:
+            if member["delete_on_failure"]:
+                logger.error("There was a problem with the last run of automaton. Initiating a cleanup.")
+                cleanup_on_failure.append(f"ConfigurationFiles/{member['confFile']}")
+        elif "succeeded" in status:
+            cleanup.append(f"ConfigurationFiles/{member['confFile']}")
+
+    # -dff deletes the resources recorded for each configuration file, so all of them are cleaned up by one run
+    if len(cleanup_on_failure) > 0:
+        fail = run(["python3", "Create_Processing_Environment.py", "-et", "CloudyCluster", "-cf"] + cleanup_on_failure + cleanup + ["-dff", "-fw", str(len(members))], timeout=3600, die=False)[1]
+
+        if fail:
+            logger.critical("Could not cleanup. You will have to manually delete the created resources.")
+            sys.exit(1)
+
+    elif len(cleanup) > 0:
+        run(["python3", "Create_Processing_Environment.py", "-et", "CloudyCluster", "-cf"] + cleanup + ["-dff", "-fw", str(len(members))], timeout=3600, die=False)
 
     end = time.strftime("%Y%m%d-%H%M")
     logger.info(f"The end time is: {end}")